@@ -6,11 +6,34 @@ import time
 import json
 import traceback
 import base64
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from fileutil import CHUNK_SIZE, FileBody
+from http_pool import ConnectionStats, create_session, DEFAULT_POOL_MAXSIZE
+from records import decode, DownloadUrls, Image, UploadUrls, WorkerConfig
+from request_stats import RequestStats, request_size, STATUS_ERROR
+import tracing
+
+# downloads larger than this are refused instead of exhausting memory
+MAX_DOWNLOAD_BYTES = 256 * 1024 * 1024
+
+
+class TransferTooLarge(Exception):
+    pass
+
 
 class AIBrushAPI(object):
-    def __init__(self, api_url: str, token: str, login_code: str=None):
+    def __init__(self, api_url: str, token: str, login_code: str=None, pool_maxsize: int=DEFAULT_POOL_MAXSIZE, transfer_workers: int=8):
         self.api_url = api_url
         self.token = token
+        # one keep-alive session shared by all worker threads
+        self.connection_stats = ConnectionStats()
+        self.session = create_session(self.connection_stats, pool_maxsize=pool_maxsize)
+        # latency, retries and bytes per endpoint
+        self.request_stats = RequestStats()
+        # runs S3 uploads and url prefetches alongside the calling thread
+        self.transfer_executor = ThreadPoolExecutor(max_workers=transfer_workers, thread_name_prefix="transfer")
         if token == None:
             self.token = self.login_as_worker(login_code).accessToken
         else:
@@ -23,7 +46,11 @@ class AIBrushAPI(object):
         resp = self.http_request("/worker-login", "POST", body)
         return self.parse_json(resp.text)
 
-    def http_request(self, path, method, body=None, content_type=None, auth=True) -> requests.Response:
+    def http_request(self, path, method, body=None, content_type=None, auth=True, endpoint: str=None, stream: bool=False) -> requests.Response:
+        # endpoint is the label request stats are recorded under, paths with ids in them
+        # should pass a template like "/images/{id}" so they aggregate into one series.
+        # body can be a FileBody to stream an upload from disk.
+        # stream=True leaves the response body unread, the caller must consume or close it.
         # hacky: auth=False means S3 call, which really doesn't like content-type headers.
         if not content_type and auth:
             content_type = "application/json"
@@ -31,49 +58,73 @@ class AIBrushAPI(object):
             url = path
         else:
             url = f"{self.api_url}/api{path}"
-        
-        backoff = 2
-        for _ in range(5):
-            try:
-                headers = {}
-                if content_type:
-                    headers["Content-Type"] = content_type
-                if self.token and auth:
-                    headers["Authorization"] = f"Bearer {self.token}"
-                # print(f"method: {method} url: {url} headers: {headers}")
-                if isinstance(body, bytes):
-                    return requests.request(method, url, data=body, headers=headers, timeout=10)
-                return requests.request(method, url, json=body, headers=headers, timeout=30)
-            except Exception as err:
-                print(f"Error making request: {err}")
-                traceback.print_exc()
-                time.sleep(backoff)
-                backoff *= 2
+        if endpoint is None:
+            endpoint = request_endpoint(path)
+
+        # a span of the current job's trace, if the calling thread is working on one
+        with tracing.span("http", endpoint=endpoint, method=method):
+            start = time.perf_counter()
+            backoff = 2
+            for attempt in range(5):
+                try:
+                    headers = {}
+                    if content_type:
+                        headers["Content-Type"] = content_type
+                    if self.token and auth:
+                        headers["Authorization"] = f"Bearer {self.token}"
+                    # print(f"method: {method} url: {url} headers: {headers}")
+                    if isinstance(body, FileBody):
+                        # rewind in case a previous attempt got part way through
+                        body.seek(0)
+                        resp = self.session.request(method, url, data=body, headers=headers, timeout=30, stream=stream)
+                    elif isinstance(body, (bytes, bytearray, memoryview)):
+                        resp = self.session.request(method, url, data=body, headers=headers, timeout=10, stream=stream)
+                    else:
+                        resp = self.session.request(method, url, json=body, headers=headers, timeout=30, stream=stream)
+                    if stream:
+                        # don't pull the body in just to measure it
+                        bytes_received = int(resp.headers.get("Content-Length") or 0)
+                    else:
+                        bytes_received = len(resp.content)
+                    self.request_stats.record(
+                        method, endpoint, resp.status_code, time.perf_counter() - start, attempt,
+                        len(body) if isinstance(body, FileBody) else request_size(resp.request.body), bytes_received)
+                    return resp
+                except Exception as err:
+                    print(f"Error making request: {err}")
+                    traceback.print_exc()
+                    time.sleep(backoff)
+                    backoff *= 2
+            self.request_stats.record(method, endpoint, STATUS_ERROR, time.perf_counter() - start, attempt, 0, 0)
+
+    def get_connection_stats(self, reset: bool=False) -> SimpleNamespace:
+        # opened, reused and requests, since startup or since the last reset
+        return self.connection_stats.snapshot(reset)
+
+    def connection_metrics(self) -> List[SimpleNamespace]:
+        # drains the connection counts into metrics for add_metrics
+        return self.connection_stats.to_metrics()
+
+    def get_request_stats(self, reset: bool=False) -> dict:
+        # "METHOD endpoint" -> requests, retries, bytes, statuses and a latency histogram snapshot
+        return self.request_stats.snapshot(reset)
+
+    def request_metrics(self) -> List[SimpleNamespace]:
+        # drains the request stats into metrics for add_metrics
+        return self.request_stats.to_metrics()
 
     def parse_json(self, json_str):
-        try:
-            return json.loads(json_str, object_hook=lambda d: SimpleNamespace(**d))
-        except Exception as err:
-            print(f"Error parsing json: {err}")
-            raise err
-
-    def process_image(self, status: str=None, include_models: List[str]=None, exclude_models: List[str]=None, peek=False) -> SimpleNamespace:
-        resp = self.http_request("/process-image", "PUT", body={
-            "include_models": include_models,
-            "exclude_models": exclude_models,
-            "status": status,
-            "peek": peek,
-        })
+        return parse_json(json_str)
+
+    def process_image(self, status: str=None, include_models: List[str]=None, exclude_models: List[str]=None, peek=False, limit: int=None, ping: bool=False) -> Image | List[Image]:
+        # with limit set, up to limit images are claimed in one round-trip and a list is returned.
+        # ping=True lets the claim double as the worker heartbeat
+        resp = self.http_request("/process-image", "PUT", body=process_image_body(status, include_models, exclude_models, peek, limit, ping))
         # print(resp.text)
-        # Use the "peek" parameter to peek at the next item without consuming it
-        # this allows the worker process to swap out models when needed without
-        # blocking pending images from being processed by other workers.
-        result = self.parse_json(resp.text)
-        if result and peek:
-            result.warmup = True
-        elif result:
-            result.warmup = False
-        return result
+        result = decode(Image, resp.content)
+        if limit is not None:
+            return parse_process_image_results(result, peek)
+        return parse_process_image_result(result, peek)
 
     def login(self, email: str) -> SimpleNamespace:
         body = {
@@ -89,54 +140,101 @@ class AIBrushAPI(object):
         resp = self.http_request("/auth/verify", "POST", body)
         return self.parse_json(resp.text)
 
-    def update_image(self, image_id: str, encoded_image: str, encoded_thumbnail: str, current_iterations: int, status: str, score: float, negative_score: float, nsfw: bool = False) -> SimpleNamespace:
+    def update_image(self, image_id: str, encoded_image: str, encoded_thumbnail: str, current_iterations: int, status: str, score: float, negative_score: float, nsfw: bool = False, upload_urls: SimpleNamespace | Future = None) -> SimpleNamespace:
+        with tracing.span("base64_decode"):
+            image_data = base64.b64decode(encoded_image) if encoded_image else None
+            thumbnail_data = base64.b64decode(encoded_thumbnail) if encoded_thumbnail else None
+        return self.update_image_data(image_id, image_data, thumbnail_data, current_iterations, status, score, negative_score, nsfw, upload_urls)
+
+    def update_image_data(self, image_id: str, image_data: bytes | memoryview, thumbnail_data: bytes | memoryview, current_iterations: int, status: str, score: float, negative_score: float, nsfw: bool = False, upload_urls: SimpleNamespace | Future = None, image_path: str = None) -> SimpleNamespace:
+        # same as update_image, but takes raw png bytes, which are uploaded without copies.
+        # image_path streams the image from disk instead of image_data, for large outputs.
+        # upload_urls can be passed in (or a future from prefetch_image_upload_urls)
+        # so that the urls are not fetched on the critical path
         image_upload_urls = None
-        if encoded_image or encoded_thumbnail:
+        if image_data or image_path or thumbnail_data:
+            image_upload_urls = self._resolve_upload_urls(image_id, upload_urls)
+        body = update_image_body(current_iterations, status, score, negative_score, nsfw)
+        uploads = []
+        if image_path and image_upload_urls:
+            uploads.append(("image", self.transfer_executor.submit(
+                self.upload_file, image_upload_urls.image_url, image_path)))
+        elif image_data and image_upload_urls:
+            uploads.append(("image", self.transfer_executor.submit(
+                self.http_request, image_upload_urls.image_url, "PUT", image_data, content_type="image/png", auth=False, endpoint="s3")))
+        if thumbnail_data and image_upload_urls:
+            uploads.append(("thumbnail", self.transfer_executor.submit(
+                self.http_request, image_upload_urls.thumbnail_url, "PUT", thumbnail_data, content_type="image/png", auth=False, endpoint="s3")))
+        # the transfers run on other threads, this is the time they add to the update
+        with tracing.span("upload_wait"):
+            self._wait_for_uploads(image_id, uploads)
+        resp = self.http_request(f"/images/{image_id}", "PATCH", body, endpoint="/images/{id}")
+        return self.parse_json(resp.text)
+
+    def prefetch_image_upload_urls(self, image_id: str) -> Future:
+        # fetch upload urls in the background while the image is still generating
+        return self.transfer_executor.submit(self.get_image_upload_urls, image_id)
+
+    def _resolve_upload_urls(self, image_id: str, upload_urls: SimpleNamespace | Future) -> SimpleNamespace:
+        if isinstance(upload_urls, Future):
             try:
-                image_upload_urls = self.get_image_upload_urls(image_id)
+                upload_urls = upload_urls.result()
             except:
-                print("Failed to get image upload urls")
-        body = {
-            "status": status,
-            "score": score,
-            "negative_score": negative_score,
-        }
-        if nsfw is not None:
-            body["nsfw"] = nsfw
-        if current_iterations:
-            body["current_iterations"] = current_iterations
-        if encoded_image and image_upload_urls:
-            # body["encoded_image"] = encoded_image
-            # base64 decode image
-            image_data = base64.b64decode(encoded_image)
-            resp = self.http_request(image_upload_urls.image_url, "PUT", image_data, content_type="image/png", auth=False)
-            print("Update image response", resp)
-        if encoded_thumbnail and image_upload_urls:
-            # body["encoded_thumbnail"] = encoded_thumbnail
-            # base64 decode image
-            thumbnail_data = base64.b64decode(encoded_thumbnail)
-            resp = self.http_request(image_upload_urls.thumbnail_url, "PUT", thumbnail_data, content_type="image/png", auth=False)
-            print("Update thumbnail response", resp)
-        resp = self.http_request(f"/images/{image_id}", "PATCH", body)
-        return self.parse_json(resp.text)
+                print("Failed to prefetch image upload urls")
+                upload_urls = None
+        if upload_urls:
+            return upload_urls
+        try:
+            return self.get_image_upload_urls(image_id)
+        except:
+            print("Failed to get image upload urls")
 
-    def get_image_data(self, image_id: str, url: str=None) -> bytes:
-        resp = self.http_request(url or f"/images/{image_id}.image.png", "GET", auth=False)
-        # print("response", resp)
-        if resp.status_code != 200:
-            return None
-        # read binary data
-        return resp.content
+    def _wait_for_uploads(self, image_id: str, uploads: list):
+        # the status update must not be sent unless every upload landed
+        failed = []
+        for name, upload in uploads:
+            resp = upload.result()
+            print(f"Update {name} response", resp)
+            if resp is None or not resp.ok:
+                failed.append(name)
+        if failed:
+            raise Exception(f"Failed to upload {', '.join(failed)} for image {image_id}")
+
+    def get_image_data(self, image_id: str, url: str=None, dest: str=None, max_bytes: int=MAX_DOWNLOAD_BYTES) -> bytearray | str:
+        return self.download(url or f"/images/{image_id}.image.png", dest, max_bytes=max_bytes,
+                             endpoint="s3" if url else "/images/{id}.image.png")
 
-    def get_mask_data(self, image_id: str, url: str=None) -> bytes:
-        resp = self.http_request(url or f"/images/{image_id}.mask.png", "GET", auth=False)
-        if resp.status_code != 200:
+    def get_mask_data(self, image_id: str, url: str=None, dest: str=None, max_bytes: int=MAX_DOWNLOAD_BYTES) -> bytearray | str:
+        return self.download(url or f"/images/{image_id}.mask.png", dest, max_bytes=max_bytes,
+                             endpoint="s3" if url else "/images/{id}.mask.png")
+
+    def download(self, path: str, dest: str=None, chunk_size: int=CHUNK_SIZE, max_bytes: int=MAX_DOWNLOAD_BYTES, endpoint: str=None) -> bytearray | str:
+        # streams a download into one buffer (preallocated when the size is known),
+        # or into the file at dest, and returns the buffer or dest. Returns None if
+        # the download failed, raises if the body is larger than max_bytes.
+        resp = self.http_request(path, "GET", auth=False, endpoint=endpoint, stream=True)
+        if resp is None:
             return None
-        # read binary data
-        return resp.content
+        with resp:
+            if resp.status_code != 200:
+                return None
+            length = int(resp.headers.get("Content-Length") or 0)
+            if max_bytes and length > max_bytes:
+                raise TransferTooLarge(f"Download of {length} bytes exceeds limit of {max_bytes}")
+            if dest:
+                return _stream_to_file(resp, dest, chunk_size, max_bytes)
+            return _stream_to_buffer(resp, length, chunk_size, max_bytes)
+
+    def upload_file(self, url: str, path: str, content_type: str="image/png", chunk_size: int=CHUNK_SIZE) -> requests.Response:
+        # streams a file from disk to a presigned url
+        body = FileBody(path, chunk_size)
+        try:
+            return self.http_request(url, "PUT", body, content_type=content_type, auth=False, endpoint="s3")
+        finally:
+            body.close()
 
     def update_video_data(self, image_id: str, video_data: bytes):
-        resp = self.http_request(f"/images/{image_id}.mp4", "PUT", video_data, "video/mp4")
+        resp = self.http_request(f"/images/{image_id}.mp4", "PUT", video_data, "video/mp4", endpoint="/images/{id}.mp4")
         if resp.status_code != 204:
             print(f"Error updating video data ({resp.status_code}): {resp.text}")
             return False
@@ -166,81 +264,40 @@ class AIBrushAPI(object):
         uncrop_offset_x: int = None,
         uncrop_offset_y: int = None
     ) -> SimpleNamespace:
-        body = {
-            "phrases": [],
-            "negative_phrases": [],
-            "label": "",
-            "iterations": 50,
-            "encoded_image": "",
-            "encoded_npy": "",
-            "encoded_mask": "",
-            "enable_video": False,
-            "enable_zoom": False,
-            "zoom_frequency": 10,
-            "zoom_scale": 0.99,
-            "zoom_shift_x": 0,
-            "zoom_shift_y": 0,
-            "model": "glid_3_xl",
-            "glid_3_xl_clip_guidance": False,
-            "glid_3_xl_clip_guidance_scale": 150,
-            "glid_3_xl_skip_iterations": 0,
-            "width": 256,
-            "height": 256,
-        }
-        if phrases is not None:
-            body["phrases"] = phrases
-        if negative_phrases is not None:
-            body["negative_phrases"] = negative_phrases
-        if label is not None:
-            body["label"] = label
-        if iterations is not None:
-            body["iterations"] = iterations
-        if parent is not None:
-            body["parent"] = parent
-        if encoded_image is not None:
-            body["encoded_image"] = encoded_image
-        if encoded_mask is not None:
-            body["encoded_mask"] = encoded_mask
-        if encoded_npy is not None:
-            body["encoded_npy"] = encoded_npy
-        if enable_video is not None:
-            body["enable_video"] = enable_video
-        if enable_zoom is not None:
-            body["enable_zoom"] = enable_zoom
-        if zoom_frequency is not None:
-            body["zoom_frequency"] = zoom_frequency
-        if zoom_scale is not None:
-            body["zoom_scale"] = zoom_scale
-        if zoom_shift_x is not None:
-            body["zoom_shift_x"] = zoom_shift_x
-        if zoom_shift_y is not None:
-            body["zoom_shift_y"] = zoom_shift_y
-        if model is not None:
-            body["model"] = model
-        if glid_3_xl_clip_guidance is not None:
-            body["glid_3_xl_clip_guidance"] = glid_3_xl_clip_guidance
-        if glid_3_xl_clip_guidance_scale is not None:
-            body["glid_3_xl_clip_guidance_scale"] = glid_3_xl_clip_guidance_scale
-        if glid_3_xl_skip_iterations is not None:
-            body["glid_3_xl_skip_iterations"] = glid_3_xl_skip_iterations
-        if height is not None:
-            body["height"] = height
-        if width is not None:
-            body["width"] = width
-        if uncrop_offset_x is not None:
-            body["uncrop_offset_x"] = uncrop_offset_x
-        if uncrop_offset_y is not None:
-            body["uncrop_offset_y"] = uncrop_offset_y
+        body = create_image_body(
+            phrases=phrases,
+            negative_phrases=negative_phrases,
+            label=label,
+            iterations=iterations,
+            parent=parent,
+            encoded_image=encoded_image,
+            encoded_mask=encoded_mask,
+            encoded_npy=encoded_npy,
+            enable_video=enable_video,
+            enable_zoom=enable_zoom,
+            zoom_frequency=zoom_frequency,
+            zoom_scale=zoom_scale,
+            zoom_shift_x=zoom_shift_x,
+            zoom_shift_y=zoom_shift_y,
+            model=model,
+            glid_3_xl_skip_iterations=glid_3_xl_skip_iterations,
+            glid_3_xl_clip_guidance=glid_3_xl_clip_guidance,
+            glid_3_xl_clip_guidance_scale=glid_3_xl_clip_guidance_scale,
+            height=height,
+            width=width,
+            uncrop_offset_x=uncrop_offset_x,
+            uncrop_offset_y=uncrop_offset_y,
+        )
         resp = self.http_request("/images", "POST", body)
         return self.parse_json(resp.text)
 
     def delete_image(self, image_id: str) -> bool:
-        resp = self.http_request(f"/images/{image_id}", "DELETE")
+        resp = self.http_request(f"/images/{image_id}", "DELETE", endpoint="/images/{id}")
         return resp.status_code == 204
 
-    def get_image(self, image_id: str) -> SimpleNamespace:
-        resp = self.http_request(f"/images/{image_id}", "GET")
-        return self.parse_json(resp.text)
+    def get_image(self, image_id: str) -> Image:
+        resp = self.http_request(f"/images/{image_id}", "GET", endpoint="/images/{id}")
+        return decode(Image, resp.content)
 
     def add_metrics(self, metrics: List[SimpleNamespace]):
         body = {
@@ -248,21 +305,214 @@ class AIBrushAPI(object):
         }
         self.http_request("/metrics", "POST", body)
 
-    def get_worker_config(self, worker_id: str) -> SimpleNamespace:
-        resp = self.http_request(f"/workers/{worker_id}/config", "GET")
-        return self.parse_json(resp.text)
+    def get_worker_config(self, worker_id: str) -> WorkerConfig:
+        resp = self.http_request(f"/workers/{worker_id}/config", "GET", endpoint="/workers/{id}/config")
+        return decode(WorkerConfig, resp.content)
 
     def worker_ping(self):
         self.http_request("/worker-ping", "POST")
 
-    def get_image_download_urls(self, image_id: str) -> SimpleNamespace:
-        resp = self.http_request(f"/images/{image_id}/download-urls", "GET")
-        return self.parse_json(resp.text)
+    def get_image_download_urls(self, image_id: str) -> DownloadUrls:
+        resp = self.http_request(f"/images/{image_id}/download-urls", "GET", endpoint="/images/{id}/download-urls")
+        return decode(DownloadUrls, resp.content)
     
-    def get_image_upload_urls(self, image_id: str) -> SimpleNamespace:
-        resp = self.http_request(f"/images/{image_id}/upload-urls", "GET")
-        return self.parse_json(resp.text)
+    def get_image_upload_urls(self, image_id: str) -> UploadUrls:
+        resp = self.http_request(f"/images/{image_id}/upload-urls", "GET", endpoint="/images/{id}/upload-urls")
+        return decode(UploadUrls, resp.content)
 
     def get_bugsnag_api_key(self) -> str:
         resp = self.http_request("/bugsnag-api-key", "GET")
         return self.parse_json(resp.text).bugsnag_api_key
+
+
+def parse_json(json_str):
+    try:
+        return json.loads(json_str, object_hook=lambda d: SimpleNamespace(**d))
+    except Exception as err:
+        print(f"Error parsing json: {err}")
+        raise err
+
+
+def _stream_to_buffer(resp: requests.Response, length: int, chunk_size: int, max_bytes: int) -> bytearray:
+    # chunks are copied straight into the result instead of collected and joined
+    buf = bytearray(length)
+    pos = 0
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        end = pos + len(chunk)
+        if max_bytes and end > max_bytes:
+            raise TransferTooLarge(f"Download exceeds limit of {max_bytes} bytes")
+        if end <= length:
+            buf[pos:end] = chunk
+        else:
+            # no (or a wrong) Content-Length, grow as we go
+            del buf[pos:]
+            buf += chunk
+            length = end
+        pos = end
+    if pos < length:
+        del buf[pos:]
+    return buf
+
+
+def _stream_to_file(resp: requests.Response, dest: str, chunk_size: int, max_bytes: int) -> str:
+    part = dest + ".part"
+    size = 0
+    try:
+        with open(part, "wb") as f:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise TransferTooLarge(f"Download exceeds limit of {max_bytes} bytes")
+                f.write(chunk)
+        os.replace(part, dest)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return dest
+
+
+def request_endpoint(path: str) -> str:
+    # default stats label: presigned storage urls all count as "s3", api paths as themselves
+    if path.startswith("http"):
+        return "s3"
+    return path
+
+
+def process_image_body(status: str=None, include_models: List[str]=None, exclude_models: List[str]=None, peek=False, limit: int=None, ping: bool=False) -> dict:
+    body = {
+        "include_models": include_models,
+        "exclude_models": exclude_models,
+        "status": status,
+        "peek": peek,
+    }
+    if limit is not None:
+        body["limit"] = limit
+    if ping:
+        body["ping"] = True
+    return body
+
+
+def parse_process_image_result(result, peek: bool):
+    # Use the "peek" parameter to peek at the next item without consuming it
+    # this allows the worker process to swap out models when needed without
+    # blocking pending images from being processed by other workers.
+    if result and peek:
+        result.warmup = True
+    elif result:
+        result.warmup = False
+    return result
+
+
+def parse_process_image_results(result, peek: bool) -> list:
+    # backends without batch support answer a batch claim with a single image (or null)
+    if not result:
+        return []
+    if not isinstance(result, list):
+        result = [result]
+    return [parse_process_image_result(image, peek) for image in result]
+
+
+def update_image_body(current_iterations: int, status: str, score: float, negative_score: float, nsfw: bool = False) -> dict:
+    body = {
+        "status": status,
+        "score": score,
+        "negative_score": negative_score,
+    }
+    if nsfw is not None:
+        body["nsfw"] = nsfw
+    if current_iterations:
+        body["current_iterations"] = current_iterations
+    return body
+
+
+# Make all args default to None
+def create_image_body(
+    phrases: List[str] = None,
+    negative_phrases: List[str] = None,
+    label: str = None,
+    iterations: int = None,
+    parent: str = None,
+    encoded_image: str = None,
+    encoded_mask: str = None,
+    encoded_npy: str = None,
+    enable_video: bool = None,
+    enable_zoom: bool = None,
+    zoom_frequency: int = None,
+    zoom_scale: float = None,
+    zoom_shift_x: float = None,
+    zoom_shift_y: float = None,
+    model: str = None,
+    glid_3_xl_skip_iterations: int = None,
+    glid_3_xl_clip_guidance: bool = None,
+    glid_3_xl_clip_guidance_scale: float = None,
+    height: int = None,
+    width: int = None,
+    uncrop_offset_x: int = None,
+    uncrop_offset_y: int = None
+) -> dict:
+    body = {
+        "phrases": [],
+        "negative_phrases": [],
+        "label": "",
+        "iterations": 50,
+        "encoded_image": "",
+        "encoded_npy": "",
+        "encoded_mask": "",
+        "enable_video": False,
+        "enable_zoom": False,
+        "zoom_frequency": 10,
+        "zoom_scale": 0.99,
+        "zoom_shift_x": 0,
+        "zoom_shift_y": 0,
+        "model": "glid_3_xl",
+        "glid_3_xl_clip_guidance": False,
+        "glid_3_xl_clip_guidance_scale": 150,
+        "glid_3_xl_skip_iterations": 0,
+        "width": 256,
+        "height": 256,
+    }
+    if phrases is not None:
+        body["phrases"] = phrases
+    if negative_phrases is not None:
+        body["negative_phrases"] = negative_phrases
+    if label is not None:
+        body["label"] = label
+    if iterations is not None:
+        body["iterations"] = iterations
+    if parent is not None:
+        body["parent"] = parent
+    if encoded_image is not None:
+        body["encoded_image"] = encoded_image
+    if encoded_mask is not None:
+        body["encoded_mask"] = encoded_mask
+    if encoded_npy is not None:
+        body["encoded_npy"] = encoded_npy
+    if enable_video is not None:
+        body["enable_video"] = enable_video
+    if enable_zoom is not None:
+        body["enable_zoom"] = enable_zoom
+    if zoom_frequency is not None:
+        body["zoom_frequency"] = zoom_frequency
+    if zoom_scale is not None:
+        body["zoom_scale"] = zoom_scale
+    if zoom_shift_x is not None:
+        body["zoom_shift_x"] = zoom_shift_x
+    if zoom_shift_y is not None:
+        body["zoom_shift_y"] = zoom_shift_y
+    if model is not None:
+        body["model"] = model
+    if glid_3_xl_clip_guidance is not None:
+        body["glid_3_xl_clip_guidance"] = glid_3_xl_clip_guidance
+    if glid_3_xl_clip_guidance_scale is not None:
+        body["glid_3_xl_clip_guidance_scale"] = glid_3_xl_clip_guidance_scale
+    if glid_3_xl_skip_iterations is not None:
+        body["glid_3_xl_skip_iterations"] = glid_3_xl_skip_iterations
+    if height is not None:
+        body["height"] = height
+    if width is not None:
+        body["width"] = width
+    if uncrop_offset_x is not None:
+        body["uncrop_offset_x"] = uncrop_offset_x
+    if uncrop_offset_y is not None:
+        body["uncrop_offset_y"] = uncrop_offset_y
+    return body
@@ -1,13 +1,33 @@
 from queue import Queue, Full
 import asyncio
+from threading import Lock, Thread
 import websockets
 import time
 
 import traceback
 
+# One long-lived websocket per process. Every local worker registers its
+# websocket queue and each notification is fanned out to all of them, so a
+# host with N gpus holds one connection instead of N.
+# The connection is kept alive with websocket pings and only reconnects
+# (with backoff, handled by websockets.connect) when it drops.
+# Configurable options:
+#  ping_interval: seconds between keepalive pings, the connection is
+#  considered dead if a pong doesn't arrive within ping_timeout
+
+PING_INTERVAL = 20
+PING_TIMEOUT = 20
+
+
+class Notification(str):
+    # the raw message, plus when it was received so the poll loop
+    # can measure notification to claim latency
+    received_at: float = None
+
+
 class ApiSocket:
 
-    def __init__(self, api_url: str, access_token: str, websocket_queue: Queue):
+    def __init__(self, api_url: str, access_token: str, websocket_queue: Queue = None, ping_interval: float = PING_INTERVAL, ping_timeout: float = PING_TIMEOUT):
         parts = api_url.split("://")
         protocol = parts[0]
         self.host = parts[1]
@@ -16,42 +36,99 @@ class ApiSocket:
         else:
             self.protocol = "wss"
         self.access_token = access_token
-        self.websocket_queue = websocket_queue
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self._queues = []
+        self._lock = Lock()
+        if websocket_queue is not None:
+            self._queues.append(websocket_queue)
         self._kill = False
+        self._loop = None
+        self._websocket = None
+        self._thread = None
+
+    def register(self, websocket_queue: Queue):
+        with self._lock:
+            self._queues.append(websocket_queue)
+
+    def unregister(self, websocket_queue: Queue):
+        # the socket shuts down when its last listener goes away
+        with self._lock:
+            if websocket_queue in self._queues:
+                self._queues.remove(websocket_queue)
+            last = not self._queues
+        if last:
+            self.kill()
+
+    def start(self):
+        # runs the socket on its own event loop thread, safe to call once per worker
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=asyncio.run, args=(self.run(),), name="apisocket", daemon=True)
+                self._thread.start()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
 
     def kill(self):
         print("kill called")
         self._kill = True
+        # wake the receive loop instead of waiting for the next message
+        if self._loop and self._websocket:
+            self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._websocket.close()))
+
+    def publish(self, message: str):
+        notification = Notification(message)
+        notification.received_at = time.time()
+        with self._lock:
+            queues = list(self._queues)
+        for queue in queues:
+            try:
+                queue.put_nowait(notification)
+            except Full:
+                # a notification is already waiting for that worker, which is all it needs
+                print("message ignored (queue full)")
 
     async def run(self):
         websocket_url = f"{self.protocol}://{self.host}"
         print(f"api socket connecting to {websocket_url}")
+        self._loop = asyncio.get_running_loop()
         try:
-            async for websocket in websockets.connect(websocket_url):
-                start = time.time()
+            async for websocket in websockets.connect(websocket_url, ping_interval=self.ping_interval, ping_timeout=self.ping_timeout):
+                self._websocket = websocket
                 try:
+                    if self._kill:
+                        print("killing websocket")
+                        await websocket.close()
+                        return
                     print("authenticating")
                     await websocket.send(self.access_token)
                     print("authenticated")
-                    while time.time() - start < 5 * 60:
-                        if self._kill:
-                            print("killing websocket")
-                            return
-                        message = None
-                        try:
-                            message = await asyncio.wait_for(websocket.recv(), timeout=1)
-                        except asyncio.TimeoutError:
-                            pass
-                        if message:
-                            print("message received")
-                            try:
-                                self.websocket_queue.put(message, timeout=0.1)
-                            except Full:
-                                print("message ignored (queue full)")
-                                pass
+                    async for message in websocket:
+                        print("message received")
+                        self.publish(message)
+                except websockets.ConnectionClosed as err:
+                    print(f"websocket closed: {err}")
                 except Exception as err:
                     print(f"Error in websocket loop: {err}")
                     traceback.print_exc()
+                if self._kill:
+                    print("killing websocket")
+                    return
         except Exception as err:
             print(f"Error in websocket connection: {err}")
             traceback.print_exc()
+
+
+_shared_socket = None
+_shared_socket_lock = Lock()
+
+
+def shared_socket(api_url: str, access_token: str) -> ApiSocket:
+    # the process-wide socket, created on first use
+    global _shared_socket
+    with _shared_socket_lock:
+        if _shared_socket is None or _shared_socket._kill:
+            _shared_socket = ApiSocket(api_url, access_token)
+        return _shared_socket
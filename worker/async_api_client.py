@@ -0,0 +1,423 @@
+# asyncio version of AIBrushAPI. Mirrors the blocking client method for method,
+# so a worker can keep hundreds of transfers in flight on a single event loop
+# instead of parking one OS thread per socket.
+# Configurable options:
+#  max_concurrency: how many requests may be in flight at once
+#  pool_maxsize: how many keep-alive connections to keep per host
+# Retry semantics match AIBrushAPI.http_request: 5 attempts with exponential
+# backoff starting at 2 seconds, after which None is returned.
+
+import asyncio
+import base64
+import json
+import os
+import time
+import traceback
+from types import SimpleNamespace
+from typing import List
+
+import aiohttp
+
+from api_client import (
+    MAX_DOWNLOAD_BYTES,
+    TransferTooLarge,
+    create_image_body,
+    parse_json,
+    parse_process_image_result,
+    parse_process_image_results,
+    process_image_body,
+    request_endpoint,
+    update_image_body,
+)
+from fileutil import CHUNK_SIZE, FileBody
+from http_pool import ConnectionStats, DEFAULT_POOL_MAXSIZE
+from records import decode, DownloadUrls, Image, UploadUrls, WorkerConfig
+from request_stats import RequestStats, request_size, STATUS_ERROR
+
+DEFAULT_MAX_CONCURRENCY = 256
+
+
+class AsyncResponse(object):
+    # the subset of requests.Response that the client methods use
+    def __init__(self, status_code: int, content: bytes, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def __repr__(self):
+        return "<AsyncResponse [%s]>" % self.status_code
+
+
+class AsyncAIBrushAPI(object):
+    def __init__(self, api_url: str, token: str, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, pool_maxsize: int=DEFAULT_POOL_MAXSIZE):
+        self.api_url = api_url
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.pool_maxsize = pool_maxsize
+        self.connection_stats = ConnectionStats()
+        self.request_stats = RequestStats()
+        self._semaphore = None
+        self._session = None
+
+    @classmethod
+    async def create(cls, api_url: str, token: str, login_code: str=None, **kwargs) -> "AsyncAIBrushAPI":
+        client = cls(api_url, token, **kwargs)
+        if token == None:
+            client.token = (await client.login_as_worker(login_code)).accessToken
+        return client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily so that the session binds to the running event loop
+        if self._session is None:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection_create)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+            trace_config.on_request_start.append(self._on_request_start)
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.pool_maxsize)
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def _on_connection_create(self, session, context, params):
+        self.connection_stats.connection_opened()
+
+    async def _on_connection_reuse(self, session, context, params):
+        self.connection_stats.connection_reused()
+
+    async def _on_request_start(self, session, context, params):
+        self.connection_stats.request_sent()
+
+    def get_connection_stats(self, reset: bool=False) -> SimpleNamespace:
+        return self.connection_stats.snapshot(reset)
+
+    def connection_metrics(self) -> List[SimpleNamespace]:
+        # drains the connection counts into metrics for add_metrics
+        return self.connection_stats.to_metrics()
+
+    def get_request_stats(self, reset: bool=False) -> dict:
+        return self.request_stats.snapshot(reset)
+
+    def request_metrics(self) -> List[SimpleNamespace]:
+        return self.request_stats.to_metrics()
+
+    async def login_as_worker(self, login_code: str) -> SimpleNamespace:
+        body = {
+            "login_code": login_code
+        }
+        resp = await self.http_request("/worker-login", "POST", body)
+        return self.parse_json(resp.text)
+
+    async def http_request(self, path, method, body=None, content_type=None, auth=True, endpoint: str=None, sink=None) -> AsyncResponse:
+        # sink is an async callable that consumes a 200 response body in place of
+        # reading it into memory, its result becomes the response content.
+        # hacky: auth=False means S3 call, which really doesn't like content-type headers.
+        if not content_type and auth:
+            content_type = "application/json"
+        if path.startswith("http"):
+            url = path
+        else:
+            url = f"{self.api_url}/api{path}"
+        if endpoint is None:
+            endpoint = request_endpoint(path)
+
+        if isinstance(body, FileBody):
+            data, timeout = None, aiohttp.ClientTimeout(total=None, sock_read=30)
+        elif isinstance(body, (bytes, bytearray, memoryview)):
+            data, timeout = body, aiohttp.ClientTimeout(total=10)
+        else:
+            # encoded here rather than with json= so the bytes sent can be recorded
+            data, timeout = None if body is None else json.dumps(body).encode(), aiohttp.ClientTimeout(total=30)
+            if data is not None and not content_type:
+                content_type = "application/json"
+
+        session = self._get_session()
+        start = time.perf_counter()
+        backoff = 2
+        for attempt in range(5):
+            try:
+                headers = {}
+                if content_type:
+                    headers["Content-Type"] = content_type
+                if self.token and auth:
+                    headers["Authorization"] = f"Bearer {self.token}"
+                if isinstance(body, FileBody):
+                    # an explicit length keeps aiohttp from chunking the upload, which S3 rejects
+                    headers["Content-Length"] = str(len(body))
+                    body.seek(0)
+                    data = _file_chunks(body)
+                async with self._semaphore:
+                    async with session.request(method, url, headers=headers, data=data, timeout=timeout) as resp:
+                        if sink and resp.status == 200:
+                            content = await sink(resp)
+                            bytes_received = resp.content_length or 0
+                        else:
+                            content = await resp.read()
+                            bytes_received = len(content)
+                        self.request_stats.record(
+                            method, endpoint, resp.status, time.perf_counter() - start, attempt,
+                            len(body) if isinstance(body, FileBody) else request_size(data), bytes_received)
+                        return AsyncResponse(resp.status, content, resp.headers)
+            except TransferTooLarge:
+                # retrying won't make it any smaller
+                raise
+            except Exception as err:
+                print(f"Error making request: {err}")
+                traceback.print_exc()
+                await asyncio.sleep(backoff)
+                backoff *= 2
+        self.request_stats.record(method, endpoint, STATUS_ERROR, time.perf_counter() - start, attempt, 0, 0)
+
+    def parse_json(self, json_str):
+        return parse_json(json_str)
+
+    async def process_image(self, status: str=None, include_models: List[str]=None, exclude_models: List[str]=None, peek=False, limit: int=None, ping: bool=False) -> Image | List[Image]:
+        resp = await self.http_request("/process-image", "PUT", body=process_image_body(status, include_models, exclude_models, peek, limit, ping))
+        result = decode(Image, resp.content)
+        if limit is not None:
+            return parse_process_image_results(result, peek)
+        return parse_process_image_result(result, peek)
+
+    async def login(self, email: str) -> SimpleNamespace:
+        body = {
+            "email": email,
+        }
+        await self.http_request("/auth/login", "POST", body)
+
+    async def verify_login(self, email: str, code: str) -> SimpleNamespace:
+        body = {
+            "email": email,
+            "code": code,
+        }
+        resp = await self.http_request("/auth/verify", "POST", body)
+        return self.parse_json(resp.text)
+
+    async def update_image(self, image_id: str, encoded_image: str, encoded_thumbnail: str, current_iterations: int, status: str, score: float, negative_score: float, nsfw: bool = False, upload_urls: SimpleNamespace | asyncio.Task = None) -> SimpleNamespace:
+        image_data = base64.b64decode(encoded_image) if encoded_image else None
+        thumbnail_data = base64.b64decode(encoded_thumbnail) if encoded_thumbnail else None
+        return await self.update_image_data(image_id, image_data, thumbnail_data, current_iterations, status, score, negative_score, nsfw, upload_urls)
+
+    async def update_image_data(self, image_id: str, image_data: bytes | memoryview, thumbnail_data: bytes | memoryview, current_iterations: int, status: str, score: float, negative_score: float, nsfw: bool = False, upload_urls: SimpleNamespace | asyncio.Task = None, image_path: str = None) -> SimpleNamespace:
+        image_upload_urls = None
+        if image_data or image_path or thumbnail_data:
+            image_upload_urls = await self._resolve_upload_urls(image_id, upload_urls)
+        body = update_image_body(current_iterations, status, score, negative_score, nsfw)
+        names = []
+        uploads = []
+        if image_path and image_upload_urls:
+            names.append("image")
+            uploads.append(self.upload_file(image_upload_urls.image_url, image_path))
+        elif image_data and image_upload_urls:
+            names.append("image")
+            uploads.append(self.http_request(image_upload_urls.image_url, "PUT", image_data, content_type="image/png", auth=False, endpoint="s3"))
+        if thumbnail_data and image_upload_urls:
+            names.append("thumbnail")
+            uploads.append(self.http_request(image_upload_urls.thumbnail_url, "PUT", thumbnail_data, content_type="image/png", auth=False, endpoint="s3"))
+        failed = []
+        for name, resp in zip(names, await asyncio.gather(*uploads)):
+            print(f"Update {name} response", resp)
+            if resp is None or resp.status_code >= 300:
+                failed.append(name)
+        if failed:
+            raise Exception(f"Failed to upload {', '.join(failed)} for image {image_id}")
+        resp = await self.http_request(f"/images/{image_id}", "PATCH", body, endpoint="/images/{id}")
+        return self.parse_json(resp.text)
+
+    def prefetch_image_upload_urls(self, image_id: str) -> asyncio.Task:
+        return asyncio.ensure_future(self.get_image_upload_urls(image_id))
+
+    async def _resolve_upload_urls(self, image_id: str, upload_urls: SimpleNamespace | asyncio.Task) -> SimpleNamespace:
+        if isinstance(upload_urls, asyncio.Future):
+            try:
+                upload_urls = await upload_urls
+            except:
+                print("Failed to prefetch image upload urls")
+                upload_urls = None
+        if upload_urls:
+            return upload_urls
+        try:
+            return await self.get_image_upload_urls(image_id)
+        except:
+            print("Failed to get image upload urls")
+
+    async def get_image_data(self, image_id: str, url: str=None, dest: str=None, max_bytes: int=MAX_DOWNLOAD_BYTES) -> bytearray | str:
+        return await self.download(url or f"/images/{image_id}.image.png", dest, max_bytes=max_bytes,
+                                   endpoint="s3" if url else "/images/{id}.image.png")
+
+    async def get_mask_data(self, image_id: str, url: str=None, dest: str=None, max_bytes: int=MAX_DOWNLOAD_BYTES) -> bytearray | str:
+        return await self.download(url or f"/images/{image_id}.mask.png", dest, max_bytes=max_bytes,
+                                   endpoint="s3" if url else "/images/{id}.mask.png")
+
+    async def download(self, path: str, dest: str=None, chunk_size: int=CHUNK_SIZE, max_bytes: int=MAX_DOWNLOAD_BYTES, endpoint: str=None) -> bytearray | str:
+        async def sink(resp):
+            length = resp.content_length or 0
+            if max_bytes and length > max_bytes:
+                raise TransferTooLarge(f"Download of {length} bytes exceeds limit of {max_bytes}")
+            if dest:
+                return await _stream_to_file(resp, dest, chunk_size, max_bytes)
+            return await _stream_to_buffer(resp, length, chunk_size, max_bytes)
+
+        resp = await self.http_request(path, "GET", auth=False, endpoint=endpoint, sink=sink)
+        if resp is None or resp.status_code != 200:
+            return None
+        return resp.content
+
+    async def upload_file(self, url: str, path: str, content_type: str="image/png", chunk_size: int=CHUNK_SIZE) -> AsyncResponse:
+        body = FileBody(path, chunk_size)
+        try:
+            return await self.http_request(url, "PUT", body, content_type=content_type, auth=False, endpoint="s3")
+        finally:
+            body.close()
+
+    async def update_video_data(self, image_id: str, video_data: bytes):
+        resp = await self.http_request(f"/images/{image_id}.mp4", "PUT", video_data, "video/mp4", endpoint="/images/{id}.mp4")
+        if resp.status_code != 204:
+            print(f"Error updating video data ({resp.status_code}): {resp.text}")
+            return False
+
+    async def create_image(
+        self, phrases: List[str] = None,
+        negative_phrases: List[str] = None,
+        label: str = None,
+        iterations: int = None,
+        parent: str = None,
+        encoded_image: str = None,
+        encoded_mask: str = None,
+        encoded_npy: str = None,
+        enable_video: bool = None,
+        enable_zoom: bool = None,
+        zoom_frequency: int = None,
+        zoom_scale: float = None,
+        zoom_shift_x: float = None,
+        zoom_shift_y: float = None,
+        model: str = None,
+        glid_3_xl_skip_iterations: int = None,
+        glid_3_xl_clip_guidance: bool = None,
+        glid_3_xl_clip_guidance_scale: float = None,
+        height: int = None,
+        width: int = None,
+        uncrop_offset_x: int = None,
+        uncrop_offset_y: int = None
+    ) -> SimpleNamespace:
+        body = create_image_body(
+            phrases=phrases,
+            negative_phrases=negative_phrases,
+            label=label,
+            iterations=iterations,
+            parent=parent,
+            encoded_image=encoded_image,
+            encoded_mask=encoded_mask,
+            encoded_npy=encoded_npy,
+            enable_video=enable_video,
+            enable_zoom=enable_zoom,
+            zoom_frequency=zoom_frequency,
+            zoom_scale=zoom_scale,
+            zoom_shift_x=zoom_shift_x,
+            zoom_shift_y=zoom_shift_y,
+            model=model,
+            glid_3_xl_skip_iterations=glid_3_xl_skip_iterations,
+            glid_3_xl_clip_guidance=glid_3_xl_clip_guidance,
+            glid_3_xl_clip_guidance_scale=glid_3_xl_clip_guidance_scale,
+            height=height,
+            width=width,
+            uncrop_offset_x=uncrop_offset_x,
+            uncrop_offset_y=uncrop_offset_y,
+        )
+        resp = await self.http_request("/images", "POST", body)
+        return self.parse_json(resp.text)
+
+    async def delete_image(self, image_id: str) -> bool:
+        resp = await self.http_request(f"/images/{image_id}", "DELETE", endpoint="/images/{id}")
+        return resp.status_code == 204
+
+    async def get_image(self, image_id: str) -> Image:
+        resp = await self.http_request(f"/images/{image_id}", "GET", endpoint="/images/{id}")
+        return decode(Image, resp.content)
+
+    async def add_metrics(self, metrics: List[SimpleNamespace]):
+        body = {
+            "metrics": [m.__dict__ for m in metrics]
+        }
+        await self.http_request("/metrics", "POST", body)
+
+    async def get_worker_config(self, worker_id: str) -> WorkerConfig:
+        resp = await self.http_request(f"/workers/{worker_id}/config", "GET", endpoint="/workers/{id}/config")
+        return decode(WorkerConfig, resp.content)
+
+    async def worker_ping(self):
+        await self.http_request("/worker-ping", "POST")
+
+    async def get_image_download_urls(self, image_id: str) -> DownloadUrls:
+        resp = await self.http_request(f"/images/{image_id}/download-urls", "GET", endpoint="/images/{id}/download-urls")
+        return decode(DownloadUrls, resp.content)
+
+    async def get_image_upload_urls(self, image_id: str) -> UploadUrls:
+        resp = await self.http_request(f"/images/{image_id}/upload-urls", "GET", endpoint="/images/{id}/upload-urls")
+        return decode(UploadUrls, resp.content)
+
+    async def get_bugsnag_api_key(self) -> str:
+        resp = await self.http_request("/bugsnag-api-key", "GET")
+        return self.parse_json(resp.text).bugsnag_api_key
+
+
+async def _file_chunks(body: FileBody):
+    # disk reads happen off the event loop
+    while True:
+        chunk = await asyncio.to_thread(body.read)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _stream_to_buffer(resp: aiohttp.ClientResponse, length: int, chunk_size: int, max_bytes: int) -> bytearray:
+    buf = bytearray(length)
+    pos = 0
+    async for chunk in resp.content.iter_chunked(chunk_size):
+        end = pos + len(chunk)
+        if max_bytes and end > max_bytes:
+            raise TransferTooLarge(f"Download exceeds limit of {max_bytes} bytes")
+        if end <= length:
+            buf[pos:end] = chunk
+        else:
+            del buf[pos:]
+            buf += chunk
+            length = end
+        pos = end
+    if pos < length:
+        del buf[pos:]
+    return buf
+
+
+async def _stream_to_file(resp: aiohttp.ClientResponse, dest: str, chunk_size: int, max_bytes: int) -> str:
+    # file io runs on the default executor, like _file_chunks, to keep it off the event loop
+    part = dest + ".part"
+    size = 0
+    try:
+        f = await asyncio.to_thread(open, part, "wb")
+        try:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise TransferTooLarge(f"Download exceeds limit of {max_bytes} bytes")
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, part, dest)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return dest
@@ -0,0 +1,35 @@
+import sys
+import time
+
+from api_client import AIBrushAPI
+from claim_loop import claim_images
+from stub_backend import StubBackend
+
+# Measures how many images per second a worker can claim from a local
+# stand-in backend, one image per round-trip vs batch claims.
+# Usage: python claim_benchmark.py [batch_size] [seconds] [latency_ms]
+
+batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005
+
+backend = StubBackend(latency=latency).start()
+client = AIBrushAPI(backend.url, "stub-token")
+
+
+def run(label: str, claim):
+    backend.add_pending(1000000)
+    claimed = 0
+    calls_before = backend.claim_calls
+    start = time.time()
+    while time.time() - start < duration:
+        claimed += claim()
+    elapsed = time.time() - start
+    calls = backend.claim_calls - calls_before
+    print(f"{label}: {claimed / elapsed:.0f} claims/s ({calls / elapsed:.0f} round-trips/s)")
+
+
+run("single", lambda: 1 if client.process_image(exclude_models=["swinir"]) else 0)
+run(f"batch of {batch_size}", lambda: len(claim_images(client, batch_size, exclude_models=["swinir"])))
+print("connections:", client.get_connection_stats())
+backend.stop()
@@ -0,0 +1,26 @@
+# Batch job claiming. Instead of claiming one image per /process-image call,
+# the poll loop claims as many images as the local pipeline has room for,
+# measured by the free slots in the process queue.
+
+from queue import Queue
+from typing import List
+
+from api_client import AIBrushAPI
+
+
+def free_slots(queue: Queue) -> int:
+    if queue.maxsize <= 0:
+        return 1
+    return max(0, queue.maxsize - queue.qsize())
+
+
+def claim_images(client: AIBrushAPI, capacity: int, *args, **kwargs) -> List:
+    # keep claiming until local capacity is full or the backlog is drained.
+    # Backends that ignore the limit return one image per call, which still works.
+    images = []
+    while len(images) < capacity:
+        batch = client.process_image(*args, limit=capacity - len(images), **kwargs)
+        if not batch:
+            break
+        images.extend(batch)
+    return images
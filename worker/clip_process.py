@@ -1,35 +1,32 @@
-import subprocess
 from types import SimpleNamespace
 import argparse
-import traceback
-import json
 import sys
 import torch
+from io import BytesIO
 
+import ipc
+from fork_server import spawn
 from clip_rank import ClipRanker
 from printutil import eprint
+from shm_handoff import encode_args, decode_args, release
 
 class ClipProcess:
 
     def __init__(self, gpu="cuda:0"):
         print("ClipProcess created")
-        self.process = subprocess.Popen(["python", "clip_process.py", gpu], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # stdout carries ipc frames, the child logs to stderr
+        self.process = spawn("clip_process.py", [gpu])
+        self.channel = ipc.Channel(self.process.stdout, self.process.stdin)
 
     def rank(self, args):
+        # args.image_data, if set, goes through shared memory with args.image as the fallback path
         print("ClipProcess rank called")
-        self.process.stdin.write(json.dumps(args.__dict__).encode())
-        self.process.stdin.write(b"\n")
-        self.process.stdin.flush()
-        print("ClipProcess sent args to child process rank")
-        line = self.process.stdout.readline().decode().strip()
-        print(line)
-        while not line.startswith("RESULT:") and not line == "EXCEPTION":
-            line = self.process.stdout.readline().decode().strip()
-            print(line)
-        if line == "EXCEPTION":
-            raise Exception("Exception in model process")
-        parts = line.split(":")
-        return float(parts[1])
+        encoded, blocks = encode_args(args.__dict__)
+        try:
+            result = ipc.call(self.channel, encoded, "clip")
+        finally:
+            release(blocks)
+        return result["score"]
 
     def __del__(self):
         if self.process:
@@ -38,30 +35,27 @@ class ClipProcess:
             self.process = None
             print("Clip process killed")
 
-def read_or_die():
-    try:
-        return input()
-    except EOFError:
-        sys.exit(0)
-
 def child_process():
     gpu = "cuda:0" if len(sys.argv) == 1 else sys.argv[1]
+    channel = ipc.child_channel()
     torch.cuda.set_device(gpu)
     eprint("clip process running")
     clip_ranker = ClipRanker()
     eprint("clip process created")
-    while True:
-        try:
-            args_json = read_or_die()
-            args = SimpleNamespace(**json.loads(args_json))
-            eprint(f"input received: {args}")
-            rank = clip_ranker.rank(args)
-            print(f"RESULT:{rank}")
-        except Exception as e:
-            eprint(e)
-            traceback.print_exc()
-            print("EXCEPTION")
-            continue
 
-if __name__ == "__main__":
+    def handle(message: dict) -> dict:
+        args = SimpleNamespace(**decode_args(message))
+        if getattr(args, "image_data", None):
+            args.image = BytesIO(args.image_data)
+            del args.image_data
+        eprint(f"input received: {args}")
+        return {"score": float(clip_ranker.rank(args))}
+
+    ipc.serve(channel, handle)
+
+def main():
+    # entry point of the clip process, also called by the fork server
     child_process()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import json
+import sys
+import time
+import tracemalloc
+
+from api_client import parse_json
+from records import decode, Image, DownloadUrls, _loads
+from stub_backend import stub_image
+
+# Compares decoding api responses into SimpleNamespace (object_hook) vs the
+# typed, slotted records, for decode time and memory per object.
+# Usage: python decode_benchmark.py [iterations]
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+image_json = json.dumps(stub_image("4b0f5a6e-8f3a-4a55-9f57-1c1b9a3b2f10")).encode()
+batch_json = json.dumps([stub_image(f"image-{i}") for i in range(8)]).encode()
+urls_json = json.dumps({
+    "image_url": "https://bucket.s3.amazonaws.com/4b0f5a6e.image.png?X-Amz-Signature=" + "a" * 64,
+    "mask_url": "https://bucket.s3.amazonaws.com/4b0f5a6e.mask.png?X-Amz-Signature=" + "b" * 64,
+    "thumbnail_url": "https://bucket.s3.amazonaws.com/4b0f5a6e.thumbnail.png?X-Amz-Signature=" + "c" * 64,
+}).encode()
+
+print("json parser:", _loads.__module__)
+
+
+def bench(label: str, fn):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {elapsed / iterations * 1e6:.1f} us/decode")
+
+
+def memory(label: str, fn, count: int = 5000):
+    tracemalloc.start()
+    objects = [fn() for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {size / count:.0f} bytes/object")
+    return objects
+
+
+for name, payload, record_cls in (
+    ("image", image_json, Image),
+    ("batch of 8 images", batch_json, Image),
+    ("download urls", urls_json, DownloadUrls),
+):
+    bench(f"{name} SimpleNamespace", lambda: parse_json(payload))
+    bench(f"{name} {record_cls.__name__}", lambda: decode(record_cls, payload))
+
+memory("image SimpleNamespace", lambda: parse_json(image_json))
+memory("image Image", lambda: decode(Image, image_json))
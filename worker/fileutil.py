@@ -1,14 +1,86 @@
+import os
+import time
 import requests
 
+# chunk size for streamed transfers, bounds how much of a transfer is held in memory at once
+CHUNK_SIZE = 1024 * 1024
+
+
 # download a large file in python:
-def download_file(url, local_filename):
+# the response is streamed into "<local_filename>.part" and renamed when complete.
+# If the connection drops, the next attempt resumes with a range request from
+# where the partial file left off (also across restarts of the process).
+def download_file(url, local_filename, chunk_size=CHUNK_SIZE, retries=5, session=None):
     print(f"Downloading {url} to {local_filename}")
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                #if chunk: 
-                f.write(chunk)
\ No newline at end of file
+    http = session or requests
+    part_filename = local_filename + ".part"
+    backoff = 2
+    for attempt in range(retries):
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            # NOTE the stream=True parameter below
+            with http.get(url, stream=True, headers=headers, allow_redirects=True, timeout=30) as r:
+                if r.status_code == 416:
+                    # nothing left past the end of the partial file
+                    break
+                r.raise_for_status()
+                # servers that ignore the range header send the whole file again
+                mode = "ab" if r.status_code == 206 else "wb"
+                if offset and mode == "ab":
+                    print(f"Resuming download at {offset} bytes")
+                with open(part_filename, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            break
+        except Exception as err:
+            if attempt == retries - 1:
+                raise
+            print(f"Error downloading {url}: {err}, retrying in {backoff}s")
+            time.sleep(backoff)
+            backoff *= 2
+    os.replace(part_filename, local_filename)
+
+
+class FileBody(object):
+    # request body that streams a file from disk in chunk_size reads, so an
+    # upload never holds more than one chunk of the file in memory.
+    # Content-Length comes from len(), which presigned S3 PUTs require.
+    def __init__(self, path: str, chunk_size: int = CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self._file = None
+
+    def __len__(self):
+        return self.size
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def read(self, size=-1) -> bytes:
+        return self._open().read(self.chunk_size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read()
+            if not chunk:
+                return
+            yield chunk
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # rewinds between retries
+        return self._open().seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._open().tell()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __repr__(self):
+        return "FileBody(%s, %s bytes)" % (self.path, self.size)
@@ -0,0 +1,247 @@
+# Pre-forked launcher for model and clip processes. Starting a model process
+# with Popen runs a fresh interpreter that imports torch, transformers,
+# diffusers and ldm again every time. The fork server imports them once (plus
+# the model modules, with any read-only assets they load at import time) and
+# forks a child per spawn(), which shares those pages copy-on-write.
+# Callers get a Popen-like handle: the child's stdin and stdout are pipes
+# created by the caller, passed to the server over a unix socket with
+# SCM_RIGHTS, and the child runs the model module's main().
+# The server never touches CUDA, children pick their device after the fork.
+# It exits when the worker that started it goes away (its stdin closes).
+# Configurable options (env vars):
+#  FORK_SERVER: set to 0 to spawn every process with Popen instead
+#  FORK_SERVER_PRELOAD: comma separated modules the server imports up front
+
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from threading import Lock
+
+FORK_SERVER = os.environ.get("FORK_SERVER", "1") == "1"
+FORK_SERVER_PRELOAD = os.environ.get(
+    "FORK_SERVER_PRELOAD",
+    "torch,transformers,diffusers,cv2,numpy,PIL.Image,omegaconf,ldm.models.diffusion.ddim,"
+    "sd_text2im_model,sd_inpaint_model,swinir_model,clip_process",
+).split(",")
+
+_lock = Lock()
+_server = None
+
+
+class ForkedProcess(object):
+    # the parts of Popen that ModelProcess and ClipProcess use
+    def __init__(self, conn: socket.socket, status, pid: int, stdin, stdout):
+        self._conn = conn
+        self._status = status
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            ready, _, _ = select.select([self._conn], [], [], 0)
+            if ready:
+                self._read_status()
+        return self.returncode
+
+    def wait(self, timeout: float = None):
+        if self.returncode is None:
+            ready, _, _ = select.select([self._conn], [], [], timeout)
+            if not ready:
+                raise subprocess.TimeoutExpired(f"forked pid {self.pid}", timeout)
+            self._read_status()
+        return self.returncode
+
+    def kill(self):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _read_status(self):
+        # the server reports the exit status once it has reaped the child
+        line = self._status.readline()
+        self.returncode = json.loads(line)["exit"] if line else -signal.SIGKILL
+        self._status.close()
+        self._conn.close()
+
+
+class ForkServer(object):
+    def __init__(self, path: str):
+        self.path = path
+        # the server lives as long as its stdin is open
+        self.process = subprocess.Popen(["python", __file__, path], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        if self.process.stdout.readline().strip() != b"ready":
+            self.process.kill()
+            raise Exception("Fork server failed to start")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def spawn(self, script: str, args: list) -> ForkedProcess:
+        child_stdin, stdin = os.pipe()
+        stdout, child_stdout = os.pipe()
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+            request = {
+                "module": os.path.splitext(os.path.basename(script))[0],
+                "argv": [script] + [str(arg) for arg in args],
+                "cwd": os.getcwd(),
+            }
+            socket.send_fds(conn, [json.dumps(request).encode() + b"\n"], [child_stdin, child_stdout, sys.stderr.fileno()])
+            status = conn.makefile("rb")
+            reply = status.readline()
+            if not reply:
+                raise Exception("Fork server closed the connection")
+        except:
+            conn.close()
+            os.close(stdin)
+            os.close(stdout)
+            raise
+        finally:
+            os.close(child_stdin)
+            os.close(child_stdout)
+        return ForkedProcess(conn, status, json.loads(reply)["pid"], os.fdopen(stdin, "wb"), os.fdopen(stdout, "rb"))
+
+
+def start() -> ForkServer:
+    # the fork server of this worker process, started on first use
+    global _server
+    with _lock:
+        if _server is None or not _server.alive:
+            start = time.time()
+            _server = ForkServer(os.path.join(tempfile.gettempdir(), f"fork-server-{os.getpid()}.sock"))
+            print(f"Fork server ready in {time.time() - start:.1f}s")
+        return _server
+
+
+def spawn(script: str, args: list):
+    # starts `python script *args` with piped stdin and stdout, forked from
+    # the shared fork server when possible
+    if FORK_SERVER:
+        try:
+            return start().spawn(script, args)
+        except Exception as err:
+            print(f"Fork server unavailable, spawning {script} directly: {err}")
+    return subprocess.Popen(["python", script] + [str(arg) for arg in args], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def _preload(modules: list):
+    for name in modules:
+        if not name:
+            continue
+        start = time.time()
+        try:
+            importlib.import_module(name)
+        except Exception as err:
+            print(f"fork server: skipping {name}: {err}", file=sys.stderr)
+            continue
+        print(f"fork server: imported {name} in {time.time() - start:.1f}s", file=sys.stderr)
+
+
+def _run_child(inherited: list, request: dict, fds: list):
+    # in the forked child, never returns. inherited: the server's sockets and fds
+    code = 1
+    try:
+        for item in inherited:
+            if isinstance(item, int):
+                os.close(item)
+            else:
+                item.close()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+        os.chdir(request["cwd"])
+        sys.argv = request["argv"]
+        importlib.import_module(request["module"]).main()
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(path: str):
+    # like the model processes, anything printed while importing goes to stderr
+    out = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    _preload(FORK_SERVER_PRELOAD)
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    # children are reaped here, the connection that spawned one gets its exit status
+    children = {}
+    # exiting children wake up the select below
+    wakeup, wakeup_writer = os.pipe()
+    os.set_blocking(wakeup_writer, False)
+    signal.set_wakeup_fd(wakeup_writer)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    out.write("ready\n")
+    out.close()
+    try:
+        while True:
+            ready, _, _ = select.select([listener, sys.stdin, wakeup], [], [], 5)
+            if wakeup in ready:
+                os.read(wakeup, 1024)
+            if sys.stdin in ready and not os.read(sys.stdin.fileno(), 1024):
+                # the worker exited
+                return
+            if listener in ready:
+                conn, _ = listener.accept()
+                try:
+                    message, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+                    request = json.loads(message)
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        _run_child([listener, conn, wakeup, wakeup_writer] + list(children.values()), request, fds)
+                    for fd in fds:
+                        os.close(fd)
+                    conn.sendall(json.dumps({"pid": pid}).encode() + b"\n")
+                    children[pid] = conn
+                except Exception as err:
+                    print(f"fork server: error spawning: {err}", file=sys.stderr)
+                    conn.close()
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                conn = children.pop(pid, None)
+                if conn is not None:
+                    try:
+                        conn.sendall(json.dumps({"exit": os.waitstatus_to_exitcode(status)}).encode() + b"\n")
+                    except OSError:
+                        pass
+                    conn.close()
+    finally:
+        listener.close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
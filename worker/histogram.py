@@ -0,0 +1,76 @@
+# Fixed-bucket latency histogram. Observations are counted into log-spaced
+# buckets (1ms to ~2 minutes, 4 buckets per doubling) so recording is O(log n)
+# and memory is constant no matter how many values are observed.
+# Percentiles are interpolated within buckets, clamped to the observed min/max.
+
+import bisect
+import math
+from threading import Lock
+from types import SimpleNamespace
+
+BUCKET_BOUNDS = tuple(0.001 * 2 ** (i / 4) for i in range(69))
+
+
+class Histogram(object):
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        # the last bucket catches everything above the largest bound
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.sum += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            return self._percentile(q)
+
+    def _percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.buckets):
+            if n and cumulative + n >= target:
+                # interpolate linearly inside the bucket, clamped to what was observed
+                lower = max(self.min, self.bounds[i - 1] if i > 0 else self.min)
+                upper = min(self.max, self.bounds[i] if i < len(self.bounds) else self.max)
+                return lower + (upper - lower) * max(0.0, target - cumulative) / n
+            cumulative += n
+        return self.max
+
+    def snapshot(self, reset: bool = False) -> SimpleNamespace:
+        with self._lock:
+            s = SimpleNamespace(
+                count=self.count,
+                sum=self.sum,
+                mean=self.sum / self.count if self.count else 0.0,
+                min=self.min if self.count else 0.0,
+                max=self.max if self.count else 0.0,
+                p50=self._percentile(0.5),
+                p90=self._percentile(0.9),
+                p99=self._percentile(0.99),
+                buckets=list(self.buckets),
+            )
+            if reset:
+                self._reset()
+            return s
+
+    def __repr__(self):
+        s = self.snapshot()
+        return "Histogram(count=%s, p50=%.4f, p90=%.4f, p99=%.4f, max=%.4f)" % (s.count, s.p50, s.p90, s.p99, s.max)
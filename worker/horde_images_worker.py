@@ -11,6 +11,17 @@ import requests
 
 import torch
 from api_client import AIBrushAPI
+from claim_loop import claim_images, free_slots
+from metrics_aggregator import MetricsAggregator, METRICS_FLUSH_INTERVAL
+from metrics_buffer import MetricsBuffer
+from metrics_endpoint import metrics_endpoint, pipeline_samples
+from poll_scheduler import PollScheduler
+from prefetch_stage import PrefetchStage, PREFETCH_THREADS
+from records import ImageUpdate
+import tracing
+from update_coalescer import UpdateCoalescer
+from upload_pool import UploadPool, UPLOAD_THREADS
+from workspace import remove_job_dir, start_sweeper
 import base64
 import traceback
 from PIL import Image
@@ -25,14 +36,17 @@ from model_process import ModelProcess
 # from glid_3_xl_model import generate_model_signature
 from memutil import get_free_memory
 from torch import device
-from apisocket import ApiSocket
-import asyncio
+from apisocket import shared_socket
 import bugsnag
 from errorkillswitch import ErrorKillSwitch
 
 NOTIFICATION_PENDING_IMAGE = "pending_image"
 NOTIFICATION_WORKER_CONFIG_UPDATED = "worker_config_updated"
 
+PROCESS_THREADS = 30
+# process, prefetch and upload threads + poll and metrics threads share the client
+HTTP_POOL_MAXSIZE = PROCESS_THREADS + PREFETCH_THREADS + UPLOAD_THREADS + 2
+
 api_url = "https://www.aibrush.art"
 if len(sys.argv) > 1:
     api_url = sys.argv[1]
@@ -41,10 +55,10 @@ if os.path.exists("credentials.json"):
     # load credentials.json
     with open('credentials.json') as f:
         access_token = json.load(f)["accessToken"]
-        client = AIBrushAPI(api_url, access_token)
+        client = AIBrushAPI(api_url, access_token, pool_maxsize=HTTP_POOL_MAXSIZE)
 elif os.environ.get("WORKER_LOGIN_CODE"):
     print("Logging in with login code")
-    client = AIBrushAPI(api_url, None, os.environ["WORKER_LOGIN_CODE"])
+    client = AIBrushAPI(api_url, None, os.environ["WORKER_LOGIN_CODE"], pool_maxsize=HTTP_POOL_MAXSIZE)
 else:
     raise Exception(
         "No credentials.json or WORKER_LOGIN_CODE environment variable found")
@@ -87,28 +101,8 @@ for folder in ["images", "output", "output_npy"]:
 
 
 def cleanup(image_id: str):
-    # delete all files in the current folder ending in .png or .backup
-    for fname in os.listdir("images"):
-        _cleanup_file(image_id, os.path.join("images", fname))
-    for fname in os.listdir("output"):
-        _cleanup_file(image_id, os.path.join("output", fname))
-    for fname in os.listdir("output_npy"):
-        _cleanup_file(image_id, os.path.join("output_npy", fname))
-    if os.path.exists("results"):
-        for fname in os.listdir(os.path.join("results", "swinir_real_sr_x4")):
-            _cleanup_file(image_id, os.path.join(
-                "results", "swinir_real_sr_x4", fname))
-
-
-def _cleanup_file(image_id: str, file_path: str):
-    is_old = time.time() - os.path.getmtime(file_path) > 3600
-    match = image_id in file_path
-    if is_old or match:
-        try:
-            os.remove(file_path)
-        except:
-            # another thread might have deleted it
-            pass
+    # the job's files all live in its own directory, orphans are left to the sweeper
+    remove_job_dir(image_id)
 
 
 def metric(name: str, type: str, value: any, attributes: dict = None) -> SimpleNamespace:
@@ -134,21 +128,26 @@ def add_trigger(prompt: str, model: str) -> str:
     return prompt
 
 
-def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, websocket_queue: Queue):
-    last_model_check = time.time()
-    image = None
+def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, websocket_queue: Queue, prefetch: PrefetchStage, scheduler: PollScheduler):
+    backlog = False
 
     while True:
         try:
-            start = time.time()
+            images = []
+            # images still downloading will take process queue slots too
+            capacity = max(0, free_slots(process_queue) - prefetch.in_flight)
             message = None
             pending_image = False
+            notified_at = None
             config_updated = False
             try:
-                message = websocket_queue.get(timeout=0.1)
+                # sleeps until the next poll is due unless a notification arrives,
+                # but keeps checking for free capacity while there's a backlog
+                message = websocket_queue.get(timeout=0.1 if backlog or not capacity else scheduler.timeout())
             except Empty:
                 pass
             if message:
+                received_at = getattr(message, "received_at", None)
                 message = json.loads(message)
                 if "connected" in message and message["connected"]:
                     print("Connected to websocket")
@@ -157,41 +156,48 @@ def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, we
                     message = SimpleNamespace(**message)
                     if message.type == NOTIFICATION_PENDING_IMAGE:
                         pending_image = True
+                        notified_at = received_at
                         # worker jitter. All workers are notified at once,
                         # so we wait a random amount of time before trying to process
                         # the next image
                         time.sleep(random.random() * 0.5)
                     elif message.type == NOTIFICATION_WORKER_CONFIG_UPDATED:
                         config_updated = True
-            # poll interval has been changed to every 2 seconds because websocket isn't working anymore
-            if config_updated or time.time() - last_model_check > 2:
+            if pending_image or config_updated:
+                scheduler.wake()
+            if scheduler.ping_due():
+                # claims carry the heartbeat, this is a fallback for backends that ignore it
                 client.worker_ping()
-                last_model_check = time.time()
-
-                image = client.process_image(exclude_models=["swinir"])
+                scheduler.pinged()
+            if capacity and (scheduler.due() or backlog):
+                start = time.time()
+                images = claim_images(client, capacity, exclude_models=["swinir"], ping=True)
+                for image in images:
+                    # the job's trace starts with the claim
+                    image.trace_id = tracing.start_trace(metrics_queue, image.model, start)
+                    tracing.record("claim", image.trace_id, start, time.time())
+                scheduler.polled(len(images))
                 metrics_queue.put(metric("worker.poll", "count", 1, {
                     "duration_seconds": time.time() - start,
+                    "claimed": len(images),
+                    "interval_seconds": scheduler.interval,
                 }))
-            elif image or pending_image:
-                image = client.process_image(exclude_models=["swinir"])
-                metrics_queue.put(metric("worker.poll", "count", 1, {
-                    "duration_seconds": time.time() - start,
-                }))
-            if image:
-                image.thumbnail_data = None
-                if not image.warmup:
-                    image_download_urls = client.get_image_download_urls(
-                        image.id)
-                    image.image_data = client.get_image_data(
-                        image.id, image_download_urls.image_url)
-                    image.mask_data = None
-                    if image.model == "stable_diffusion_inpainting":
-                        image.mask_data = client.get_mask_data(
-                            image.id, image_download_urls.mask_url)
-                process_queue.put(image)
+                if notified_at:
+                    metrics_queue.put(metric("worker.notification", "count", 1, {
+                        "claim_latency_seconds": time.time() - notified_at,
+                        "claimed": len(images),
+                    }))
+            if capacity:
+                # a claim that filled our capacity means more work is likely waiting
+                backlog = len(images) == capacity
+            for image in images:
                 if image.warmup:
+                    image.thumbnail_data = None
+                    process_queue.put(image)
                     ready_queue.get()
-                image = None
+                else:
+                    # downloads happen off the poll thread
+                    prefetch.submit(image)
         except Exception as err:
             handle_error(err, "poll_loop")
 
@@ -333,6 +339,7 @@ def process_image(image):
 
 def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue, metrics_queue: Queue):
     print("process loop started")
+    image = None
 
     while True:
         try:
@@ -340,6 +347,12 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
             if not image:
                 return
             start = time.time()
+            tracing.record("process_queue_wait", image.trace_id, image.queued_at, start)
+
+            # fetch upload urls while the image generates
+            upload_urls = None
+            if not image.warmup:
+                upload_urls = client.prefetch_image_upload_urls(image.id)
 
             def update_image(iterations: int, status: str, image_data: bytes = None):
                 if image.warmup:
@@ -351,20 +364,19 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
                 npy_data = None
 
                 if image_data:
-                    # use PIL to resize image
-                    thumbnail = Image.open(BytesIO(image_data))
-                    # resize image
-                    thumbnail = thumbnail.resize((128, 128), Image.ANTIALIAS)
-                    # thumbnail = Image.lo(image_data).resize((128, 128), Image.ANTIALIAS)
-                    buf = BytesIO()
-                    thumbnail.save(buf, format="png")
-                    thumbnail_data = base64.b64encode(
-                        buf.getvalue()).decode("utf-8")
-                    # base64 encode image
-                    image_data = base64.encodebytes(image_data).decode("utf-8")
+                    with tracing.span("thumbnail", image.trace_id):
+                        # use PIL to resize image
+                        thumbnail = Image.open(BytesIO(image_data))
+                        # resize image
+                        thumbnail = thumbnail.resize((128, 128), Image.ANTIALIAS)
+                        # thumbnail = Image.lo(image_data).resize((128, 128), Image.ANTIALIAS)
+                        buf = BytesIO()
+                        thumbnail.save(buf, format="png")
+                        # raw png bytes all the way to the upload, getvalue() doesn't copy
+                        thumbnail_data = buf.getvalue()
                 # update image
                 # client.update_image(image.id, image_data, npy_data, iterations, status, score, negative_score, nsfw)
-                update_queue.put(SimpleNamespace(
+                update_queue.put(ImageUpdate(
                     id=image.id,
                     image_data=image_data,
                     thumbnail_data=thumbnail_data,
@@ -374,11 +386,15 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
                     score=score,
                     negative_score=negative_score,
                     nsfw=image.nsfw,
+                    upload_urls=upload_urls,
+                    trace_id=image.trace_id,
                 ))
 
             update_image(0, "processing")
 
-            updated_image = process_image(image)
+            # submitting to the horde and waiting for the result
+            with tracing.span("generate", image.trace_id):
+                updated_image = process_image(image)
             if not updated_image:
                 update_image(image.iterations, "error")
                 continue
@@ -391,28 +407,21 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
             if image.warmup:
                 ready_queue.put(True)
         except Exception as e:
+            tracing.end_trace(image.trace_id if image else None, status="error")
             handle_error(e, "process_loop")
             continue
 
 
-def update_loop(update_queue: Queue, cleanup_queue: Queue, metrics_queue: Queue):
-    while True:
-        try:
-            image = update_queue.get()
-            if not image:
-                return
-            start = time.time()
-            client.update_image(image.id, image.image_data, image.thumbnail_data,
-                                image.iterations, image.status, image.score, image.negative_score, image.nsfw)
-            metrics_queue.put(metric("worker.update", "count", 1, {
-                "duration_seconds": time.time() - start
-            }))
-            # cleanup_queue.put(image.id)
-            if image.status == "completed":
-                cleanup_queue.put(image.id)
-        except Exception as e:
-            handle_error(e, "update_loop")
-            continue
+def send_update(image, cleanup_queue: Queue):
+    # runs on an UploadPool thread, updates for the same image arrive in order
+    client.update_image_data(image.id, image.image_data, image.thumbnail_data,
+                             image.iterations, image.status, image.score, image.negative_score, image.nsfw,
+                             upload_urls=image.upload_urls, image_path=image.image_path)
+    if image.status in ("completed", "error"):
+        # after its last upload
+        tracing.end_trace(image.trace_id, status=image.status)
+    if image.status == "completed":
+        cleanup_queue.put(image.id)
 
 
 def cleanup_loop(cleanup_queue: Queue):
@@ -427,65 +436,83 @@ def cleanup_loop(cleanup_queue: Queue):
             continue
 
 
-def metrics_loop(metrics_queue: Queue):
-    # Collect metrics and send to server every 10 seconds
-    last_send = time.time()
-    collected_metrics = []
-    while True:
+def flush_metrics(aggregator: MetricsAggregator, metrics_queue: MetricsBuffer, scheduler: PollScheduler):
+    collected_metrics = aggregator.flush()
+    # idle requests per second since the last flush
+    collected_metrics.append(scheduler.metric())
+    collected_metrics.extend(client.connection_metrics())
+    collected_metrics.extend(client.request_metrics())
+    dropped = metrics_queue.take_dropped()
+    if dropped:
+        collected_metrics.append(metric("worker.metrics.dropped", "count", dropped))
+    client.add_metrics(collected_metrics)
+
+
+def metrics_loop(metrics_queue: MetricsBuffer, scheduler: PollScheduler):
+    # Aggregate metrics locally and send them to the server every 10 seconds,
+    # producers never wait on this thread
+    aggregator = MetricsAggregator()
+    closed = False
+    while not closed:
         try:
-            metrics = metrics_queue.get()
-            if not metrics:
-                return
-            collected_metrics.append(metrics)
-            if time.time() - last_send > 10:
-                client.add_metrics(collected_metrics)
-                collected_metrics = []
-                last_send = time.time()
+            closed = metrics_queue.wait(METRICS_FLUSH_INTERVAL)
+            for metrics in metrics_queue.drain():
+                aggregator.add(metrics)
+            flush_metrics(aggregator, metrics_queue, scheduler)
         except Exception as e:
             handle_error(e, "metrics_loop")
             continue
 
 
-PROCESS_THREADS = 30
-
-
 class ImagesWorker:
     def __init__(self):
         # create queues
         self.websocket_queue = Queue(maxsize=1)
         self.process_queue = Queue(maxsize=4)
-        self.update_queue = Queue(maxsize=4)
         self.cleanup_queue = Queue(maxsize=4)
-        self.metrics_queue = Queue(maxsize=4)
+        # non-blocking, metrics are dropped rather than stalling the pipeline
+        self.metrics_queue = MetricsBuffer()
+        # updates are uploaded in parallel, in order per image
+        self.upload_pool = UploadPool(
+            lambda image: send_update(image, self.cleanup_queue), self.metrics_queue, handle_error)
+        # "processing" updates are held back briefly, and dropped for jobs that finish first
+        self.update_queue = UpdateCoalescer(self.upload_pool, self.metrics_queue)
         self.ready_queue = Queue(maxsize=1)
 
         # start threads
-        self.apisocket = ApiSocket(api_url, client.token, self.websocket_queue)
-        # self.websocket_thread = Thread(target=self.apisocket.run)
-        self.websocket_thread = Thread(
-            target=asyncio.run, args=(self.apisocket.run(),))
+        # one socket per process, notifications are fanned out to every worker
+        self.apisocket = shared_socket(api_url, client.token)
+        self.apisocket.register(self.websocket_queue)
+        self.prefetch = PrefetchStage(
+            client, self.process_queue, self.metrics_queue, handle_error)
+        # shared by the poll loop and the metrics flush
+        self.scheduler = PollScheduler()
         self.poll_thread = Thread(target=poll_loop, args=(
-            self.ready_queue, self.process_queue, self.metrics_queue, self.websocket_queue))
+            self.ready_queue, self.process_queue, self.metrics_queue, self.websocket_queue, self.prefetch, self.scheduler))
         # self.process_thread = Thread(target=process_loop, args=(
         #     self.ready_queue, self.process_queue, self.update_queue, self.metrics_queue))
         self.process_threads = []
         for i in range(PROCESS_THREADS):
             self.process_threads.append(Thread(target=process_loop, args=(
                 self.ready_queue, self.process_queue, self.update_queue, self.metrics_queue)))
-        self.update_thread = Thread(target=update_loop, args=(
-            self.update_queue, self.cleanup_queue, self.metrics_queue))
         self.cleanup_thread = Thread(
             target=cleanup_loop, args=(self.cleanup_queue,))
         self.metrics_thread = Thread(
-            target=metrics_loop, args=(self.metrics_queue,))
+            target=metrics_loop, args=(self.metrics_queue, self.scheduler))
+        # live /metrics for scraping
+        self.metrics_endpoint = metrics_endpoint()
+        self.metrics_endpoint.register(self.collect_metrics)
 
     def start(self):
         # start threads
-        self.websocket_thread.start()
+        self.apisocket.start()
         self.poll_thread.start()
-        self.update_thread.start()
+        self.upload_pool.start()
+        self.update_queue.start()
         self.cleanup_thread.start()
+        start_sweeper()
         self.metrics_thread.start()
+        self.metrics_endpoint.start()
         # self.process_thread.start()
         for process_thread in self.process_threads:
             process_thread.start()
@@ -494,14 +521,21 @@ class ImagesWorker:
         # self.process_thread.join()
         for process_thread in self.process_threads:
             process_thread.join()
-        self.websocket_thread.join()
+        self.apisocket.join()
         self.poll_thread.join()
-        self.update_thread.join()
+        self.update_queue.join()
+        self.upload_pool.join()
         self.cleanup_thread.join()
         self.metrics_thread.join()
 
+    def collect_metrics(self) -> list:
+        # called on the metrics endpoint's thread when scraped
+        return pipeline_samples(self)
+
     def kill(self):
-        self.apisocket.kill()
+        self.metrics_endpoint.unregister(self.collect_metrics)
+        self.apisocket.unregister(self.websocket_queue)
+        self.prefetch.shutdown()
         self.websocket_queue.put(None)
         # self.process_queue.put(None)
         for i in range(PROCESS_THREADS):
@@ -0,0 +1,115 @@
+# Connection pooling for the AIBrush API client.
+# A single requests.Session is shared by every thread in a worker. The session
+# is configured once and never mutated afterwards, and the urllib3 pools behind
+# the adapter are thread-safe, so sharing it is safe. Connections are kept alive
+# and reused per host (backend, S3), up to pool_maxsize connections per host.
+# Configurable options:
+#  pool_connections: how many per-host pools to keep around
+#  pool_maxsize: how many connections to keep alive per host
+#  pool_block: wait for a free connection instead of opening a throwaway one
+
+from threading import Lock
+from types import SimpleNamespace
+from typing import List
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+DEFAULT_POOL_CONNECTIONS = 8
+DEFAULT_POOL_MAXSIZE = 32
+
+
+class ConnectionStats(object):
+    def __init__(self):
+        self._lock = Lock()
+        self.opened = 0
+        self.reused = 0
+        self.requests = 0
+
+    def connection_opened(self):
+        with self._lock:
+            self.opened += 1
+
+    def connection_reused(self):
+        with self._lock:
+            self.reused += 1
+
+    def request_sent(self):
+        with self._lock:
+            self.requests += 1
+
+    def snapshot(self, reset: bool = False) -> SimpleNamespace:
+        # cumulative counts, or the counts since the last reset
+        with self._lock:
+            snapshot = SimpleNamespace(opened=self.opened, reused=self.reused, requests=self.requests)
+            if reset:
+                self.opened = self.reused = self.requests = 0
+            return snapshot
+
+    def to_metrics(self) -> List[SimpleNamespace]:
+        # the counts since the last call, shaped for AIBrushAPI.add_metrics
+        s = self.snapshot(reset=True)
+        return [
+            SimpleNamespace(name="worker.http.connections_opened", type="count", value=s.opened, attributes=[]),
+            SimpleNamespace(name="worker.http.connections_reused", type="count", value=s.reused, attributes=[]),
+        ]
+
+    def __repr__(self):
+        s = self.snapshot()
+        return "ConnectionStats(opened=%s, reused=%s, requests=%s)" % (s.opened, s.reused, s.requests)
+
+
+def _counting_pool_class(base, stats: ConnectionStats):
+    # count real socket connects, including reconnects of dropped keep-alive connections
+    class CountingConnection(base.ConnectionCls):
+        def connect(self):
+            stats.connection_opened()
+            return super().connect()
+
+    class CountingConnectionPool(base):
+        ConnectionCls = CountingConnection
+
+        def _get_conn(self, timeout=None):
+            # a pooled connection that still has its socket is reused, a new or
+            # dropped one connects (and is counted) when the request is sent
+            conn = super()._get_conn(timeout)
+            if conn.sock is not None:
+                stats.connection_reused()
+            return conn
+    return CountingConnectionPool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool_class(HTTPConnectionPool, self.stats),
+            "https": _counting_pool_class(HTTPSConnectionPool, self.stats),
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.request_sent()
+        return super().send(request, **kwargs)
+
+
+def create_session(
+    stats: ConnectionStats,
+    pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    pool_block: bool = True,
+) -> requests.Session:
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(
+        stats,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
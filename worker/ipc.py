@@ -0,0 +1,193 @@
+# Framed protocol between the worker and its model / clip subprocesses.
+# Each frame is a fixed header (payload length, request id, kind) followed by
+# the payload: a json object with any bytes values split out and appended
+# raw, so results can carry output buffers without base64.
+# The child talks over its original stdout and points fd 1 at stderr, so
+# anything it or its libraries print is logged instead of corrupting frames.
+# Replies carry the request id, so the parent can keep several requests in
+# flight, and errors come back as ERROR frames with the child's traceback.
+
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+import traceback
+from concurrent.futures import Future, wait
+from queue import Queue
+from threading import Lock, Thread
+
+FRAME = struct.Struct("!IIB")  # payload length, request id, kind
+JSON_LENGTH = struct.Struct("!I")
+
+REQUEST = 1
+RESULT = 2
+ERROR = 3
+
+BLOBS_KEY = "__blobs__"
+
+
+def encode(message: dict) -> list:
+    fields = {}
+    blobs = []
+    for key, value in message.items():
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            blobs.append((key, value))
+        else:
+            fields[key] = value
+    if blobs:
+        fields[BLOBS_KEY] = [[key, len(value)] for key, value in blobs]
+    head = json.dumps(fields).encode()
+    return [JSON_LENGTH.pack(len(head)), head] + [value for _, value in blobs]
+
+
+def decode(payload: bytes) -> dict:
+    view = memoryview(payload)
+    (head_length,) = JSON_LENGTH.unpack_from(view)
+    offset = JSON_LENGTH.size + head_length
+    message = json.loads(bytes(view[JSON_LENGTH.size:offset]))
+    for key, length in message.pop(BLOBS_KEY, []):
+        message[key] = bytes(view[offset:offset + length])
+        offset += length
+    return message
+
+
+def _read_exactly(f, n: int):
+    chunks = []
+    while n:
+        chunk = f.read(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+
+class Channel(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._write_lock = Lock()
+        self._ids = itertools.count(1)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def send(self, request_id: int, kind: int, message: dict):
+        parts = encode(message)
+        header = FRAME.pack(sum(len(p) for p in parts), request_id, kind)
+        with self._write_lock:
+            self.writer.write(header)
+            for part in parts:
+                self.writer.write(part)
+            self.writer.flush()
+
+    def receive(self):
+        # (request id, kind, message), or None once the other side is gone
+        header = _read_exactly(self.reader, FRAME.size)
+        if header is None:
+            return None
+        length, request_id, kind = FRAME.unpack(header)
+        payload = _read_exactly(self.reader, length)
+        if payload is None:
+            return None
+        return request_id, kind, decode(payload)
+
+
+def call(channel: Channel, message: dict, name: str = "model") -> dict:
+    # one request, waits for its reply
+    request_id = channel.next_id()
+    channel.send(request_id, REQUEST, message)
+    while True:
+        frame = channel.receive()
+        if frame is None:
+            raise Exception(f"{name} process exited")
+        reply_id, kind, result = frame
+        if reply_id != request_id:
+            print(f"Ignoring stale reply {reply_id} from {name} process")
+            continue
+        if kind == ERROR:
+            raise Exception(f"Exception in {name} process: {result.get('error')}")
+        return result
+
+
+def child_channel() -> Channel:
+    # frames go over a copy of the original stdout, fd 1 becomes stderr
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    return Channel(sys.stdin.buffer, out)
+
+
+def serve(channel: Channel, handler, prepare=None, depth: int = 1):
+    # child loop: handler(prepare(message)) -> result dict, until the parent closes stdin.
+    # A reader thread receives and prepares up to `depth` requests ahead of the handler.
+    # The handler can also return a Future of the result dict: the next request is
+    # handled right away and the reply goes out once the future is done.
+    requests = Queue(maxsize=depth)
+    # done once the deferred reply has been sent
+    deferred = set()
+
+    def reply(request_id: int, received_at: float, start: float, cpu_start: float, result: dict = None, error: BaseException = None):
+        try:
+            if error:
+                raise error
+            result["queued_seconds"] = start - received_at
+            result["duration_seconds"] = time.time() - start
+            # process wide, so deferred results include whatever ran in the meantime
+            result["cpu_seconds"] = time.process_time() - cpu_start
+            channel.send(request_id, RESULT, result)
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                channel.send(request_id, ERROR, {"error": str(e) or type(e).__name__, "traceback": traceback.format_exc()})
+            except Exception as err:
+                print(f"Error replying to request {request_id}: {err}")
+
+    def reply_deferred(future: Future, sent: Future, *timing):
+        if future.exception():
+            reply(*timing, error=future.exception())
+        else:
+            reply(*timing, result=future.result())
+        deferred.discard(sent)
+        sent.set_result(None)
+
+    def read():
+        while True:
+            frame = channel.receive()
+            if frame is None:
+                requests.put(None)
+                return
+            request_id, _, message = frame
+            received_at = time.time()
+            try:
+                if prepare:
+                    message = prepare(message)
+                requests.put((request_id, received_at, message, None))
+            except Exception as e:
+                requests.put((request_id, received_at, None, e))
+
+    Thread(target=read, name="ipc-reader", daemon=True).start()
+    while True:
+        request = requests.get()
+        if request is None:
+            # the parent is gone or done, finish the replies still owed first
+            wait(list(deferred))
+            return
+        request_id, received_at, message, error = request
+        timing = (request_id, received_at, time.time(), time.process_time())
+        try:
+            if error:
+                raise error
+            result = handler(message)
+        except Exception as e:
+            reply(*timing, error=e)
+            continue
+        if isinstance(result, Future):
+            sent = Future()
+            deferred.add(sent)
+            result.add_done_callback(lambda future, sent=sent, timing=timing: reply_deferred(future, sent, *timing))
+        else:
+            reply(*timing, result=result)
@@ -0,0 +1,61 @@
+import sys
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from model_process import ModelProcess
+
+# Round-trip latency of the model process ipc, against the stub model on cpu:
+# empty requests, then requests carrying an input image that comes back as
+# the output (through shared memory both ways), one at a time and pipelined
+# with MODEL_PIPELINE_DEPTH requests in flight.
+# Usage: python ipc_benchmark.py [iterations] [payload_kb]
+# Set STUB_MODEL_DELAY to simulate inference time, which pipelining overlaps.
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+payload_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+
+model = ModelProcess("stub_model.py", "cpu")
+
+
+def bench(label: str, make_args):
+    model.run(make_args())  # warmup, loads the model
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        model.run(make_args())
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    # exact percentiles, the latency histogram's buckets start at 1ms
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{label}: {iterations / elapsed:.0f} round-trips/s, p50 {p50 * 1e6:.0f} us, p99 {p99 * 1e6:.0f} us")
+
+
+def bench_pipelined(label: str, make_args):
+    model.run(make_args())
+    in_flight = deque()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        # submit blocks once the pipeline is full, collect in order
+        in_flight.append(model.submit(make_args()))
+        while in_flight and in_flight[0].done():
+            in_flight.popleft().result()
+    for future in in_flight:
+        future.result()
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {iterations / elapsed:.0f} round-trips/s")
+
+
+payload = bytes(range(256)) * (payload_kb * 4)
+
+bench("empty", lambda: SimpleNamespace(prompt="a cat"))
+bench(f"{payload_kb}KB in + out", lambda: SimpleNamespace(
+    prompt="a cat", image="unused.png", image_data=payload, output_image="unused.png", output_shm=True))
+bench_pipelined(f"{payload_kb}KB in + out, pipelined (depth {model.depth})", lambda: SimpleNamespace(
+    prompt="a cat", image="unused.png", image_data=payload, output_image="unused.png", output_shm=True))
+
+result = model.run(SimpleNamespace(image="unused.png", image_data=payload, output_image="unused.png", output_shm=True))
+assert result.output_data == payload
@@ -1,9 +1,12 @@
-from typing import Tuple
+import os
 import torch
 
-def get_free_memory() -> Tuple[int, int]:
-    free, total = torch.cuda.mem_get_info()
-    print(f"Free memory: {free}")
-    print(f"Total memory: {total}")
-
+def get_free_memory(device=None) -> int:
+    # called on every model cache lookup and metrics scrape, so it doesn't log
+    if device is not None and not str(device).startswith("cuda"):
+        return get_free_host_memory()
+    free, _ = torch.cuda.mem_get_info(device)
     return free
+
+def get_free_host_memory() -> int:
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
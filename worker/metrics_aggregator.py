@@ -0,0 +1,102 @@
+# Client-side metric aggregation. Raw metrics from the worker threads are
+# folded into one series per name + dimension attributes between flushes,
+# so each add_metrics payload has at most one entry per series no matter how
+# many jobs ran.
+#  - string and bool attributes (model, status, endpoint...) are dimensions
+#  - numeric attributes ending in "_seconds" are observed into a latency
+#    histogram and flushed as mean, p50, p90, p99 and max
+#  - other numeric attributes (claimed, busy_uploaders...) are averaged
+#  - "count" values are summed, "gauge" values keep the latest value
+# Configurable options:
+#  METRICS_FLUSH_INTERVAL: seconds between add_metrics calls
+#  max_series: series past this many are folded into one overflow series
+#  per metric name, so the payload size stays bounded
+
+from threading import Lock
+from types import SimpleNamespace
+from typing import List
+
+from histogram import Histogram
+
+MAX_SERIES = 256
+METRICS_FLUSH_INTERVAL = 10
+
+
+class MetricSeries(object):
+    def __init__(self, name: str, type: str, dimensions: tuple):
+        self.name = name
+        self.type = type
+        self.dimensions = dimensions
+        self.value = 0
+        self.sums = {}
+        self.histograms = {}
+
+    def add(self, value, measurements: list):
+        if self.type == "gauge":
+            self.value = value
+        else:
+            self.value += value
+        for key, v in measurements:
+            if key.endswith("_seconds"):
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(v)
+            else:
+                total, n = self.sums.get(key, (0, 0))
+                self.sums[key] = (total + v, n + 1)
+
+    def to_metric(self) -> SimpleNamespace:
+        attributes = [{"name": key, "value": v} for key, v in self.dimensions]
+        for key, (total, n) in self.sums.items():
+            attributes.append({"name": key, "value": total / n})
+        for key, histogram in self.histograms.items():
+            s = histogram.snapshot()
+            attributes.append({"name": key, "value": s.mean})
+            attributes.append({"name": f"{key}_p50", "value": s.p50})
+            attributes.append({"name": f"{key}_p90", "value": s.p90})
+            attributes.append({"name": f"{key}_p99", "value": s.p99})
+            attributes.append({"name": f"{key}_max", "value": s.max})
+        return SimpleNamespace(name=self.name, type=self.type, value=self.value, attributes=attributes)
+
+
+class MetricsAggregator(object):
+    def __init__(self, max_series: int = MAX_SERIES):
+        self.max_series = max_series
+        self._lock = Lock()
+        self._series = {}
+        # metrics folded into overflow series since the last flush
+        self.overflowed = 0
+
+    def add(self, metric: SimpleNamespace):
+        dimensions = []
+        measurements = []
+        for attribute in metric.attributes or []:
+            key, v = attribute["name"], attribute["value"]
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                measurements.append((key, v))
+            else:
+                dimensions.append((key, v))
+        dimensions = tuple(sorted(dimensions, key=lambda d: d[0]))
+        key = (metric.name, metric.type, dimensions)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                if len(self._series) >= self.max_series:
+                    self.overflowed += 1
+                    dimensions = (("overflow", True),)
+                    key = (metric.name, metric.type, dimensions)
+                    series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = MetricSeries(metric.name, metric.type, dimensions)
+            series.add(metric.value, measurements)
+
+    def flush(self) -> List[SimpleNamespace]:
+        with self._lock:
+            series, self._series = self._series, {}
+            self.overflowed = 0
+        return [s.to_metric() for s in series.values()]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._series)
@@ -0,0 +1,53 @@
+# Non-blocking metrics emission. Replaces the bounded metrics Queue, whose
+# put() blocked poll, process and upload threads whenever the metrics thread
+# was busy in add_metrics. put() here is a single deque append: when the
+# buffer is full the oldest metric is dropped and counted instead.
+# The metrics thread drains the whole buffer once per flush.
+# put(None) closes the buffer, like the queue it replaces.
+# Configurable options:
+#  maxlen: how many metrics to hold between flushes
+
+from collections import deque
+from threading import Event
+from typing import List
+
+METRICS_BUFFER_SIZE = 10000
+
+
+class MetricsBuffer(object):
+    def __init__(self, maxlen: int = METRICS_BUFFER_SIZE):
+        self.maxlen = maxlen
+        self._items = deque(maxlen=maxlen)
+        self._closed = Event()
+        # approximate under contention, it's only read for reporting
+        self._dropped = 0
+
+    def put(self, metric, *args, **kwargs):
+        # never blocks, extra args are accepted (and ignored) for Queue compatibility
+        if metric is None:
+            self._closed.set()
+            return
+        if len(self._items) >= self.maxlen:
+            self._dropped += 1
+        self._items.append(metric)
+
+    def wait(self, timeout: float) -> bool:
+        # sleeps until the next flush is due, returns True once closed
+        return self._closed.wait(timeout)
+
+    def drain(self) -> List:
+        items = []
+        popleft = self._items.popleft
+        try:
+            while True:
+                items.append(popleft())
+        except IndexError:
+            pass
+        return items
+
+    def take_dropped(self) -> int:
+        dropped, self._dropped = self._dropped, 0
+        return dropped
+
+    def qsize(self) -> int:
+        return len(self._items)
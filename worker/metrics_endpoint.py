@@ -0,0 +1,188 @@
+# Local metrics endpoint in the Prometheus text format, for live scraping
+# next to the batched add_metrics calls. One http server per process serves
+# GET /metrics from a background thread; the ImagesWorker of each worker
+# (images, upscale, horde) registers a collector that reads its queue depths,
+# in-flight jobs and, with a gpu, model processes and free memory when
+# scraped, so nothing is computed on the job path.
+# Per-stage latency histograms are fed by the tracing spans and are
+# cumulative since startup, as Prometheus expects.
+# The endpoint is off unless METRICS_PORT is set. Pick a free port on the
+# host, 9100 (node_exporter) is usually taken on GPU machines.
+# Configurable options (env vars):
+#  METRICS_PORT: port to serve /metrics on, 0 (the default) to disable
+#  METRICS_HOST: interface to listen on
+
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from types import SimpleNamespace
+from typing import List
+
+import tracing
+from histogram import Histogram
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+# every 4th histogram bound, one bucket per doubling from 1ms
+EXPORTED_BUCKETS = 4
+
+
+def sample(name: str, value: float, type: str = "gauge", **labels) -> SimpleNamespace:
+    # value can be a Histogram snapshot, exported as _bucket, _sum and _count
+    return SimpleNamespace(name=name, type=type, value=value, labels=labels)
+
+
+def pipeline_samples(worker, **labels) -> List[SimpleNamespace]:
+    # queue depths and jobs in flight of the stages every ImagesWorker has
+    return [
+        sample("worker_queue_depth", worker.process_queue.qsize(), queue="process", **labels),
+        sample("worker_queue_depth", worker.update_queue.qsize(), queue="update", **labels),
+        sample("worker_queue_depth", worker.upload_pool.qsize(), queue="upload", **labels),
+        sample("worker_queue_depth", worker.cleanup_queue.qsize(), queue="cleanup", **labels),
+        sample("worker_jobs_in_flight", worker.prefetch.in_flight, stage="download", **labels),
+        sample("worker_jobs_in_flight", worker.upload_pool.busy, stage="upload", **labels),
+    ]
+
+
+class StageLatency(object):
+    # tracing span durations per stage and model
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+
+    def observe(self, stage: str, model: str, seconds: float):
+        key = (stage, model)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(seconds)
+
+    def collect(self) -> List[SimpleNamespace]:
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return [
+            sample("worker_stage_duration_seconds", histogram.snapshot(), "histogram", stage=stage, model=model)
+            for (stage, model), histogram in histograms
+        ]
+
+
+class MetricsEndpoint(object):
+    def __init__(self, port: int = METRICS_PORT, host: str = METRICS_HOST):
+        self.port = port
+        self.host = host
+        self._lock = Lock()
+        self._collectors = []
+        self._server = None
+        self.stages = StageLatency()
+        self.register(self.stages.collect)
+        tracing.add_observer(self.stages.observe)
+
+    def register(self, collector: callable):
+        # collector() -> list of sample(), called on every scrape
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister(self, collector: callable):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def start(self):
+        with self._lock:
+            if self._server is not None or not self.port:
+                return
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), _handler(self))
+            except OSError as err:
+                print(f"Metrics endpoint disabled, can't listen on {self.host}:{self.port}: {err}")
+                self.port = 0
+                return
+            self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, name="metrics-endpoint", daemon=True).start()
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def render(self) -> str:
+        with self._lock:
+            collectors = list(self._collectors)
+        samples = []
+        for collector in collectors:
+            try:
+                samples.extend(collector())
+            except Exception as err:
+                print(f"Error collecting metrics: {err}")
+        # samples of a metric have to be grouped under one TYPE line
+        by_name = {}
+        for s in samples:
+            by_name.setdefault(s.name, []).append(s)
+        lines = []
+        for name, group in by_name.items():
+            lines.append(f"# TYPE {name} {group[0].type}")
+            for s in group:
+                if s.type == "histogram":
+                    lines.extend(_histogram_lines(name, s.value, s.labels))
+                else:
+                    lines.append(f"{name}{_labels(s.labels)} {_number(s.value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _handler(endpoint: MetricsEndpoint):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = endpoint.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes aren't worth a log line each
+            pass
+
+    return Handler
+
+
+def _histogram_lines(name: str, snapshot: SimpleNamespace, labels: dict) -> List[str]:
+    lines = []
+    cumulative = 0
+    bounds = Histogram().bounds
+    for i, count in enumerate(snapshot.buckets[:-1]):
+        cumulative += count
+        if i % EXPORTED_BUCKETS == 0:
+            lines.append(f"{name}_bucket{_labels(labels, le=f'{bounds[i]:.6g}')} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {snapshot.count}")
+    lines.append(f"{name}_sum{_labels(labels)} {_number(snapshot.sum)}")
+    lines.append(f"{name}_count{_labels(labels)} {snapshot.count}")
+    return lines
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{key}="{v}"' for key, v in zip(labels, escaped)) + "}"
+
+
+def _number(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return f"{value:.6g}" if isinstance(value, float) else str(value)
+
+
+_endpoint = None
+_endpoint_lock = Lock()
+
+
+def metrics_endpoint() -> MetricsEndpoint:
+    # the process-wide endpoint, shared by the workers of every gpu
+    global _endpoint
+    with _endpoint_lock:
+        if _endpoint is None:
+            _endpoint = MetricsEndpoint()
+        return _endpoint
@@ -0,0 +1,226 @@
+# Keeps several warm model processes per gpu, so alternating between models
+# doesn't pay a cold start (process spawn + weights load) on every switch.
+# Models are kept in least recently used order. Before a model is loaded,
+# the least recently used ones are evicted until its footprint fits: either
+# the free memory measured after its last load or, the first time, an
+# estimate. Evicted processes finish their queued requests before exiting,
+# and are closed outside the cache's lock, so lookups of other models don't
+# wait for them.
+# preload() loads a model on a background thread while the current one keeps
+# serving; it never evicts the most recently used model, so it gives up when
+# both don't fit.
+# Configurable options:
+#  MODEL_CACHE_SIZE: most model processes kept warm per gpu
+#  MODEL_MEMORY_RESERVE: bytes of memory to leave free for inference
+# Emits "worker.model_cache" per lookup (model, hit), "worker.model.cold_start"
+# with the load time, process spawn time and measured footprint,
+# "worker.model.switch" with how long the switch stalled the process loop,
+# and "worker.model.evicted".
+
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Queue
+from threading import Lock, Thread
+from types import SimpleNamespace
+
+from histogram import Histogram
+
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", "3"))
+MODEL_MEMORY_RESERVE = int(os.environ.get("MODEL_MEMORY_RESERVE", str(2 * 1024 ** 3)))
+
+# footprints until a load has been measured
+MODEL_MEMORY_ESTIMATES = {
+    "stable_diffusion": 5 * 1024 ** 3,
+    "stable_diffusion_inpainting": 5 * 1024 ** 3,
+    "swinir": 2 * 1024 ** 3,
+}
+DEFAULT_MODEL_MEMORY = 4 * 1024 ** 3
+
+
+class ModelCache(object):
+    def __init__(self, create_model: callable, free_memory: callable, metrics_queue: Queue, max_models: int = MODEL_CACHE_SIZE, reserve: int = MODEL_MEMORY_RESERVE):
+        self.create_model = create_model
+        self.free_memory = free_memory
+        self.metrics_queue = metrics_queue
+        self.max_models = max_models
+        self.reserve = reserve
+        self.footprints = dict(MODEL_MEMORY_ESTIMATES)
+        self._lock = Lock()
+        # model name -> ModelProcess, least recently used first
+        self._models = OrderedDict()
+        # model name -> Future of the ModelProcess being loaded
+        self._loading = {}
+        # the model the last get() returned
+        self.current = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cold_starts = Histogram()
+        self.switch_stalls = Histogram()
+
+    def get(self, model_name: str):
+        start = time.time()
+        cold = False
+        with self._lock:
+            model = self._warm(model_name)
+            loading = None
+            if model is None:
+                loading = self._loading.get(model_name)
+                if loading is None:
+                    cold = True
+                    loading = self._loading[model_name] = Future()
+            if cold:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._metric("worker.model_cache", {"model": model_name, "hit": not cold})
+        if cold:
+            model = self._load(model_name, loading, preloaded=False)
+        elif model is None:
+            # being preloaded, wait for it instead of starting another process
+            model = loading.result()
+        if model_name != self.current:
+            stall = time.time() - start
+            self.switch_stalls.observe(stall)
+            self._metric("worker.model.switch", {
+                "from": self.current or "",
+                "to": model_name,
+                "stall_seconds": stall,
+            })
+            self.current = model_name
+        return model
+
+    def preload(self, model_name: str) -> bool:
+        # starts loading model_name in the background. False if it's already warm,
+        # loading, or can't fit next to the current model.
+        with self._lock:
+            if self._warm(model_name) is not None or model_name in self._loading:
+                return False
+            keep = next(reversed(self._models), None)
+            evicted = []
+            fits = self._make_room(model_name, keep, evicted)
+            if fits:
+                future = self._loading[model_name] = Future()
+        if not fits:
+            self._close(evicted)
+            return False
+        Thread(target=self._load, args=(model_name, future, True, evicted), name=f"preload-{model_name}", daemon=True).start()
+        return True
+
+    def is_warm(self, model_name: str) -> bool:
+        with self._lock:
+            return self._warm(model_name) is not None
+
+    def is_loading(self, model_name: str) -> bool:
+        with self._lock:
+            return model_name in self._loading
+
+    def _warm(self, model_name: str):
+        # call with the lock held
+        model = self._models.get(model_name)
+        if model is not None and not model.alive:
+            print(f"Model process for {model_name} died, reloading")
+            del self._models[model_name]
+            model = None
+        if model is not None:
+            self._models.move_to_end(model_name)
+        return model
+
+    def _load(self, model_name: str, future: Future, preloaded: bool, evicted: list = None):
+        # evicted: models preload() made room by, closed here before loading
+        try:
+            evicted = evicted or []
+            if not preloaded:
+                with self._lock:
+                    self._make_room(model_name, None, evicted)
+            # the evicted models have to be gone before the footprint is measured
+            self._close(evicted)
+            free_before = self.free_memory()
+            start = time.time()
+            model = self.create_model(model_name)
+            loaded = model.load()
+            elapsed = time.time() - start
+            footprint = free_before - self.free_memory()
+            with self._lock:
+                if footprint > 0:
+                    self.footprints[model_name] = footprint
+                self.cold_starts.observe(elapsed)
+                self._models[model_name] = model
+                del self._loading[model_name]
+                warm = len(self._models)
+            print(f"Loaded {model_name} in {elapsed:.1f}s ({footprint / 1024 ** 2:.0f}MB), {warm} models warm")
+            self._metric("worker.model.cold_start", {
+                "model": model_name,
+                "preloaded": preloaded,
+                "duration_seconds": elapsed,
+                "spawn_seconds": loaded.ready_seconds - loaded.duration_seconds,
+                "forked": model.forked,
+                "memory_bytes": footprint,
+            })
+            future.set_result(model)
+            return model
+        except Exception as err:
+            with self._lock:
+                self._loading.pop(model_name, None)
+            future.set_exception(err)
+            if not preloaded:
+                raise
+            print(f"Error preloading {model_name}: {err}")
+
+    def _make_room(self, model_name: str, keep: str, evicted: list) -> bool:
+        # call with the lock held. Evicts least recently used models, except keep,
+        # until model_name fits, and adds them to evicted for the caller to close
+        # after releasing the lock. Their memory counts as freed by their footprint.
+        # Models still loading count towards the limit.
+        need = self.footprints.get(model_name, DEFAULT_MODEL_MEMORY)
+        loading = [name for name in self._loading if name != model_name]
+        loading_need = sum(self.footprints.get(name, DEFAULT_MODEL_MEMORY) for name in loading)
+        free = self.free_memory()
+        while len(self._models) + len(loading) >= self.max_models or free - loading_need - need < self.reserve:
+            evictable = [name for name in self._models if name != keep]
+            if not evictable:
+                return False
+            victim = evictable[0]
+            evicted.append(self._models.pop(victim))
+            free += self.footprints.get(victim, DEFAULT_MODEL_MEMORY)
+            print(f"Evicting {victim}")
+            self.evictions += 1
+            self._metric("worker.model.evicted", {"model": victim})
+        return True
+
+    def _close(self, models: list):
+        # waits for the evicted processes to finish their queued requests and exit
+        for model in models:
+            model.close()
+
+    def clear(self):
+        # dropping the processes kills them
+        with self._lock:
+            self._models.clear()
+
+    def stats(self) -> SimpleNamespace:
+        with self._lock:
+            return SimpleNamespace(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                warm=list(self._models),
+                loading=list(self._loading),
+                in_flight={model_name: model.in_flight for model_name, model in self._models.items()},
+                cold_start=self.cold_starts.snapshot(),
+                switch_stall=self.switch_stalls.snapshot(),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return len(self._models)
+
+    def __contains__(self, model_name: str):
+        return self.is_warm(model_name)
+
+    def _metric(self, name: str, attributes: dict):
+        self.metrics_queue.put(SimpleNamespace(name=name, type="count", value=1, attributes=[
+            {"name": key, "value": v} for key, v in attributes.items()
+        ]))
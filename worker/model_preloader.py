@@ -0,0 +1,91 @@
+# Backlog-aware model switching for the poll loop. It picks the model the
+# worker should claim for next: the assigned one when it has work, otherwise
+# the current one while it keeps claiming, otherwise the assigned one. With
+# PRELOAD_IDLE_STEAL, an idle worker instead takes any other model with a
+# backlog, overriding its per-gpu assignment until that model runs dry.
+# Backlogs are found by peeking (process_image with peek=True, which
+# doesn't claim anything), only for the models a decision depends on, never
+# the current one, and at most once per interval per model. Peeks count as
+# idle requests in the poll scheduler's metric.
+# The next model is loaded by the ModelCache in the background while the
+# current one keeps serving, and the poll loop only switches once it's warm.
+# When both don't fit in memory it switches right away and the process loop
+# pays the cold start, measured as "worker.model.switch" by the cache.
+# Configurable options (env vars):
+#  PRELOAD_PEEK_INTERVAL: seconds between backlog peeks
+#  PRELOAD_MODELS: comma separated models to peek at and preload
+#  PRELOAD_IDLE_STEAL: set to 1 to let idle workers serve unassigned models
+
+import os
+import time
+from queue import Queue
+from types import SimpleNamespace
+from typing import List
+
+from api_client import AIBrushAPI
+from model_cache import ModelCache
+from poll_scheduler import PollScheduler
+
+PRELOAD_PEEK_INTERVAL = float(os.environ.get("PRELOAD_PEEK_INTERVAL", "15"))
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "stable_diffusion,stable_diffusion_inpainting,swinir").split(",")
+PRELOAD_IDLE_STEAL = os.environ.get("PRELOAD_IDLE_STEAL", "0") == "1"
+
+
+class ModelPreloader(object):
+    def __init__(self, client: AIBrushAPI, models: ModelCache, metrics_queue: Queue, scheduler: PollScheduler, model_names: List[str] = PRELOAD_MODELS, interval: float = PRELOAD_PEEK_INTERVAL, idle_steal: bool = PRELOAD_IDLE_STEAL):
+        self.client = client
+        self.models = models
+        self.metrics_queue = metrics_queue
+        self.scheduler = scheduler
+        self.model_names = [name for name in model_names if name]
+        self.interval = interval
+        self.idle_steal = idle_steal
+        # model name -> whether the last peek found pending images
+        self.backlog = {}
+        # model name -> when it may be peeked at again
+        self.next_peek = {}
+
+    def has_backlog(self, model_name: str) -> bool:
+        # peeks at the model's pending images at most once per interval
+        if time.time() < self.next_peek.get(model_name, 0):
+            return self.backlog[model_name]
+        try:
+            self.backlog[model_name] = bool(self.client.process_image(include_models=[model_name], peek=True))
+        except Exception as err:
+            print(f"Error peeking at {model_name} backlog: {err}")
+            self.backlog[model_name] = False
+        self.next_peek[model_name] = time.time() + self.interval
+        self.scheduler.peeked()
+        return self.backlog[model_name]
+
+    def select(self, current: str, assigned: str, idle: bool) -> str:
+        # the model to claim for. idle means the last claim for current came back empty.
+        target = self._next_model(current, assigned, idle)
+        if target == current:
+            return current
+        if self.models.is_warm(target):
+            return target
+        if self.models.is_loading(target):
+            return current
+        if self.models.preload(target):
+            print(f"Preloading {target} while {current} keeps serving")
+            self._metric(target)
+            return current
+        # doesn't fit next to the current model
+        return target
+
+    def _next_model(self, current: str, assigned: str, idle: bool) -> str:
+        if assigned != current and (assigned not in self.model_names or self.has_backlog(assigned)):
+            return assigned
+        if not idle:
+            return current
+        if self.idle_steal:
+            for model_name in self.model_names:
+                if model_name != current and model_name != assigned and self.has_backlog(model_name):
+                    return model_name
+        return assigned
+
+    def _metric(self, model_name: str):
+        self.metrics_queue.put(SimpleNamespace(name="worker.model.preload", type="count", value=1, attributes=[
+            {"name": "model", "value": model_name},
+        ]))
@@ -1,61 +1,288 @@
-import subprocess
 from types import SimpleNamespace
 import argparse
-import json
+from concurrent.futures import Future
+from threading import BoundedSemaphore, Lock, Thread
+import weakref
 from printutil import eprint
-import traceback
-import torch
+from shm_handoff import encode_args, decode_args, release, put_bytes, take_bytes
+from io import BytesIO
+import ipc
+from fork_server import spawn, ForkedProcess
 import sys
+import os
+import time
+
+# Requests a model process accepts before submit() blocks. With 2 the child
+# runs one request while it already holds (and has decoded) the next, and
+# the parent post-processes finished results on its own threads.
+# Outputs larger than MODEL_OUTPUT_SHM_MAX bytes are written to the output
+# file instead of shared memory, and the worker streams them from disk.
+# Configurable options:
+#  depth: requests in flight per model process, pipeline_depth(model) by default
+#  MODEL_PIPELINE_DEPTH: default depth of every model
+#  MODEL_PIPELINE_DEPTH_<MODEL>: depth of one model, e.g. MODEL_PIPELINE_DEPTH_SWINIR
+#  MODEL_OUTPUT_SHM_MAX: largest output handed back in memory
+MODEL_PIPELINE_DEPTH = int(os.environ.get("MODEL_PIPELINE_DEPTH", "2"))
+MODEL_OUTPUT_SHM_MAX = int(os.environ.get("MODEL_OUTPUT_SHM_MAX", str(16 * 1024 * 1024)))
+
+
+def pipeline_depth(model_name: str) -> int:
+    return int(os.environ.get(f"MODEL_PIPELINE_DEPTH_{model_name.upper()}", MODEL_PIPELINE_DEPTH))
+
 
 # wrap the local model in a separate process
 class ModelProcess:
 
-    def __init__(self, model_file: str, gpu="cuda:0") -> None:
+    def __init__(self, model_file: str, gpu="cuda:0", depth: int = MODEL_PIPELINE_DEPTH) -> None:
         print("ModelProcess created")
-        self.process = subprocess.Popen(["python", model_file, gpu], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # stdout carries ipc frames, the child logs to stderr
+        # forked from the fork server, which has the heavy imports done already
+        self.started = time.time()
+        self.process = spawn(model_file, [gpu, depth])
+        self.forked = isinstance(self.process, ForkedProcess)
+        self.channel = ipc.Channel(self.process.stdout, self.process.stdin)
+        self.depth = depth
+        self._slots = BoundedSemaphore(depth)
+        self._pending = {}
+        self._lock = Lock()
+        self._closed = False
+        # the reader only holds a weak reference, so dropping the ModelProcess still kills the child
+        self._reader = Thread(target=ModelProcess._read_loop, args=(self.channel, weakref.ref(self)), name="model-reader", daemon=True)
+        self._reader.start()
 
-    def generate(self, args: SimpleNamespace | argparse.Namespace) -> bool:
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, args: SimpleNamespace | argparse.Namespace) -> Future:
+        # input bytes in args.*_data go through shared memory. Set args.output_shm
+        # to get the encoded output back as output_data instead of in the output file,
+        # large outputs still come back as output_path.
+        # Blocks while `depth` requests are already in flight.
         print("ModelProcess generate called")
-        nsfw = False
-        self.process.stdin.write(json.dumps(args.__dict__).encode())
-        self.process.stdin.write(b"\n")
-        self.process.stdin.flush()
-        print("ModelProcess sent args to child process generate")
-        line = self.process.stdout.readline().decode().strip()
-        print(line)
-        while line not in ("GENERATED", "EXCEPTION"):
-            line = self.process.stdout.readline().decode().strip()
-            print(line)
-            if line.find("NSFW") != -1:
-                nsfw = True
-        if line == "EXCEPTION":
-            raise Exception("Exception in model process")
-        return nsfw
+        self._slots.acquire()
+        try:
+            encoded, blocks = encode_args(args.__dict__)
+        except:
+            self._slots.release()
+            raise
+        future = Future()
+        request_id = self.channel.next_id()
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._pending[request_id] = (future, blocks)
+        if closed:
+            release(blocks)
+            self._slots.release()
+            raise Exception("Model process closed")
+        try:
+            self.channel.send(request_id, ipc.REQUEST, encoded)
+        except Exception as err:
+            self._finish(request_id, error=err)
+        return future
+
+    def run(self, args: SimpleNamespace | argparse.Namespace) -> SimpleNamespace:
+        return self.submit(args).result()
+
+    def generate(self, args: SimpleNamespace | argparse.Namespace) -> bool:
+        return self.run(args).nsfw
+
+    def load(self) -> SimpleNamespace:
+        # loads the model now instead of on the first request. duration_seconds is the
+        # load time, ready_seconds the time from spawning the process until it's loaded
+        result = self.run(SimpleNamespace(load_only=True))
+        result.ready_seconds = time.time() - self.started
+        print(f"Model process {'forked' if self.forked else 'spawned'} and ready in {result.ready_seconds:.2f}s (load {result.duration_seconds:.2f}s)")
+        return result
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        # the child finishes what's queued and exits once stdin is closed
+        with self._lock:
+            self._closed = True
+        try:
+            self.process.stdin.close()
+        except Exception:
+            pass
+        self._reader.join()
+        self.process.wait()
+
+    def _finish(self, request_id: int, result: SimpleNamespace = None, error: Exception = None):
+        with self._lock:
+            entry = self._pending.pop(request_id, None)
+        if entry is None:
+            print(f"Ignoring stale reply {request_id} from model process")
+            return
+        future, blocks = entry
+        release(blocks)
+        self._slots.release()
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _fail_pending(self, error: Exception):
+        with self._lock:
+            self._closed = True
+            request_ids = list(self._pending)
+        for request_id in request_ids:
+            self._finish(request_id, error=error)
+
+    @staticmethod
+    def _read_loop(channel: ipc.Channel, ref):
+        while True:
+            try:
+                frame = channel.receive()
+            except Exception as err:
+                print(f"Error reading from model process: {err}")
+                frame = None
+            owner = ref()
+            if owner is None:
+                return
+            if frame is None:
+                owner._fail_pending(Exception("Model process exited"))
+                return
+            request_id, kind, message = frame
+            if kind == ipc.ERROR:
+                owner._finish(request_id, error=Exception(f"Exception in model process: {message.get('error')}"))
+            else:
+                try:
+                    result = _decode_result(message)
+                except Exception as err:
+                    owner._finish(request_id, error=err)
+                else:
+                    owner._finish(request_id, result)
+            owner = None
 
     def __del__(self):
         if hasattr(self, "process") and self.process:
+            self._fail_pending(Exception("Model process killed"))
             self.process.kill()
             self.process.wait()
             self.process = None
             print("Model process killed")
 
+
+def _decode_result(message: dict) -> SimpleNamespace:
+    output_data = message.get("output_data")
+    if "output" in message:
+        output_data = take_bytes(message["output"], unlink=True)
+    return SimpleNamespace(
+        nsfw=message["nsfw"],
+        output_data=output_data,
+        output_path=message.get("output_path"),
+        queued_seconds=message["queued_seconds"],
+        duration_seconds=message["duration_seconds"],
+        cpu_seconds=message["cpu_seconds"],
+    )
+
+
+_output = None
+
+
+def input_file(args, key: str):
+    # an input image to open with PIL: the bytes handed over in memory, else the fallback path
+    data = getattr(args, key + "_data", None)
+    if data:
+        return BytesIO(data)
+    path = getattr(args, key)
+    assert os.path.isfile(path)
+    return path
+
+
+def save_output(image, path: str, in_memory: bool = False):
+    # called by the models with their result, a PIL image or encoded png bytes.
+    # Held for child_process to hand back when the parent asked for it in memory.
+    global _output
+    if in_memory:
+        if not isinstance(image, (bytes, bytearray)):
+            buf = BytesIO()
+            image.save(buf, format="png")
+            image = buf.getvalue()
+        _output = (image, path)
+    elif isinstance(image, (bytes, bytearray)):
+        with open(path, "wb") as f:
+            f.write(image)
+    else:
+        image.save(path)
+
+
+def _take_output(result: dict):
+    global _output
+    if _output is None:
+        return
+    (data, path), _output = _output, None
+    if len(data) <= MODEL_OUTPUT_SHM_MAX or not path:
+        ref, shm = put_bytes(data, untrack=True)
+        if ref:
+            # the parent unlinks it once read
+            shm.close()
+            result["output"] = ref
+            return
+        if not path:
+            # no shared memory, the bytes go in the reply frame
+            result["output_data"] = data
+            return
+    # too large to hold in memory, or no shared memory: the worker uploads the file
+    with open(path, "wb") as f:
+        f.write(data)
+    result["output_path"] = os.path.abspath(path)
+
+
+def _with_nsfw(result: dict, nsfw: Future) -> Future:
+    reply = Future()
+
+    def done(future: Future):
+        if future.exception():
+            if "output" in result:
+                # never reaches the parent, which would unlink it
+                take_bytes(result["output"], unlink=True)
+            reply.set_exception(future.exception())
+        else:
+            result["nsfw"] = bool(future.result())
+            reply.set_result(result)
+
+    nsfw.add_done_callback(done)
+    return reply
+
+
 def child_process(Model, name):
     gpu = "cuda:0" if len(sys.argv) == 1 else sys.argv[1]
-    torch.cuda.set_device(gpu)
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else MODEL_PIPELINE_DEPTH
+    channel = ipc.child_channel()
+    if gpu.startswith("cuda"):
+        # imported here so stub models can run without torch
+        import torch
+        torch.cuda.set_device(gpu)
     eprint(f"local model process running for {name}")
     model = None
     eprint("model process created")
-    while True:
-        try:
-            args_json = input()
-            args = SimpleNamespace(**json.loads(args_json))
-            if model is None:
-                model = Model()
-            eprint(f"input received: {args}")
-            model.generate(args)
-            print("GENERATED")
-        except Exception as e:
-            eprint(e)
-            traceback.print_exc()
-            print("EXCEPTION")
-            continue
+
+    def prepare(message: dict) -> SimpleNamespace:
+        # runs on the reader thread, while the previous request generates
+        return SimpleNamespace(**decode_args(message))
+
+    def handle(args: SimpleNamespace) -> dict:
+        global _output
+        nonlocal model
+        _output = None
+        if model is None:
+            model = Model()
+        if getattr(args, "load_only", False):
+            return {"nsfw": False}
+        eprint(f"input received: {sorted(args.__dict__)}")
+        nsfw = model.generate(args)
+        result = {}
+        _take_output(result)
+        if isinstance(nsfw, Future):
+            # the safety check is still running, the reply goes out when it's done
+            return _with_nsfw(result, nsfw)
+        result["nsfw"] = bool(nsfw)
+        return result
+
+    ipc.serve(channel, handle, prepare, depth)
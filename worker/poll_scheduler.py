@@ -0,0 +1,83 @@
+# Adaptive poll timing for the poll loop. Every poll that claims nothing
+# doubles the interval until the next one, up to max_interval, so idle
+# workers put almost no load on the backend. Claimed work or a pending_image
+# notification snaps the interval back to min_interval.
+# The heartbeat rides along on claim requests (the "ping" flag), and an
+# explicit worker ping is only sent every ping_interval as a fallback, well
+# inside the backend's worker timeout.
+# Configurable options (env vars):
+#  POLL_MIN_INTERVAL, POLL_MAX_INTERVAL: bounds of the poll interval in seconds
+#  PING_INTERVAL: seconds between explicit worker pings
+
+import os
+import time
+from threading import Lock
+from types import SimpleNamespace
+
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", "16"))
+PING_INTERVAL = float(os.environ.get("PING_INTERVAL", "60"))
+
+
+class PollScheduler(object):
+    def __init__(self, min_interval: float = POLL_MIN_INTERVAL, max_interval: float = POLL_MAX_INTERVAL, ping_interval: float = PING_INTERVAL, backoff: float = 2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.ping_interval = ping_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        # poll right away on startup
+        self.next_poll = time.time()
+        self.last_ping = time.time()
+        self._lock = Lock()
+        self._idle_requests = 0
+        self._idle_since = time.time()
+
+    def due(self) -> bool:
+        return time.time() >= self.next_poll
+
+    def timeout(self) -> float:
+        # how long the poll loop can block waiting for a notification
+        return max(0, self.next_poll - time.time())
+
+    def wake(self):
+        # new work was announced, poll now and at full rate again
+        self.interval = self.min_interval
+        self.next_poll = time.time()
+
+    def polled(self, claimed: int):
+        if claimed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+            self._count_idle()
+        self.next_poll = time.time() + self.interval
+
+    def ping_due(self) -> bool:
+        return time.time() - self.last_ping >= self.ping_interval
+
+    def pinged(self):
+        self.last_ping = time.time()
+        self._count_idle()
+
+    def peeked(self):
+        # backlog peeks don't claim anything either
+        self._count_idle()
+
+    def _count_idle(self):
+        with self._lock:
+            self._idle_requests += 1
+
+    def idle_request_rate(self) -> float:
+        # requests per second that found no work, since the last call
+        with self._lock:
+            now = time.time()
+            rate = self._idle_requests / max(now - self._idle_since, 1e-6)
+            self._idle_requests = 0
+            self._idle_since = now
+            return rate
+
+    def metric(self) -> SimpleNamespace:
+        return SimpleNamespace(name="worker.poll.idle_requests_per_second", type="gauge", value=self.idle_request_rate(), attributes=[
+            {"name": "interval_seconds", "value": self.interval},
+        ])
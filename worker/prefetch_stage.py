@@ -0,0 +1,79 @@
+# Input download stage between the poll loop and the process loop.
+# The poll loop hands claimed images to submit() and goes straight back to
+# polling, while a small pool of threads fetches download urls, image and mask
+# (concurrently) and then puts the image on the process queue.
+# Configurable options:
+#  max_workers: how many images may be downloading at once
+# Emits a "worker.prefetch" metric per image with the input wait time
+# (claim to queued for processing) and the download time, and the
+# "prefetch_wait" and "download" spans of traced images.
+
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from threading import Lock
+from types import SimpleNamespace
+
+import tracing
+from api_client import AIBrushAPI
+
+PREFETCH_THREADS = 4
+
+
+class PrefetchStage(object):
+    def __init__(self, client: AIBrushAPI, process_queue: Queue, metrics_queue: Queue, on_error: callable, max_workers: int = PREFETCH_THREADS):
+        self.client = client
+        self.process_queue = process_queue
+        self.metrics_queue = metrics_queue
+        self.on_error = on_error
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = Lock()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        # claimed images that haven't reached the process queue yet,
+        # the poll loop counts these against its capacity
+        with self._lock:
+            return self._in_flight
+
+    def submit(self, image) -> Future:
+        with self._lock:
+            self._in_flight += 1
+        return self.executor.submit(self._prefetch, image, time.time())
+
+    def _prefetch(self, image, claimed_at: float):
+        try:
+            start = time.time()
+            tracing.record("prefetch_wait", image.trace_id, claimed_at, start)
+            with tracing.span("download", image.trace_id):
+                fetch_inputs(self.client, image)
+            download_seconds = time.time() - start
+            image.queued_at = time.time()
+            self.process_queue.put(image)
+            self.metrics_queue.put(SimpleNamespace(name="worker.prefetch", type="count", value=1, attributes=[
+                {"name": "wait_seconds", "value": time.time() - claimed_at},
+                {"name": "duration_seconds", "value": download_seconds},
+                {"name": "model", "value": image.model},
+            ]))
+        except Exception as err:
+            self.on_error(err, "prefetch")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_inputs(client: AIBrushAPI, image):
+    # image and mask are downloaded side by side
+    image.thumbnail_data = None
+    image.mask_data = None
+    download_urls = client.get_image_download_urls(image.id)
+    mask = None
+    if image.model == "stable_diffusion_inpainting":
+        mask = client.transfer_executor.submit(client.get_mask_data, image.id, download_urls.mask_url)
+    image.image_data = client.get_image_data(image.id, download_urls.image_url)
+    if mask:
+        image.mask_data = mask.result()
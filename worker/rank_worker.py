@@ -10,6 +10,10 @@ from uuid import uuid4
 
 import torch
 from api_client import AIBrushAPI
+from metrics_aggregator import MetricsAggregator, METRICS_FLUSH_INTERVAL
+from metrics_buffer import MetricsBuffer
+from upload_pool import UploadPool
+from workspace import job_path, remove_job_dir, start_sweeper
 import base64
 import traceback
 from PIL import Image
@@ -20,8 +24,7 @@ from io import BytesIO
 from clip_process import ClipProcess
 from memutil import get_free_memory
 from torch import device
-from apisocket import ApiSocket
-import asyncio
+from apisocket import shared_socket
 import bugsnag
 from errorkillswitch import ErrorKillSwitch
 
@@ -78,27 +81,9 @@ for folder in ["images", "output", "output_npy"]:
 
 
 def cleanup(image_id: str):
-    # delete all files in the current folder ending in .png or .backup
-    for fname in os.listdir("images"):
-        _cleanup_file(image_id, os.path.join("images", fname))
-    for fname in os.listdir("output"):
-        _cleanup_file(image_id, os.path.join("output", fname))
-    for fname in os.listdir("output_npy"):
-        _cleanup_file(image_id, os.path.join("output_npy", fname))
-    if os.path.exists("results"):
-        for fname in os.listdir(os.path.join("results", "swinir_real_sr_x4")):
-            _cleanup_file(image_id, os.path.join("results", "swinir_real_sr_x4", fname))
-
-
-def _cleanup_file(image_id: str, file_path: str):
-    is_old = time.time() - os.path.getmtime(file_path) > 3600
-    match = image_id in file_path
-    if is_old or match:
-        try:
-            os.remove(file_path)
-        except:
-            # another thread might have deleted it
-            pass
+    # the job's files all live in its own directory, orphans are left to the sweeper
+    remove_job_dir(image_id)
+
 
 model_lock = Lock()
 
@@ -232,20 +217,18 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
                 score = 0
                 negative_score = 0
                 
-                # get output image
-                image_path = os.path.join("images", image.id + ".png")
-                with open(image_path, "wb") as f:
-                    f.write(image_data)
+                # handed to the clip process in memory, the path is only written if shared memory isn't available
+                image_path = job_path(image.id, "output.png")
                 prompts = ",".join(image.phrases)
                 negative_prompts = ",".join(image.negative_phrases).strip()
 
                 score = clip_ranker.rank(argparse.Namespace(
-                    text=prompts, image=image_path, cpu=False))
+                    text=prompts, image=image_path, image_data=image_data, cpu=False))
                 if negative_prompts:
                     print(
                         f"Calculating negative clip ranking for '{prompts}'")
                     negative_score = clip_ranker.rank(argparse.Namespace(
-                        text=negative_prompts, image=image_path, cpu=False))
+                        text=negative_prompts, image=image_path, image_data=image_data, cpu=False))
                 # use PIL to resize image
                 update_queue.put(SimpleNamespace(
                     id=image.id,
@@ -266,24 +249,12 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
             continue
 
 
-def update_loop(update_queue: Queue, cleanup_queue: Queue, metrics_queue: Queue):
-    while True:
-        try:
-            image = update_queue.get()
-            if not image:
-                return
-            start = time.time()
-            client.update_image(image.id, None, None,
-                                None, image.status, image.score, image.negative_score, None)
-            metrics_queue.put(metric("worker.update", "count", 1, {
-                "duration_seconds": time.time() - start
-            }))
-            # cleanup_queue.put(image.id)
-            if image.status == "completed":
-                cleanup_queue.put(image.id)
-        except Exception as e:
-            handle_error(e, "update_loop")
-            continue
+def send_update(image, cleanup_queue: Queue):
+    # runs on an UploadPool thread, updates for the same image arrive in order
+    client.update_image(image.id, None, None,
+                        None, image.status, image.score, image.negative_score, None)
+    if image.status == "completed":
+        cleanup_queue.put(image.id)
 
 
 def cleanup_loop(cleanup_queue: Queue):
@@ -298,20 +269,27 @@ def cleanup_loop(cleanup_queue: Queue):
             continue
 
 
-def metrics_loop(metrics_queue: Queue):
-    # Collect metrics and send to server every 10 seconds
-    last_send = time.time()
-    collected_metrics = []
-    while True:
+def flush_metrics(aggregator: MetricsAggregator, metrics_queue: MetricsBuffer):
+    collected_metrics = aggregator.flush()
+    collected_metrics.extend(client.connection_metrics())
+    collected_metrics.extend(client.request_metrics())
+    dropped = metrics_queue.take_dropped()
+    if dropped:
+        collected_metrics.append(metric("worker.metrics.dropped", "count", dropped))
+    client.add_metrics(collected_metrics)
+
+
+def metrics_loop(metrics_queue: MetricsBuffer):
+    # Aggregate metrics locally and send them to the server every 10 seconds,
+    # producers never wait on this thread
+    aggregator = MetricsAggregator()
+    closed = False
+    while not closed:
         try:
-            metrics = metrics_queue.get()
-            if not metrics:
-                return
-            collected_metrics.append(metrics)
-            if time.time() - last_send > 10:
-                client.add_metrics(collected_metrics)
-                collected_metrics = []
-                last_send = time.time()
+            closed = metrics_queue.wait(METRICS_FLUSH_INTERVAL)
+            for metrics in metrics_queue.drain():
+                aggregator.add(metrics)
+            flush_metrics(aggregator, metrics_queue)
         except Exception as e:
             handle_error(e, "metrics_loop")
             continue
@@ -322,22 +300,22 @@ class ImagesWorker:
         # create queues
         self.websocket_queue = Queue(maxsize=1)
         self.process_queue = Queue(maxsize=4)
-        self.update_queue = Queue(maxsize=4)
         self.cleanup_queue = Queue(maxsize=4)
-        self.metrics_queue = Queue(maxsize=4)
+        # non-blocking, metrics are dropped rather than stalling the pipeline
+        self.metrics_queue = MetricsBuffer()
+        # updates are uploaded in parallel, in order per image
+        self.update_queue = UploadPool(
+            lambda image: send_update(image, self.cleanup_queue), self.metrics_queue, handle_error)
         self.ready_queue = Queue(maxsize=1)
 
         # start threads
-        self.apisocket = ApiSocket(api_url, client.token, self.websocket_queue)
-        # self.websocket_thread = Thread(target=self.apisocket.run)
-        self.websocket_thread = Thread(
-            target=asyncio.run, args=(self.apisocket.run(),))
+        # one socket per process, notifications are fanned out to every worker
+        self.apisocket = shared_socket(api_url, client.token)
+        self.apisocket.register(self.websocket_queue)
         self.poll_thread = Thread(target=poll_loop, args=(
             self.ready_queue, self.process_queue, self.metrics_queue, self.websocket_queue, gpu))
         self.process_thread = Thread(target=process_loop, args=(
             self.ready_queue, self.process_queue, self.update_queue, self.metrics_queue, gpu))
-        self.update_thread = Thread(target=update_loop, args=(
-            self.update_queue, self.cleanup_queue, self.metrics_queue))
         self.cleanup_thread = Thread(
             target=cleanup_loop, args=(self.cleanup_queue,))
         self.metrics_thread = Thread(
@@ -345,23 +323,24 @@ class ImagesWorker:
 
     def start(self):
         # start threads
-        self.websocket_thread.start()
+        self.apisocket.start()
         self.poll_thread.start()
-        self.update_thread.start()
+        self.update_queue.start()
         self.cleanup_thread.start()
+        start_sweeper()
         self.metrics_thread.start()
         self.process_thread.start()
 
     def wait(self):
         self.process_thread.join()
-        self.websocket_thread.join()
+        self.apisocket.join()
         self.poll_thread.join()
-        self.update_thread.join()
+        self.update_queue.join()
         self.cleanup_thread.join()
         self.metrics_thread.join()
 
     def kill(self):
-        self.apisocket.kill()
+        self.apisocket.unregister(self.websocket_queue)
         self.websocket_queue.put(None)
         self.process_queue.put(None)
         self.update_queue.put(None)
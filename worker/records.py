@@ -0,0 +1,229 @@
+# Compact records passed between worker threads. These use __slots__ instead of
+# SimpleNamespace so each record is a fixed-size object, and carry image payloads
+# as raw bytes (or memoryviews over an encoder's buffer) so that nothing is
+# base64 encoded or copied between generation and upload.
+#
+# API responses that the workers handle on every poll (images, download and
+# upload urls, worker config) are decoded into typed records as well, using
+# orjson when it is installed. Fields the record doesn't know about are kept
+# in an overflow dict, so a newer backend can't break decoding.
+
+import json
+from types import SimpleNamespace
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+class Record(object):
+    __slots__ = ("_extra",)
+    # fields that come from (and go back to) the api
+    _fields = ()
+    # worker-local fields, never serialized
+    _local_fields = ()
+    # fields holding nested objects: name -> record class (or SimpleNamespace)
+    _nested = {}
+
+    def __init__(self, **kwargs):
+        self._from_dict(self, kwargs)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Record":
+        obj = cls.__new__(cls)
+        cls._from_dict(obj, data)
+        return obj
+
+    def __init_subclass__(cls, **kwargs):
+        # compile a straight-line field setter per record class, like namedtuple and
+        # dataclasses do, so decoding is plain attribute stores instead of setattr calls
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls._fields)
+        lines = ["def _from_dict(obj, data):", "    get = data.get"]
+        for name in cls._fields:
+            if name in cls._nested:
+                lines.append(f"    value = get({name!r})")
+                lines.append(f"    obj.{name} = None if value is None else decode_nested(nested[{name!r}], value)")
+            else:
+                lines.append(f"    obj.{name} = get({name!r})")
+        for name in cls._local_fields:
+            lines.append(f"    obj.{name} = None")
+        lines.append("    obj._extra = None if field_set.issuperset(data) else {k: v for k, v in data.items() if k not in field_set}")
+        namespace = {"decode_nested": _decode_nested, "nested": cls._nested, "field_set": cls._field_set}
+        exec("\n".join(lines), namespace)
+        cls._from_dict = staticmethod(namespace["_from_dict"])
+
+    def __getattr__(self, name):
+        # only called when a slot is missing, fall back to unknown api fields
+        if name != "_extra":
+            extra = self._extra
+            if extra and name in extra:
+                return extra[name]
+        raise AttributeError(f"{type(self).__name__} has no attribute '{name}'")
+
+    def to_dict(self) -> dict:
+        data = {name: _encode_nested(getattr(self, name)) for name in self._fields}
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self._fields[:3])
+        return f"{type(self).__name__}({fields})"
+
+
+def _decode_nested(nested_cls, value):
+    if isinstance(value, list):
+        return [_decode_nested(nested_cls, v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if nested_cls is SimpleNamespace:
+        return SimpleNamespace(**{k: _decode_nested(SimpleNamespace, v) for k, v in value.items()})
+    return nested_cls.from_dict(value)
+
+
+def _encode_nested(value):
+    if isinstance(value, list):
+        return [_encode_nested(v) for v in value]
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, SimpleNamespace):
+        return {k: _encode_nested(v) for k, v in value.__dict__.items()}
+    return value
+
+
+class Image(Record):
+    _fields = (
+        "id",
+        "created_at",
+        "created_by",
+        "updated_at",
+        "label",
+        "parent",
+        "phrases",
+        "negative_phrases",
+        "iterations",
+        "current_iterations",
+        "score",
+        "negative_score",
+        "status",
+        "model",
+        "width",
+        "height",
+        "stable_diffusion_strength",
+        "nsfw",
+        "temporary",
+        "deleted_at",
+        "error",
+        "worker_id",
+        "params",
+    )
+    _local_fields = (
+        "image_data",
+        "mask_data",
+        "thumbnail_data",
+        "warmup",
+        # tracing.start_trace() id, and when the image was put on the process queue
+        "trace_id",
+        "queued_at",
+    )
+    _nested = {"params": SimpleNamespace}
+    __slots__ = _fields + _local_fields
+
+
+class ImageUrls(Record):
+    _fields = (
+        "image_url",
+        "mask_url",
+        "thumbnail_url",
+    )
+    __slots__ = _fields
+
+
+# the backend uses the same shape for both
+DownloadUrls = ImageUrls
+UploadUrls = ImageUrls
+
+
+class WorkerGpuConfig(Record):
+    _fields = (
+        "gpu_num",
+        "model",
+    )
+    __slots__ = _fields
+
+
+class WorkerConfig(Record):
+    _fields = (
+        "worker_id",
+        "gpu_configs",
+    )
+    _nested = {"gpu_configs": WorkerGpuConfig}
+    __slots__ = _fields
+
+
+def decode(record_cls, json_str):
+    # decodes a single record, a list of records or null
+    try:
+        data = _loads(json_str)
+    except Exception as err:
+        print(f"Error parsing json: {err}")
+        raise err
+    if data is None:
+        return None
+    if isinstance(data, list):
+        return [record_cls.from_dict(d) for d in data]
+    return record_cls.from_dict(data)
+
+
+def as_dict(obj) -> dict:
+    # json-serializable fields of a record or SimpleNamespace
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    return obj.__dict__
+
+
+class ImageUpdate(object):
+    __slots__ = (
+        "id",
+        "image_data",
+        "image_path",
+        "thumbnail_data",
+        "npy_data",
+        "iterations",
+        "status",
+        "score",
+        "negative_score",
+        "nsfw",
+        "upload_urls",
+        "trace_id",
+    )
+
+    def __init__(self, id: str, status: str, image_data: bytes | memoryview = None, thumbnail_data: bytes | memoryview = None,
+                 npy_data: bytes = None, iterations: int = None, score: float = 0, negative_score: float = 0,
+                 nsfw: bool = None, upload_urls=None, image_path: str = None, trace_id: str = None):
+        self.id = id
+        self.status = status
+        self.image_data = image_data
+        # output file to stream the upload from, instead of image_data
+        self.image_path = image_path
+        self.thumbnail_data = thumbnail_data
+        self.npy_data = npy_data
+        self.iterations = iterations
+        self.score = score
+        self.negative_score = negative_score
+        self.nsfw = nsfw
+        self.upload_urls = upload_urls
+        self.trace_id = trace_id
+
+    def __repr__(self):
+        return "ImageUpdate(id=%s, status=%s, image_bytes=%s, image_path=%s, thumbnail_bytes=%s)" % (
+            self.id, self.status, _size(self.image_data), self.image_path, _size(self.thumbnail_data))
+
+
+def _size(data) -> int:
+    if data is None:
+        return 0
+    return memoryview(data).nbytes
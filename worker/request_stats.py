@@ -0,0 +1,98 @@
+# Per-endpoint request instrumentation for the API clients. Every logical
+# request (after retries) records its latency into a histogram, plus retry
+# count, bytes sent/received and status code, keyed by method and endpoint
+# template, e.g. "PATCH /images/{id}" or "PUT s3".
+# Stats can be read with snapshot() or drained into add_metrics() payloads
+# with to_metrics().
+
+from threading import Lock
+from types import SimpleNamespace
+from typing import Dict, List
+
+from histogram import Histogram
+
+# status recorded when every retry failed without a response
+STATUS_ERROR = "error"
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.requests = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = {}
+
+
+class RequestStats(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._endpoints: Dict[str, EndpointStats] = {}
+
+    def record(self, method: str, endpoint: str, status, elapsed: float, retries: int, bytes_sent: int, bytes_received: int):
+        key = f"{method} {endpoint}"
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = EndpointStats()
+            stats.requests += 1
+            stats.retries += retries
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            # under the lock, so a concurrent snapshot(reset=True) gets both or neither
+            stats.latency.observe(elapsed)
+
+    def snapshot(self, reset: bool = False) -> Dict[str, SimpleNamespace]:
+        with self._lock:
+            endpoints = self._endpoints
+            if reset:
+                self._endpoints = {}
+        return {
+            key: SimpleNamespace(
+                requests=stats.requests,
+                retries=stats.retries,
+                bytes_sent=stats.bytes_sent,
+                bytes_received=stats.bytes_received,
+                statuses=dict(stats.statuses),
+                latency=stats.latency.snapshot(),
+            )
+            for key, stats in endpoints.items()
+        }
+
+    def to_metrics(self, reset: bool = True) -> List[SimpleNamespace]:
+        # one "worker.http.request" count per endpoint, shaped for AIBrushAPI.add_metrics
+        metrics = []
+        for key, stats in self.snapshot(reset).items():
+            errors = sum(n for status, n in stats.statuses.items() if status == STATUS_ERROR or status >= 400)
+            metrics.append(_metric("worker.http.request", "count", stats.requests, {
+                "endpoint": key,
+                "retries": stats.retries,
+                "errors": errors,
+                "bytes_sent": stats.bytes_sent,
+                "bytes_received": stats.bytes_received,
+                "latency_mean": stats.latency.mean,
+                "latency_p50": stats.latency.p50,
+                "latency_p90": stats.latency.p90,
+                "latency_p99": stats.latency.p99,
+                "latency_max": stats.latency.max,
+            }))
+        return metrics
+
+
+def request_size(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    try:
+        return memoryview(body).nbytes
+    except TypeError:
+        return 0
+
+
+def _metric(name: str, type: str, value, attributes: dict) -> SimpleNamespace:
+    return SimpleNamespace(name=name, type=type, value=value, attributes=[
+        {"name": key, "value": v} for key, v in attributes.items()
+    ])
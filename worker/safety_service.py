@@ -0,0 +1,318 @@
+# One safety checker per host, shared by every model process. The stable
+# diffusion models used to load their own copy of the checker at import time
+# and run it inline after sampling, one image at a time.
+# The service is a process listening on a unix socket. Model processes send
+# it their samples with SafetyClient.check(), which returns a Future of the
+# nsfw flag right away, so the model moves on to the next request while the
+# check runs. Requests from all connections are batched through the checker.
+# The first client to find no service starts it; it exits after being idle
+# with no connections. Without the service, checks run in the calling process,
+# and checks that were waiting when the service went away are sent to a new
+# one once before they fall back to that.
+# Configurable options (env vars):
+#  SAFETY_SERVICE: set to 0 to run the checker in each model process
+#  SAFETY_SERVICE_SOCKET: path of the service's unix socket
+#  SAFETY_BATCH_SIZE: most images per checker batch
+#  SAFETY_BATCH_WAIT: seconds to wait for more images before running a batch
+#  SAFETY_SERVICE_IDLE: seconds without connections before the service exits
+#  SAFETY_CHECKER_DEVICE: torch device of the checker
+
+import fcntl
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Lock, Thread
+
+import numpy as np
+
+import ipc
+
+SAFETY_SERVICE = os.environ.get("SAFETY_SERVICE", "1") == "1"
+SAFETY_SERVICE_SOCKET = os.environ.get("SAFETY_SERVICE_SOCKET", os.path.join(tempfile.gettempdir(), "aibrush-safety-checker.sock"))
+SAFETY_BATCH_SIZE = int(os.environ.get("SAFETY_BATCH_SIZE", "8"))
+SAFETY_BATCH_WAIT = float(os.environ.get("SAFETY_BATCH_WAIT", "0.02"))
+SAFETY_SERVICE_IDLE = float(os.environ.get("SAFETY_SERVICE_IDLE", "300"))
+SAFETY_CHECKER_DEVICE = os.environ.get("SAFETY_CHECKER_DEVICE", "cpu")
+
+SAFETY_MODEL_ID = "CompVis/stable-diffusion-safety-checker"
+
+
+class SafetyChecker(object):
+    def __init__(self, device: str = SAFETY_CHECKER_DEVICE):
+        # imported here, the client side doesn't need them
+        from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+        from transformers import AutoFeatureExtractor
+        self.device = device
+        self.feature_extractor = AutoFeatureExtractor.from_pretrained(SAFETY_MODEL_ID)
+        self.checker = StableDiffusionSafetyChecker.from_pretrained(SAFETY_MODEL_ID).to(device)
+
+    def check(self, images: list) -> list:
+        # images: uint8 (h, w, c) arrays. Returns an nsfw flag per image
+        import torch
+        from PIL import Image
+        clip_input = self.feature_extractor([Image.fromarray(image) for image in images], return_tensors="pt").pixel_values
+        with torch.no_grad():
+            _, has_nsfw_concept = self.checker(
+                images=[image.astype(np.float32) / 255.0 for image in images],
+                clip_input=clip_input.to(self.device),
+            )
+        return [bool(flag) for flag in has_nsfw_concept]
+
+
+def to_pixels(images) -> np.ndarray:
+    # samples as the models produce them, (n, h, w, c) floats in [0, 1], to uint8
+    images = np.asarray(images)
+    if images.ndim == 3:
+        images = images[None, ...]
+    if images.dtype != np.uint8:
+        images = (images * 255).round().clip(0, 255).astype(np.uint8)
+    return np.ascontiguousarray(images)
+
+
+class SafetyClient(object):
+    def __init__(self, path: str = SAFETY_SERVICE_SOCKET):
+        self.path = path
+        self._lock = Lock()
+        self._channel = None
+        # channel -> request id -> (future, pixels, retried). Request ids restart
+        # with every channel, and a channel's reader takes its requests when it ends
+        self._pending = {}
+        self._local_lock = Lock()
+        self._local = None
+
+    def check(self, images) -> Future:
+        # resolves to whether any of the images is nsfw
+        future = Future()
+        self._submit(future, to_pixels(images), retried=False)
+        return future
+
+    def check_local(self, pixels: np.ndarray) -> Future:
+        future = Future()
+        self._check_local(future, pixels)
+        return future
+
+    def _submit(self, future: Future, pixels: np.ndarray, retried: bool):
+        if SAFETY_SERVICE:
+            try:
+                channel, request_id = self._register(future, pixels, retried)
+            except Exception as err:
+                print(f"Safety service unavailable, checking in process: {err}")
+            else:
+                try:
+                    channel.send(request_id, ipc.REQUEST, {"shape": list(pixels.shape), "pixels": pixels.tobytes()})
+                    return
+                except Exception as err:
+                    # unless the channel's reader took the request to retry it already
+                    with self._lock:
+                        taken = self._pending.get(channel, {}).pop(request_id, None)
+                    if taken is None:
+                        return
+                    print(f"Safety service unavailable, checking in process: {err}")
+        self._check_local(future, pixels)
+
+    def _register(self, future: Future, pixels: np.ndarray, retried: bool):
+        # adds the request to a live channel's pending requests. The pixels are kept
+        # until the reply, to retry them if the service goes away
+        for _ in range(3):
+            channel = self._connect()
+            with self._lock:
+                # the reader may have ended the channel since _connect returned it
+                if self._channel is channel:
+                    request_id = channel.next_id()
+                    self._pending.setdefault(channel, {})[request_id] = (future, pixels, retried)
+                    return channel, request_id
+        raise Exception("Safety service connection keeps closing")
+
+    def _check_local(self, future: Future, pixels: np.ndarray):
+        try:
+            with self._local_lock:
+                if self._local is None:
+                    self._local = SafetyChecker()
+                nsfw = any(self._local.check(list(pixels)))
+        except Exception as err:
+            future.set_exception(err)
+        else:
+            future.set_result(nsfw)
+
+    def _connect(self) -> ipc.Channel:
+        with self._lock:
+            if self._channel is None:
+                sock = _connect(self.path)
+                self._channel = ipc.Channel(sock.makefile("rb"), sock.makefile("wb"))
+                Thread(target=self._read_loop, args=(self._channel,), name="safety-reader", daemon=True).start()
+            return self._channel
+
+    def _read_loop(self, channel: ipc.Channel):
+        while True:
+            try:
+                frame = channel.receive()
+            except Exception as err:
+                print(f"Error reading from safety service: {err}")
+                frame = None
+            if frame is None:
+                break
+            request_id, kind, message = frame
+            with self._lock:
+                future, _, _ = self._pending.get(channel, {}).pop(request_id, (None, None, None))
+            if future is None:
+                continue
+            if kind == ipc.ERROR:
+                future.set_exception(Exception(f"Exception in safety service: {message.get('error')}"))
+            else:
+                future.set_result(message["nsfw"])
+        # the next check reconnects, or starts a new service. Requests can't be
+        # added to this channel once it's no longer current
+        with self._lock:
+            if self._channel is channel:
+                self._channel = None
+            pending = self._pending.pop(channel, {})
+        # checks still waiting are sent again once, then run in process, so
+        # images that are already generated aren't lost with the service
+        if pending:
+            print(f"Safety service went away, retrying {len(pending)} checks")
+        for future, pixels, retried in pending.values():
+            if retried:
+                self._check_local(future, pixels)
+            else:
+                self._submit(future, pixels, retried=True)
+
+
+def _connect(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    # one process on the host starts the service, the others wait for it
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            sock.connect(path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        start = time.time()
+        process = subprocess.Popen(["python", os.path.abspath(__file__), path], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, start_new_session=True)
+        ready = process.stdout.readline().strip() == b"ready"
+        process.stdout.close()
+        if not ready:
+            raise Exception("Safety service failed to start")
+        print(f"Safety service started in {time.time() - start:.1f}s")
+        sock.connect(path)
+        return sock
+
+
+class SafetyService(object):
+    def __init__(self, checker: SafetyChecker, batch_size: int = SAFETY_BATCH_SIZE, batch_wait: float = SAFETY_BATCH_WAIT):
+        self.checker = checker
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        # (channel, request id, images)
+        self.requests = Queue()
+        self._lock = Lock()
+        self.connections = 0
+        self.idle_since = time.time()
+
+    def handle_connection(self, conn: socket.socket):
+        channel = ipc.Channel(conn.makefile("rb"), conn.makefile("wb"))
+        with self._lock:
+            self.connections += 1
+        try:
+            while True:
+                frame = channel.receive()
+                if frame is None:
+                    return
+                request_id, _, message = frame
+                try:
+                    images = np.frombuffer(message["pixels"], dtype=np.uint8).reshape(message["shape"])
+                except Exception as err:
+                    channel.send(request_id, ipc.ERROR, {"error": str(err) or type(err).__name__})
+                    continue
+                self.requests.put((channel, request_id, images))
+        except Exception as err:
+            print(f"safety service: connection error: {err}", file=sys.stderr)
+        finally:
+            conn.close()
+            with self._lock:
+                self.connections -= 1
+                if not self.connections:
+                    self.idle_since = time.time()
+
+    def batch_loop(self):
+        while True:
+            batch = [self.requests.get()]
+            images = len(batch[0][2])
+            deadline = time.time() + self.batch_wait
+            while images < self.batch_size:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                batch.append(request)
+                images += len(request[2])
+            self.run_batch(batch)
+
+    def run_batch(self, batch: list):
+        start = time.time()
+        try:
+            flags = self.checker.check([image for _, _, request_images in batch for image in request_images])
+        except Exception as err:
+            traceback.print_exc()
+            for channel, request_id, _ in batch:
+                self._send(channel, request_id, ipc.ERROR, {"error": str(err) or type(err).__name__})
+            return
+        offset = 0
+        for channel, request_id, request_images in batch:
+            self._send(channel, request_id, ipc.RESULT, {"nsfw": any(flags[offset:offset + len(request_images)])})
+            offset += len(request_images)
+        print(f"safety service: checked {len(flags)} images from {len(batch)} requests in {time.time() - start:.2f}s", file=sys.stderr)
+
+    def _send(self, channel: ipc.Channel, request_id: int, kind: int, message: dict):
+        try:
+            channel.send(request_id, kind, message)
+        except Exception as err:
+            # the model process went away
+            print(f"safety service: error replying: {err}", file=sys.stderr)
+
+    def idle(self) -> bool:
+        with self._lock:
+            return not self.connections and time.time() - self.idle_since > SAFETY_SERVICE_IDLE
+
+
+def serve(path: str, checker: SafetyChecker = None):
+    # anything printed while loading goes to stderr, stdout only says when it's ready
+    out = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    service = SafetyService(checker or SafetyChecker())
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    listener.settimeout(min(SAFETY_SERVICE_IDLE, 60))
+    Thread(target=service.batch_loop, name="safety-batches", daemon=True).start()
+    out.write("ready\n")
+    out.close()
+    try:
+        while not service.idle():
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            Thread(target=service.handle_connection, args=(conn,), name="safety-connection", daemon=True).start()
+    finally:
+        listener.close()
+        os.unlink(path)
+        print("safety service: idle, exiting", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
@@ -14,31 +14,17 @@ from ldm.models.diffusion.ddim import DDIMSampler
 
 MAX_SIZE = 640
 
-# load safety model
-from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
-from transformers import AutoFeatureExtractor
 from imwatermark import WatermarkEncoder
 import cv2
-from model_process import child_process
+from model_process import child_process, input_file, save_output
+from safety_service import SafetyClient
 
-safety_model_id = "CompVis/stable-diffusion-safety-checker"
-safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
-safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+# nsfw checks run in the host's shared safety service
+safety = SafetyClient()
 wm = "StableDiffusionV1-Inpainting"
 wm_encoder = WatermarkEncoder()
 wm_encoder.set_watermark('bytes', wm.encode('utf-8'))
 
-def numpy_to_pil(images):
-    """
-    Convert a numpy image or a batch of images to a PIL image.
-    """
-    if images.ndim == 3:
-        images = images[None, ...]
-    images = (images * 255).round().astype("uint8")
-    pil_images = [Image.fromarray(image) for image in images]
-
-    return pil_images
-
 def put_watermark(img):
     if wm_encoder is not None:
         img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
@@ -46,12 +32,6 @@ def put_watermark(img):
         img = Image.fromarray(img[:, :, ::-1])
     return img
 
-def check_safety(x_image):
-    safety_checker_input = safety_feature_extractor(numpy_to_pil(x_image), return_tensors="pt")
-    x_checked_image, has_nsfw_concept = safety_checker(images=x_image, clip_input=safety_checker_input.pixel_values)
-    assert x_checked_image.shape[0] == len(has_nsfw_concept)
-    return x_checked_image, has_nsfw_concept
-
 
 def initialize_model(config, ckpt):
     config = OmegaConf.load(config)
@@ -94,7 +74,7 @@ def make_batch_sd(
     return batch
 
 
-def inpaint(sampler, image, mask, prompt, seed, scale, ddim_steps, num_samples, W, H, filename, negative_prompt):
+def inpaint(sampler, image, mask, prompt, seed, scale, ddim_steps, num_samples, W, H, filename, negative_prompt, output_shm=False):
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     model = sampler.model
 
@@ -146,12 +126,10 @@ def inpaint(sampler, image, mask, prompt, seed, scale, ddim_steps, num_samples,
             result = result.cpu().numpy().transpose(0,2,3,1)
 
             img = put_watermark(Image.fromarray((result[0]*255).astype(np.uint8)))
-            img.save(filename)
+            save_output(img, filename, output_shm)
 
-            _, has_nsfw_concept = check_safety(result)
-            if has_nsfw_concept[0]:
-                print("NSFW")
-        return has_nsfw_concept[0]
+            # a future, the next request can start sampling while it's checked
+            return safety.check(result[:1])
 
 _default_args = SimpleNamespace(
     prompt="a painting of a virus monster playing guitar",
@@ -161,6 +139,7 @@ _default_args = SimpleNamespace(
     ddim_steps=50,
     seed=42,
     num_samples=1,
+    output_shm=False,
 )
 
 class StableDiffusionInpaintingModel:
@@ -183,13 +162,11 @@ class StableDiffusionInpaintingModel:
         # mask = canvas_result.image_data
         # mask = mask[:, :, -1] > 0
         # if mask.sum() > 0:
-        assert os.path.isfile(args.image)
-        args.image = Image.open(args.image)
+        args.image = Image.open(input_file(args, "image"))
         # if not 512x512, resize
         if args.image.width != 512 or args.image.height != 512:
             args.image = args.image.resize((512, 512), Image.ANTIALIAS)
-        assert os.path.isfile(args.mask)
-        args.mask = Image.open(args.mask)
+        args.mask = Image.open(input_file(args, "mask"))
         # if not 512x512, resize
         if args.mask.width != 512 or args.mask.height != 512:
             args.mask = args.mask.resize((512, 512), Image.ANTIALIAS)
@@ -197,9 +174,17 @@ class StableDiffusionInpaintingModel:
         # Make args compatible with text2im version
         args.filename = os.path.join("images", args.filename)
         args.negative_prompt = ""
+        # already opened above
+        args.__dict__.pop("image_data", None)
+        args.__dict__.pop("mask_data", None)
 
-        inpaint(**args.__dict__)
+        return inpaint(**args.__dict__)
 
 
-if __name__ == "__main__":
+def main():
+    # entry point of the model process, also called by the fork server
     child_process(StableDiffusionInpaintingModel, "stable_diffusion_inpainting")
+
+
+if __name__ == "__main__":
+    main()
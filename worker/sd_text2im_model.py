@@ -23,9 +23,8 @@ from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 
-from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
-from transformers import AutoFeatureExtractor
-from model_process import child_process
+from model_process import child_process, input_file, save_output
+from safety_service import SafetyClient
 
 _default_args = SimpleNamespace(
     prompt="a painting of a virus monster playing guitar",
@@ -46,12 +45,11 @@ _default_args = SimpleNamespace(
     precision="autocast",
     init_img=None,
     strength=0.75,
+    output_shm=False,
 )
 
-# load safety model
-safety_model_id = "CompVis/stable-diffusion-safety-checker"
-safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
-safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+# nsfw checks run in the host's shared safety service
+safety = SafetyClient()
 
 
 def chunk(it, size):
@@ -59,18 +57,6 @@ def chunk(it, size):
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-def numpy_to_pil(images):
-    """
-    Convert a numpy image or a batch of images to a PIL image.
-    """
-    if images.ndim == 3:
-        images = images[None, ...]
-    images = (images * 255).round().astype("uint8")
-    pil_images = [Image.fromarray(image) for image in images]
-
-    return pil_images
-
-
 def load_model_from_config(config, ckpt, verbose=False):
     print(f"Loading model from {ckpt}")
     pl_sd = torch.load(ckpt, map_location="cpu")
@@ -121,17 +107,6 @@ def load_replacement(x):
         return x
 
 
-def check_safety(x_image):
-    safety_checker_input = safety_feature_extractor(numpy_to_pil(x_image), return_tensors="pt")
-    _, has_nsfw_concept = safety_checker(images=x_image, clip_input=safety_checker_input.pixel_values)
-    # assert x_checked_image.shape[0] == len(has_nsfw_concept)
-    for i in range(len(has_nsfw_concept)):
-        if has_nsfw_concept[i]:
-            return x_image, True
-    #         x_checked_image[i] = load_replacement(x_checked_image[i])
-    # # return x_checked_image, has_nsfw_concept
-    return x_image, False
-
 def load_model():
     config = OmegaConf.load(_default_args.config)
     return load_model_from_config(config, _default_args.ckpt)
@@ -182,8 +157,7 @@ class StableDiffusionText2ImageModel:
         if args.fixed_code:
             start_code = torch.randn([1, args.C, args.H // args.f, args.W // args.f], device=self.device)
         if args.image:
-            assert os.path.isfile(args.image)
-            init_image = load_img(args.image, args.W, args.H).to(torch.float16).to(self.device)
+            init_image = load_img(input_file(args, "image"), args.W, args.H).to(torch.float16).to(self.device)
             #TODO: is this needed?
             init_image = repeat(init_image, '1 ... -> b ...', b=1)
             init_latent = self.model.get_first_stage_encoding(self.model.encode_first_stage(init_image))  # move to latent space
@@ -221,7 +195,7 @@ class StableDiffusionText2ImageModel:
                                 x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
                                 
                                 outfilename = os.path.join(sample_path, args.filename)
-                                Image.fromarray(x_sample.astype(np.uint8)).save(outfilename)
+                                save_output(Image.fromarray(x_sample.astype(np.uint8)), outfilename, args.output_shm)
                                 print(f"Saved to {outfilename}")
                                 base_count += 1
                         else:
@@ -249,12 +223,11 @@ class StableDiffusionText2ImageModel:
                                 img = Image.fromarray(x_sample.astype(np.uint8))
                                 img = put_watermark(img, self.wm_encoder)
                                 
-                                img.save(os.path.join(sample_path, args.filename))
+                                save_output(img, os.path.join(sample_path, args.filename), args.output_shm)
                                 print(f"Saved to {os.path.join(sample_path, args.filename)}")
                                 base_count += 1
-                            _, has_nsfw_concept = check_safety(x_samples_ddim)
-                            if has_nsfw_concept:
-                                print("NSFW")
+                            # a future, the next request can start sampling while it's checked
+                            has_nsfw_concept = safety.check(x_samples_ddim)
 
                     # toc = time.time()
 
@@ -263,5 +236,10 @@ class StableDiffusionText2ImageModel:
         return has_nsfw_concept
 
 
+def main():
+    # entry point of the model process, also called by the fork server
+    child_process(StableDiffusionText2ImageModel, "stable_diffusion")
+
+
 if __name__ == "__main__":
-    child_process(StableDiffusionText2ImageModel, "stable_diffusion")
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,98 @@
+# Passes image bytes between the worker and its model / clip subprocesses
+# through shared memory instead of temp files. Args attributes ending in
+# "_data" (image_data, mask_data...) are copied into a shared memory block
+# and replaced by a {"shm": name, "size": n} reference in the json line sent
+# to the child, which copies them back out. Outputs go the other way: the
+# child puts the encoded result in a block and the parent reads it.
+# The side that reads a block unlinks it, except inputs, which the parent
+# unlinks once the child has replied.
+# If shared memory can't be used (no /dev/shm, or it's full) the bytes are
+# written to the matching path attribute instead (image_data -> image),
+# which is what the child reads when the "_data" attribute is missing.
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Tuple
+
+DATA_SUFFIX = "_data"
+
+
+def _untrack(shm: SharedMemory):
+    # python < 3.13 registers every block with this process's resource
+    # tracker, which would unlink it when the process exits. Blocks handed
+    # to the other process are its responsibility.
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def put_bytes(data, untrack: bool = False) -> Tuple[Optional[dict], Optional[SharedMemory]]:
+    # returns (reference, block), or (None, None) when shared memory isn't available
+    size = len(data)
+    if size == 0:
+        return None, None
+    try:
+        shm = SharedMemory(create=True, size=size)
+    except OSError as err:
+        print(f"Shared memory unavailable, falling back to files: {err}")
+        return None, None
+    shm.buf[:size] = data
+    if untrack:
+        _untrack(shm)
+    return {"shm": shm.name, "size": size}, shm
+
+
+def take_bytes(ref: dict, unlink: bool) -> bytes:
+    shm = SharedMemory(name=ref["shm"])
+    try:
+        data = bytes(shm.buf[:ref["size"]])
+    finally:
+        shm.close()
+    if unlink:
+        shm.unlink()
+    else:
+        _untrack(shm)
+    return data
+
+
+def is_ref(value) -> bool:
+    return isinstance(value, dict) and "shm" in value
+
+
+def encode_args(args: dict) -> Tuple[dict, List[SharedMemory]]:
+    # parent side: moves "_data" bytes into shared memory, or to their fallback path
+    encoded = dict(args)
+    blocks = []
+    for key, value in args.items():
+        if not key.endswith(DATA_SUFFIX) or not isinstance(value, (bytes, bytearray, memoryview)):
+            continue
+        ref, shm = put_bytes(value)
+        if ref:
+            encoded[key] = ref
+            blocks.append(shm)
+            continue
+        del encoded[key]
+        path = args.get(key[:-len(DATA_SUFFIX)])
+        if not path:
+            raise Exception(f"No fallback path for {key}")
+        with open(path, "wb") as f:
+            f.write(value)
+    return encoded, blocks
+
+
+def decode_args(args: dict) -> dict:
+    # child side: copies "_data" references back out, the parent unlinks the blocks
+    for key, value in args.items():
+        if key.endswith(DATA_SUFFIX) and is_ref(value):
+            args[key] = take_bytes(value, unlink=False)
+    return args
+
+
+def release(blocks: List[SharedMemory]):
+    for shm in blocks:
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
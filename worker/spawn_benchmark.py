@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+
+# Spawn-to-ready time of model processes started with Popen (a fresh
+# interpreter, the cold start without the fork server) against processes
+# forked from the fork server, with the stub model on cpu.
+# STUB_MODEL_IMPORTS sets the modules the stub imports, e.g.
+# "torch,transformers,diffusers" for the imports of the stable diffusion models.
+# Usage: python spawn_benchmark.py [iterations]
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+# the fork server imports what the stub would
+os.environ.setdefault("FORK_SERVER_PRELOAD", os.environ.get("STUB_MODEL_IMPORTS", "") + ",stub_model")
+
+import fork_server
+from model_process import ModelProcess
+
+
+def bench(label: str):
+    ready = []
+    for _ in range(iterations):
+        model = ModelProcess("stub_model.py", "cpu")
+        ready.append(model.load().ready_seconds)
+        model.close()
+    ready.sort()
+    print(f"{label}: p50 {ready[len(ready) // 2] * 1000:.0f} ms, max {ready[-1] * 1000:.0f} ms")
+
+
+fork_server.FORK_SERVER = False
+bench("popen")
+
+start = time.time()
+fork_server.start()
+print(f"fork server startup: {(time.time() - start) * 1000:.0f} ms (once per worker)")
+fork_server.FORK_SERVER = True
+bench("forked")
@@ -0,0 +1,157 @@
+# Local stand-in for the parts of the backend API that workers talk to.
+# Used by the benchmark scripts; it is not a faithful backend, just enough
+# of /process-image, image records and presigned S3 urls to drive a worker
+# client at full speed without a database.
+# Configurable options:
+#  backlog: how many pending images to start with
+#  latency: seconds of simulated backend latency per request
+#  image_size: size in bytes of the stored image payloads
+
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+
+def stub_image(image_id: str, model: str = "stable_diffusion") -> dict:
+    # shaped like a real image record returned by /process-image
+    return {
+        "id": image_id,
+        "created_at": int(time.time() * 1000),
+        "created_by": "stub-user",
+        "updated_at": int(time.time() * 1000),
+        "label": "",
+        "parent": "",
+        "phrases": ["a painting of a cat", "highly detailed"],
+        "negative_phrases": ["blurry"],
+        "iterations": 50,
+        "current_iterations": 0,
+        "score": 0,
+        "negative_score": 0,
+        "status": "processing",
+        "model": model,
+        "width": 512,
+        "height": 512,
+        "stable_diffusion_strength": 0.75,
+        "nsfw": False,
+        "temporary": False,
+        "params": {"prompt": "a painting of a cat", "steps": 50, "cfg_scale": 7.5},
+    }
+
+
+class StubBackend(object):
+    def __init__(self, port: int = 0, backlog: int = 0, latency: float = 0, image_size: int = 256 * 1024):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.pending = [str(uuid4()) for _ in range(backlog)]
+        self.images = {}
+        self.objects = {}
+        self.image_payload = b"\x89PNG" + b"\0" * max(0, image_size - 4)
+        self.request_count = 0
+        self.claim_calls = 0
+        self.claimed = 0
+        self.ping_count = 0
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                backend._handle(self, "GET")
+
+            def do_PUT(self):
+                backend._handle(self, "PUT")
+
+            def do_POST(self):
+                backend._handle(self, "POST")
+
+            def do_PATCH(self):
+                backend._handle(self, "PATCH")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> "StubBackend":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_pending(self, count: int):
+        with self.lock:
+            self.pending.extend(str(uuid4()) for _ in range(count))
+
+    def _claim(self, body: dict):
+        limit = body.get("limit")
+        with self.lock:
+            self.claim_calls += 1
+            if body.get("ping"):
+                self.ping_count += 1
+            count = 1 if limit is None else limit
+            ids = self.pending[:count]
+            if not body.get("peek"):
+                del self.pending[:count]
+                self.claimed += len(ids)
+        images = [stub_image(image_id) for image_id in ids]
+        if limit is None:
+            return images[0] if images else None
+        return images
+
+    def _route(self, method: str, path: str, body: bytes):
+        if path.startswith("/s3/"):
+            if method == "PUT":
+                self.objects[path] = body
+                return 200, b"", "text/plain"
+            return 200, self.objects.get(path, self.image_payload), "image/png"
+        payload = json.loads(body) if body else None
+        if path == "/api/process-image":
+            result = self._claim(payload or {})
+        elif path == "/api/worker-ping":
+            with self.lock:
+                self.ping_count += 1
+            result = None
+        elif path == "/api/metrics":
+            result = None
+        elif path.endswith("/download-urls") or path.endswith("/upload-urls"):
+            image_id = path.split("/")[3]
+            result = {
+                "image_url": f"{self.url}/s3/{image_id}.image.png",
+                "mask_url": f"{self.url}/s3/{image_id}.mask.png",
+                "thumbnail_url": f"{self.url}/s3/{image_id}.thumbnail.png",
+            }
+        elif path.startswith("/api/images/"):
+            image_id = path.split("/")[3]
+            result = self.images.get(image_id) or stub_image(image_id)
+            if method == "PATCH":
+                result = {**result, **payload}
+                self.images[image_id] = result
+        else:
+            return 404, b"not found", "text/plain"
+        return 200, json.dumps(result).encode(), "application/json"
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        with self.lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        status, data, content_type = self._route(method, handler.path, body)
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
@@ -0,0 +1,47 @@
+import importlib
+import os
+import time
+
+from model_process import child_process, input_file, save_output
+
+# Stand-in model for exercising ModelProcess on cpu, without torch or weights.
+# Echoes its input image back as the output (or returns output_size zero
+# bytes when there's no input), after an optional delay.
+# Usage: ModelProcess("stub_model.py", "cpu")
+# Configurable options:
+#  STUB_MODEL_DELAY: seconds each generate takes
+#  STUB_MODEL_IMPORTS: comma separated modules to import, like a real model's startup
+
+STUB_MODEL_DELAY = float(os.environ.get("STUB_MODEL_DELAY", "0"))
+STUB_MODEL_IMPORTS = os.environ.get("STUB_MODEL_IMPORTS", "")
+
+for _module in STUB_MODEL_IMPORTS.split(","):
+    if _module:
+        importlib.import_module(_module)
+
+
+class StubModel(object):
+    def generate(self, args):
+        if STUB_MODEL_DELAY:
+            time.sleep(STUB_MODEL_DELAY)
+        if getattr(args, "image_data", None) or getattr(args, "image", None):
+            source = input_file(args, "image")
+            if isinstance(source, str):
+                with open(source, "rb") as f:
+                    output = f.read()
+            else:
+                output = source.getvalue()
+        else:
+            output = bytes(getattr(args, "output_size", 0))
+        if output:
+            save_output(output, getattr(args, "output_image", None), getattr(args, "output_shm", False))
+        return getattr(args, "nsfw", False)
+
+
+def main():
+    # entry point of the model process, also called by the fork server
+    child_process(StubModel, "stub")
+
+
+if __name__ == "__main__":
+    main()
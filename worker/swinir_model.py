@@ -9,10 +9,10 @@ import math
 from collections import OrderedDict
 import os
 import torch
-import requests
 import PIL
 
-from model_process import child_process
+from model_process import child_process, input_file, save_output
+from fileutil import download_file
 
 from swinir.models.network_swinir import SwinIR as net
 from swinir.utils import util_calculate_psnr_ssim as util
@@ -49,9 +49,9 @@ class SwinIRModel:
             if model_folder != "":
                 os.makedirs(os.path.dirname(model_args.model_path), exist_ok=True)
             url = 'https://github.com/JingyunLiang/SwinIR/releases/download/v0.0/{}'.format(os.path.basename(model_args.model_path))
-            r = requests.get(url, allow_redirects=True)
             print(f'downloading model {model_args.model_path}')
-            open(model_args.model_path, 'wb').write(r.content)
+            # streamed to disk, resumes with range requests if interrupted
+            download_file(url, model_args.model_path)
         self.model = load_model()
         self.model = self.model.to(self.device)
 
@@ -59,7 +59,10 @@ class SwinIRModel:
         init_image = args.init_image
         output_image = args.output_image
         # read image
-        img_lq = read_image(init_image)  # image to HWC-BGR, float32
+        if getattr(args, "init_image_data", None):
+            img_lq = decode_image(args.init_image_data)  # image to HWC-BGR, float32
+        else:
+            img_lq = read_image(init_image)  # image to HWC-BGR, float32
         img_lq = np.transpose(img_lq if img_lq.shape[2] == 1 else img_lq[:, :, [2, 1, 0]], (2, 0, 1))  # HCW-BGR to CHW-RGB
         img_lq = torch.from_numpy(img_lq).float().unsqueeze(0).to(self.device)  # CHW-RGB to NCHW-RGB
 
@@ -79,10 +82,10 @@ class SwinIRModel:
         if output.ndim == 3:
             output = np.transpose(output[[2, 1, 0], :, :], (1, 2, 0))  # CHW-RGB to HCW-BGR
         output = (output * 255.0).round().astype(np.uint8)  # float32 to uint8
-        cv2.imwrite(output_image, output)
+        save_output(cv2.imencode(".png", output)[1].tobytes(), output_image, getattr(args, "output_shm", False))
         return False
 
-    def _split_image(self, init_image: str):
+    def _split_image(self, init_image: str, tile_folder: str):
         img = PIL.Image.open(init_image)
         # Check if the image area is larger than 640x640
         if img.width * img.height > 512 * 512:
@@ -105,7 +108,7 @@ class SwinIRModel:
                     # crop the tile
                     tile = img.crop((x0, y0, x1, y1))
                     # save the tile
-                    tile.save(os.path.join(folder, f"{x}_{y}.png"))
+                    tile.save(os.path.join(tile_folder, f"{x}_{y}.png"))
             # return num_tiles_x, num_tiles_y, tile_size
             return SimpleNamespace(
                 num_tiles_x=num_tiles_x,
@@ -117,31 +120,37 @@ class SwinIRModel:
         else:
             return None
 
-    def _merge_tiles(self, split_result: SimpleNamespace, output_image: str):
+    def _merge_tiles(self, split_result: SimpleNamespace, output_image: str, tile_folder: str, in_memory: bool):
         # create a new image
         img = PIL.Image.new("RGB", (split_result.image_width, split_result.image_height))
         for x in range(split_result.num_tiles_x):
             for y in range(split_result.num_tiles_y):
                 # load the tile
-                tile = PIL.Image.open(os.path.join(folder, f"{x}_{y}.png"))
+                tile = PIL.Image.open(os.path.join(tile_folder, f"{x}_{y}.png"))
                 # paste the tile into the new image
                 img.paste(tile, (x * (split_result.tile_size - 32), y * (split_result.tile_size - 32)))
         # save the new image
-        img.save(output_image)
+        save_output(img, output_image, in_memory)
 
     def generate(self, args):
-        init_image = args.init_image
+        init_image = input_file(args, "init_image")
         output_image = args.output_image
-        split_result = self._split_image(init_image)
+        in_memory = getattr(args, "output_shm", False)
+        # tiles go next to the output, so concurrent jobs don't overwrite each other's
+        tile_folder = os.path.dirname(output_image) or folder
+        split_result = self._split_image(init_image, tile_folder)
         if not split_result:
             return self._generate_image(args)
         else:
+            # tiles are read and written as files, only the merged image is handed back
+            args.init_image_data = None
+            args.output_shm = False
             for x in range(split_result.num_tiles_x):
                 for y in range(split_result.num_tiles_y):
-                    args.init_image = os.path.join(folder, f"{x}_{y}.png")
-                    args.output_image = os.path.join(folder, f"{x}_{y}_out.png")
+                    args.init_image = os.path.join(tile_folder, f"{x}_{y}.png")
+                    args.output_image = os.path.join(tile_folder, f"{x}_{y}_out.png")
                     self._generate_image(args)
-            self._merge_tiles(split_result, output_image)
+            self._merge_tiles(split_result, output_image, tile_folder, in_memory)
             return False
 
 def define_model(model_args):
@@ -168,11 +177,19 @@ def read_image(path):
     # 003 real-world image sr (load lq image only)
     return cv2.imread(path, cv2.IMREAD_COLOR).astype(np.float32) / 255.
 
+def decode_image(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR).astype(np.float32) / 255.
+
 def test(img_lq, model):
     # test the image as a whole
     output = model(img_lq)
 
     return output
 
-if __name__ == "__main__":
+def main():
+    # entry point of the model process, also called by the fork server
     child_process(SwinIRModel, "swinir")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import time
+from queue import Queue
+from threading import Event, Thread
+from types import SimpleNamespace
+
+from model_cache import ModelCache
+
+GB = 1024 ** 3
+
+
+class FakeModel(object):
+    def __init__(self, name: str, memory: "FakeMemory", footprint: int, close_delay: float = 0):
+        self.name = name
+        self.memory = memory
+        self.footprint = footprint
+        self.close_delay = close_delay
+        self.alive = True
+        self.forked = False
+        self.in_flight = 0
+
+    def load(self):
+        self.memory.free -= self.footprint
+        return SimpleNamespace(ready_seconds=0.0, duration_seconds=0.0)
+
+    def close(self):
+        time.sleep(self.close_delay)
+        self.memory.free += self.footprint
+        self.alive = False
+
+
+class FakeMemory(object):
+    def __init__(self, free: int):
+        self.free = free
+
+    def __call__(self) -> int:
+        return self.free
+
+
+def make_cache(free: int = 100 * GB, max_models: int = 2, footprint: int = GB, close_delay: float = 0):
+    memory = FakeMemory(free)
+    created = []
+
+    def create_model(name: str):
+        model = FakeModel(name, memory, footprint, close_delay)
+        created.append(model)
+        return model
+
+    return ModelCache(create_model, memory, Queue(), max_models=max_models, reserve=GB), created, memory
+
+
+def test_hits_reuse_the_warm_process():
+    cache, created, _ = make_cache()
+    first = cache.get("a")
+    assert cache.get("a") is first
+    assert len(created) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evicts_least_recently_used_over_the_limit():
+    cache, created, _ = make_cache(max_models=2)
+    a = cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert cache.stats().warm == ["a", "c"]
+    assert not created[1].alive
+    assert a.alive
+    assert cache.evictions == 1
+
+
+def test_evicts_until_the_model_fits_in_memory():
+    # 3GB left after two models, "c" needs 4GB plus the 1GB reserve
+    cache, created, memory = make_cache(free=5 * GB, max_models=3, footprint=GB)
+    cache.footprints.update(a=GB, b=GB, c=4 * GB)
+    cache.get("a")
+    cache.get("b")
+    cache.get("c")
+    assert cache.stats().warm == ["c"]
+    assert memory.free == 4 * GB
+
+
+def test_eviction_does_not_block_other_lookups():
+    cache, _, _ = make_cache(max_models=2, close_delay=0.5)
+    cache.get("a")
+    cache.get("b")
+    loader = Thread(target=cache.get, args=("c",))
+    loader.start()
+    time.sleep(0.1)
+    # "a" is being closed, looking up "b" doesn't wait for it
+    start = time.time()
+    cache.get("b")
+    assert time.time() - start < 0.2
+    loader.join()
+    assert cache.stats().warm == ["b", "c"]
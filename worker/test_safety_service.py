@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+from threading import Thread
+
+import numpy as np
+
+import safety_service
+
+WORKER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# a service whose checker either flags everything or kills the service mid-check
+SERVICE = """
+import os, sys, time
+import safety_service
+
+class Checker(object):
+    def check(self, images):
+        if sys.argv[2] == "die":
+            time.sleep(0.2)
+            os._exit(1)
+        return [True] * len(images)
+
+safety_service.serve(sys.argv[1], Checker())
+"""
+
+
+class LocalChecker(object):
+    def check(self, images):
+        return [False] * len(images)
+
+
+def start_service(path: str, mode: str) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, "-c", SERVICE, path, mode], cwd=WORKER_DIR,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    assert process.stdout.readline().strip() == b"ready"
+    return process
+
+
+def check_concurrently(client: safety_service.SafetyClient, n: int) -> list:
+    futures = [None] * n
+
+    def check(i):
+        futures[i] = client.check(np.zeros((1, 8, 8, 3), dtype=np.uint8))
+
+    threads = [Thread(target=check, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [future.result(timeout=10) for future in futures]
+
+
+def use_services(monkeypatch, tmp_path, *modes) -> list:
+    # each new connection of the client goes to the next service
+    paths = [str(tmp_path / f"safety-{i}.sock") for i in range(len(modes))]
+    processes = [start_service(path, mode) for path, mode in zip(paths, modes)]
+    connect = safety_service._connect
+    remaining = iter(paths)
+    monkeypatch.setattr(safety_service, "_connect", lambda path: connect(next(remaining)))
+    monkeypatch.setattr(safety_service, "SafetyChecker", LocalChecker)
+    return processes
+
+
+def test_checks_pending_when_the_service_dies_are_retried(monkeypatch, tmp_path):
+    processes = use_services(monkeypatch, tmp_path, "die", "ok")
+    try:
+        assert check_concurrently(safety_service.SafetyClient(), 16) == [True] * 16
+    finally:
+        for process in processes:
+            process.kill()
+
+
+def test_checks_run_in_process_when_the_retry_fails_too(monkeypatch, tmp_path):
+    processes = use_services(monkeypatch, tmp_path, "die", "die", "die", "die")
+    try:
+        assert check_concurrently(safety_service.SafetyClient(), 16) == [False] * 16
+    finally:
+        for process in processes:
+            process.kill()
@@ -0,0 +1,97 @@
+import time
+from queue import Queue
+from threading import Event, Thread
+from types import SimpleNamespace
+
+from update_coalescer import UpdateCoalescer
+
+
+class RecordingTarget(object):
+    def __init__(self):
+        self.updates = []
+
+    def put(self, update):
+        self.updates.append(update)
+
+
+def update(image_id: str, status: str) -> SimpleNamespace:
+    return SimpleNamespace(id=image_id, status=status)
+
+
+def test_completed_replaces_pending_processing():
+    target = RecordingTarget()
+    metrics = Queue()
+    coalescer = UpdateCoalescer(target, metrics, delay=10)
+    coalescer.start()
+    coalescer.put(update("a", "processing"))
+    coalescer.put(update("a", "completed"))
+    coalescer.put(None)
+    coalescer.join()
+    assert [(u.id, u.status) for u in target.updates if u] == [("a", "completed")]
+    assert coalescer.saved == 1
+    assert metrics.get_nowait().attributes == [{"name": "status", "value": "processing"}]
+
+
+def test_processing_is_sent_after_the_delay():
+    target = RecordingTarget()
+    coalescer = UpdateCoalescer(target, Queue(), delay=0.05)
+    coalescer.start()
+    coalescer.put(update("a", "processing"))
+    time.sleep(0.2)
+    coalescer.put(update("a", "completed"))
+    coalescer.put(None)
+    coalescer.join()
+    assert [u.status for u in target.updates if u] == ["processing", "completed"]
+    assert coalescer.saved == 0
+
+
+def test_full_target_blocks_only_the_caller():
+    release = Event()
+
+    class BlockingTarget(RecordingTarget):
+        def put(self, update):
+            if update is not None and update.id == "slow":
+                release.wait()
+            super().put(update)
+
+    target = BlockingTarget()
+    coalescer = UpdateCoalescer(target, Queue(), delay=10)
+    coalescer.start()
+    producer = Thread(target=coalescer.put, args=(update("slow", "completed"),))
+    producer.start()
+    time.sleep(0.05)
+    # neither other producers nor qsize wait for the blocked hand-off
+    coalescer.put(update("b", "processing"))
+    assert coalescer.qsize() == 1
+    release.set()
+    producer.join()
+    coalescer.put(None)
+    coalescer.join()
+    assert [u.id for u in target.updates if u] == ["slow", "b"]
+
+
+def test_update_waits_for_its_image_being_flushed():
+    flushing = Event()
+    release = Event()
+
+    class SlowTarget(RecordingTarget):
+        def put(self, update):
+            if update is not None and update.status == "processing":
+                flushing.set()
+                release.wait()
+            super().put(update)
+
+    target = SlowTarget()
+    coalescer = UpdateCoalescer(target, Queue(), delay=0.01)
+    coalescer.start()
+    coalescer.put(update("a", "processing"))
+    flushing.wait(1)
+    producer = Thread(target=coalescer.put, args=(update("a", "completed"),))
+    producer.start()
+    time.sleep(0.05)
+    assert target.updates == []
+    release.set()
+    producer.join()
+    coalescer.put(None)
+    coalescer.join()
+    assert [u.status for u in target.updates if u] == ["processing", "completed"]
@@ -0,0 +1,193 @@
+# Per-job tracing across the worker's stages: claim, queue waits, download,
+# generate, encode, clip ranking and upload. start_trace() gives a claimed
+# image a trace id, and every stage it passes through records a span with
+# its wall time and the CPU time of the thread that ran it.
+# Spans go to the metrics pipeline as "worker.stage" (stage and model as
+# dimensions), and to a JSONL file when TRACE_FILE is set, written by a
+# background thread. end_trace() records the whole job as the "job" stage.
+# The current span is tracked per thread (a contextvar), so code that doesn't
+# know about jobs, like the api client, opens spans that join the job's
+# trace. Outside of a trace span() does nothing.
+# Configurable options (env vars):
+#  TRACE_FILE: JSONL file to append spans to, unset to only emit metrics
+
+import contextvars
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+from queue import Queue
+from threading import Lock, Thread
+from types import SimpleNamespace
+from uuid import uuid4
+
+TRACE_FILE = os.environ.get("TRACE_FILE")
+# traces that never end (failed jobs) are forgotten past this many
+MAX_TRACES = 4096
+
+_lock = Lock()
+_traces = OrderedDict()
+_span_ids = itertools.count(1)
+_current = contextvars.ContextVar("span", default=None)
+_writer = None
+_observers = []
+
+
+class Trace(object):
+    __slots__ = ("id", "model", "metrics_queue", "start")
+
+    def __init__(self, model: str, metrics_queue: Queue, start: float = None):
+        self.id = uuid4().hex[:16]
+        self.model = model
+        self.metrics_queue = metrics_queue
+        self.start = start or time.time()
+
+
+class Span(object):
+    __slots__ = ("trace", "name", "attributes", "id", "parent_id", "start", "_cpu_start", "_token")
+
+    def __init__(self, trace: Trace, name: str, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.id = None
+        self.parent_id = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        parent = _current.get()
+        self.parent_id = parent.id if parent is not None and parent.trace is self.trace else None
+        self.id = next(_span_ids)
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time()
+        cpu_seconds = time.thread_time() - self._cpu_start
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        _export(self.trace, self.name, self.start, end, cpu_seconds, self.attributes, self.id, self.parent_id)
+        return False
+
+
+class _NoSpan(object):
+    def set(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def add_observer(callback: callable):
+    # callback(stage, model, duration_seconds) for every span, on the thread that ended it
+    _observers.append(callback)
+
+
+def start_trace(metrics_queue: Queue, model: str, start: float = None) -> str:
+    trace = Trace(model, metrics_queue, start)
+    with _lock:
+        _traces[trace.id] = trace
+        while len(_traces) > MAX_TRACES:
+            _traces.popitem(last=False)
+    return trace.id
+
+
+def end_trace(trace_id: str, **attributes):
+    with _lock:
+        trace = _traces.pop(trace_id, None) if trace_id else None
+    if trace is not None:
+        _export(trace, "job", trace.start, time.time(), None, attributes, next(_span_ids), None)
+
+
+def current_trace() -> str:
+    span = _current.get()
+    return span.trace.id if span is not None else None
+
+
+def span(name: str, trace_id: str = None, **attributes):
+    # with span("encode", image.trace_id): ... Without a trace id the span joins
+    # the current one, if any
+    trace = _get_trace(trace_id)
+    if trace is None:
+        return _NO_SPAN
+    return Span(trace, name, attributes)
+
+
+def record(name: str, trace_id: str, start: float, end: float, cpu_seconds: float = None, **attributes):
+    # a span measured elsewhere, like a queue wait between two timestamps or
+    # the inference time reported by the model process
+    trace = _get_trace(trace_id)
+    if trace is not None and start is not None:
+        parent = _current.get()
+        parent_id = parent.id if parent is not None and parent.trace is trace else None
+        _export(trace, name, start, end, cpu_seconds, attributes, next(_span_ids), parent_id)
+
+
+def _get_trace(trace_id: str) -> Trace:
+    if trace_id is None:
+        span = _current.get()
+        return span.trace if span is not None else None
+    with _lock:
+        return _traces.get(trace_id)
+
+
+def _export(trace: Trace, name: str, start: float, end: float, cpu_seconds: float, attributes: dict, span_id: int, parent_id: int):
+    metric_attributes = [
+        {"name": "stage", "value": name},
+        {"name": "model", "value": trace.model},
+        {"name": "duration_seconds", "value": end - start},
+    ]
+    if cpu_seconds is not None:
+        metric_attributes.append({"name": "cpu_seconds", "value": cpu_seconds})
+    # only low-cardinality attributes become metric dimensions
+    metric_attributes.extend({"name": key, "value": v} for key, v in attributes.items() if isinstance(v, (str, bool)))
+    trace.metrics_queue.put(SimpleNamespace(name="worker.stage", type="count", value=1, attributes=metric_attributes))
+    for observe in _observers:
+        observe(name, trace.model, end - start)
+    if TRACE_FILE:
+        _write({
+            "trace_id": trace.id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "model": trace.model,
+            "start": start,
+            "duration_seconds": end - start,
+            "cpu_seconds": cpu_seconds,
+            **attributes,
+        })
+
+
+def _write(entry: dict):
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = Queue()
+                Thread(target=_write_loop, args=(_writer, TRACE_FILE), name="trace-writer", daemon=True).start()
+    _writer.put(entry)
+
+
+def _write_loop(entries: Queue, path: str):
+    with open(path, "a") as f:
+        while True:
+            lines = [entries.get()]
+            while not entries.empty():
+                lines.append(entries.get())
+            try:
+                f.write("".join(json.dumps(line, default=str) + "\n" for line in lines))
+                f.flush()
+            except Exception as err:
+                print(f"Error writing traces: {err}")
@@ -0,0 +1,120 @@
+# Debounces "processing" status updates in front of the upload pool.
+# A "processing" update is held for a short delay before it's sent; if the
+# job finishes first, the "completed" update replaces it and the "processing"
+# PATCH is never sent. A newer pending update for the same image replaces an
+# older one. Any other update is forwarded right away, after dropping whatever
+# is still pending for that image, so updates are never reordered.
+# The target is called outside the lock: a full upload queue only blocks the
+# thread handing it an update, and an update waits for a "processing" update
+# of the same image that's being flushed, to keep the order per image.
+# Configurable options:
+#  delay: seconds to hold "processing" updates (UPDATE_DEBOUNCE_SECONDS env var), 0 disables
+# Emits a "worker.update.coalesced" metric for each update that was dropped.
+
+import os
+import time
+from queue import Queue
+from threading import Condition, Thread
+from types import SimpleNamespace
+
+UPDATE_DEBOUNCE_SECONDS = float(os.environ.get("UPDATE_DEBOUNCE_SECONDS", "2"))
+
+DEBOUNCED_STATUSES = ("processing",)
+
+
+class UpdateCoalescer(object):
+    def __init__(self, target, metrics_queue: Queue, delay: float = UPDATE_DEBOUNCE_SECONDS):
+        # target is anything with put(), normally an UploadPool
+        self.target = target
+        self.metrics_queue = metrics_queue
+        self.delay = delay
+        # image id -> (update, deadline), in deadline order
+        self._pending = {}
+        self._cond = Condition()
+        # image ids the flush loop is handing to the target right now
+        self._flushing = set()
+        self._stopped = False
+        self.saved = 0
+        self.thread = Thread(target=self._flush_loop, name="update-coalescer")
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def put(self, update):
+        if update is None:
+            self._stop()
+            return
+        dropped = None
+        forward = False
+        with self._cond:
+            pending = self._pending.get(update.id)
+            if update.status in DEBOUNCED_STATUSES and self.delay > 0:
+                if pending:
+                    # keep the original deadline, the newer update goes out in its place
+                    dropped = pending[0]
+                    self._pending[update.id] = (update, pending[1])
+                else:
+                    self._pending[update.id] = (update, time.time() + self.delay)
+                    self._cond.notify_all()
+            else:
+                if pending:
+                    dropped = pending[0]
+                    del self._pending[update.id]
+                # a pending update the flush loop already took must reach the target first
+                while update.id in self._flushing:
+                    self._cond.wait()
+                forward = True
+            if dropped:
+                self.saved += 1
+        # outside the lock, the target blocks while its queues are full
+        if forward:
+            self.target.put(update)
+        if dropped:
+            self.metrics_queue.put(SimpleNamespace(name="worker.update.coalesced", type="count", value=1, attributes=[
+                {"name": "status", "value": dropped.status},
+            ]))
+
+    def qsize(self) -> int:
+        # updates held back, not yet passed on
+        with self._cond:
+            return len(self._pending)
+
+    def _stop(self):
+        # pending updates are sent before the upload pool is stopped
+        with self._cond:
+            updates = [update for update, _ in self._pending.values()]
+            self._pending.clear()
+            self._stopped = True
+            self._cond.notify_all()
+        # an update the flush loop is handing over goes first
+        if self.thread.is_alive():
+            self.thread.join()
+        for update in updates:
+            self.target.put(update)
+        self.target.put(None)
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._pending:
+                        image_id, (update, deadline) = next(iter(self._pending.items()))
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+                del self._pending[image_id]
+                self._flushing.add(image_id)
+            try:
+                self.target.put(update)
+            finally:
+                with self._cond:
+                    self._flushing.discard(image_id)
+                    self._cond.notify_all()
@@ -0,0 +1,92 @@
+# Parallel upload stage. Replaces the single update_loop thread with a pool of
+# uploader threads, each draining its own queue. Updates are sharded by image
+# id, so updates for the same image ("processing" then "completed") are always
+# sent in order by the same thread, while different images upload in parallel.
+# It has the same put() interface as the update queue it replaces, including
+# put(None) to stop.
+# Configurable options:
+#  workers: number of uploader threads (UPLOAD_THREADS env var)
+#  queue_size: bound of each uploader's queue, producers block when it's full
+# Emits a "worker.update" metric per update with the upload duration, the time
+# it waited in the queue and how many uploaders were busy, and the
+# "upload_queue_wait" and "upload" spans of traced updates.
+
+import os
+import time
+import zlib
+from queue import Queue
+from threading import Lock, Thread
+from types import SimpleNamespace
+
+import tracing
+
+UPLOAD_THREADS = int(os.environ.get("UPLOAD_THREADS", "4"))
+
+
+class UploadPool(object):
+    def __init__(self, handler: callable, metrics_queue: Queue, on_error: callable, workers: int = UPLOAD_THREADS, queue_size: int = 4):
+        self.handler = handler
+        self.metrics_queue = metrics_queue
+        self.on_error = on_error
+        self.workers = workers
+        self.shards = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [
+            Thread(target=self._upload_loop, args=(shard,), name=f"upload-{i}")
+            for i, shard in enumerate(self.shards)
+        ]
+        self._lock = Lock()
+        self._busy = 0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def put(self, update):
+        if update is None:
+            for shard in self.shards:
+                shard.put(None)
+            return
+        self.shards[self.shard_index(update.id)].put((update, time.time()))
+
+    def shard_index(self, image_id: str) -> int:
+        # stable across processes, unlike hash()
+        return zlib.crc32(image_id.encode()) % self.workers
+
+    @property
+    def busy(self) -> int:
+        with self._lock:
+            return self._busy
+
+    def qsize(self) -> int:
+        return sum(shard.qsize() for shard in self.shards)
+
+    def _upload_loop(self, shard: Queue):
+        while True:
+            item = shard.get()
+            if item is None:
+                return
+            update, queued_at = item
+            start = time.time()
+            with self._lock:
+                self._busy += 1
+                busy = self._busy
+            trace_id = getattr(update, "trace_id", None)
+            tracing.record("upload_queue_wait", trace_id, queued_at, start)
+            try:
+                with tracing.span("upload", trace_id, status=update.status):
+                    self.handler(update)
+                self.metrics_queue.put(SimpleNamespace(name="worker.update", type="count", value=1, attributes=[
+                    {"name": "duration_seconds", "value": time.time() - start},
+                    {"name": "wait_seconds", "value": start - queued_at},
+                    {"name": "busy_uploaders", "value": busy},
+                    {"name": "uploaders", "value": self.workers},
+                ]))
+            except Exception as e:
+                self.on_error(e, "update_loop")
+            finally:
+                with self._lock:
+                    self._busy -= 1
@@ -10,6 +10,17 @@ from uuid import uuid4
 
 import torch
 from api_client import AIBrushAPI
+from claim_loop import claim_images, free_slots
+from metrics_aggregator import MetricsAggregator, METRICS_FLUSH_INTERVAL
+from metrics_buffer import MetricsBuffer
+from metrics_endpoint import metrics_endpoint, pipeline_samples, sample
+from poll_scheduler import PollScheduler
+from prefetch_stage import PrefetchStage
+from records import ImageUpdate
+import tracing
+from update_coalescer import UpdateCoalescer
+from upload_pool import UploadPool
+from workspace import job_path, remove_job_dir, start_sweeper
 import base64
 import traceback
 from PIL import Image
@@ -18,14 +29,13 @@ from io import BytesIO
 
 # import clip_rank
 from clip_process import ClipProcess
-from model_process import ModelProcess
+from model_process import ModelProcess, pipeline_depth
 # from sd_text2im_model import StableDiffusionText2ImageModel, load_model as load_sd_model
 # from swinir_model import SwinIRModel
 # from glid_3_xl_model import generate_model_signature
 from memutil import get_free_memory
 from torch import device
-from apisocket import ApiSocket
-import asyncio
+from apisocket import shared_socket
 import bugsnag
 from errorkillswitch import ErrorKillSwitch
 
@@ -82,27 +92,8 @@ for folder in ["images", "output", "output_npy"]:
 
 
 def cleanup(image_id: str):
-    # delete all files in the current folder ending in .png or .backup
-    for fname in os.listdir("images"):
-        _cleanup_file(image_id, os.path.join("images", fname))
-    for fname in os.listdir("output"):
-        _cleanup_file(image_id, os.path.join("output", fname))
-    for fname in os.listdir("output_npy"):
-        _cleanup_file(image_id, os.path.join("output_npy", fname))
-    if os.path.exists("results"):
-        for fname in os.listdir(os.path.join("results", "swinir_real_sr_x4")):
-            _cleanup_file(image_id, os.path.join("results", "swinir_real_sr_x4", fname))
-
-
-def _cleanup_file(image_id: str, file_path: str):
-    is_old = time.time() - os.path.getmtime(file_path) > 3600
-    match = image_id in file_path
-    if is_old or match:
-        try:
-            os.remove(file_path)
-        except:
-            # another thread might have deleted it
-            pass
+    # the job's files all live in its own directory, orphans are left to the sweeper
+    remove_job_dir(image_id)
 
 
 def _swinir_args(image_data, image):
@@ -111,14 +102,11 @@ def _swinir_args(image_data, image):
         raise Exception("Image data is required for SwinIR")
     args = SimpleNamespace()
     args.model_path = "003_realSR_BSRGAN_DFO_s64w8_SwinIR-M_x4_GAN.pth"
-    # downsampling to 256 width yields better results
-    buf = BytesIO(image_data)
-    img = Image.open(buf)
-    init_image_path = os.path.join("images", image.id + "-init.png")
-    output_image_path = os.path.join("images", image.id + ".png")
-    img.save(init_image_path)
-    args.init_image = init_image_path
-    args.output_image = output_image_path
+    # handed to the model in memory, the paths are only used if shared memory isn't available
+    args.init_image = job_path(image.id, "init.png")
+    args.init_image_data = image_data
+    args.output_image = job_path(image.id, "output.png")
+    args.output_shm = True
     return args
 
 model_lock = Lock()
@@ -132,7 +120,7 @@ def create_model(gpu: str):
     print("create_model", gpu)
     with model_lock:
         print("lock acquired")
-        return ModelProcess("swinir_model.py", gpu)
+        return ModelProcess("swinir_model.py", gpu, pipeline_depth("swinir"))
 
 # def clear_model():
 #     global model
@@ -147,11 +135,11 @@ def metric(name: str, type: str, value: any, attributes: dict = None) -> SimpleN
     return SimpleNamespace(name=name, type=type, value=value, attributes=attribute_list)
 
 
-def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, websocket_queue: Queue, gpu: str):
-    last_model_check = time.time()
+def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, websocket_queue: Queue, gpu: str, prefetch: PrefetchStage, scheduler: PollScheduler):
     image = None
 
     model_name = "swinir"
+    backlog = False
 
     image = warmup_image(model_name, str(uuid4()))
     process_queue.put(image)
@@ -159,15 +147,21 @@ def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, we
 
     while True:
         try:
-            start = time.time()
+            images = []
+            # images still downloading will take process queue slots too
+            capacity = max(0, free_slots(process_queue) - prefetch.in_flight)
             message = None
             pending_image = False
+            notified_at = None
             config_updated = False
             try:
-                message = websocket_queue.get(timeout=0.1)
+                # sleeps until the next poll is due unless a notification arrives,
+                # but keeps checking for free capacity while there's a backlog
+                message = websocket_queue.get(timeout=0.1 if backlog or not capacity else scheduler.timeout())
             except Empty:
                 pass
             if message:
+                received_at = getattr(message, "received_at", None)
                 message = json.loads(message)
                 if "connected" in message and message["connected"]:
                     print("Connected to websocket")
@@ -176,38 +170,48 @@ def poll_loop(ready_queue: Queue, process_queue: Queue, metrics_queue: Queue, we
                     message = SimpleNamespace(**message)
                     if message.type == NOTIFICATION_PENDING_IMAGE:
                         pending_image = True
+                        notified_at = received_at
                         # worker jitter. All workers are notified at once,
                         # so we wait a random amount of time before trying to process
                         # the next image
                         time.sleep(random.random() * 0.5)
                     elif message.type == NOTIFICATION_WORKER_CONFIG_UPDATED:
                         config_updated = True
-            # poll interval has been changed to every 2 seconds because websocket isn't working anymore
-            if config_updated or time.time() - last_model_check > 2:
+            if pending_image or config_updated:
+                scheduler.wake()
+            if scheduler.ping_due():
+                # claims carry the heartbeat, this is a fallback for backends that ignore it
                 client.worker_ping()
-                last_model_check = time.time()
-
-                image = client.process_image(include_models=[model_name])
-                metrics_queue.put(metric("worker.poll", "count", 1, {
-                    "duration_seconds": time.time() - start,
-                }))
-            elif pending_image:
-                image = client.process_image(include_models=[model_name])
+                scheduler.pinged()
+            if capacity and (scheduler.due() or backlog):
+                start = time.time()
+                images = claim_images(client, capacity, include_models=[model_name], ping=True)
+                for image in images:
+                    # the job's trace starts with the claim
+                    image.trace_id = tracing.start_trace(metrics_queue, image.model, start)
+                    tracing.record("claim", image.trace_id, start, time.time())
+                scheduler.polled(len(images))
                 metrics_queue.put(metric("worker.poll", "count", 1, {
                     "duration_seconds": time.time() - start,
+                    "claimed": len(images),
+                    "interval_seconds": scheduler.interval,
                 }))
-            if image:
-                image.thumbnail_data = None
-                if not image.warmup:
-                    image_download_urls = client.get_image_download_urls(
-                        image.id)
-                    image.image_data = client.get_image_data(
-                        image.id, image_download_urls.image_url)
-                    image.mask_data = None
-                process_queue.put(image)
+                if notified_at:
+                    metrics_queue.put(metric("worker.notification", "count", 1, {
+                        "claim_latency_seconds": time.time() - notified_at,
+                        "claimed": len(images),
+                    }))
+            if capacity:
+                # a claim that filled our capacity means more work is likely waiting
+                backlog = len(images) == capacity
+            for image in images:
                 if image.warmup:
+                    image.thumbnail_data = None
+                    process_queue.put(image)
                     ready_queue.get()
-                image = None
+                else:
+                    # downloads happen off the poll thread
+                    prefetch.submit(image)
         except Exception as err:
             handle_error(err, "poll_loop")
             
@@ -238,6 +242,8 @@ def warmup_image(model_name: str, image_id: str):
         warmup=True,
         nsfw=False,
         negative_phrases=[],
+        trace_id=None,
+        queued_at=None,
     )
 
 
@@ -251,99 +257,131 @@ def process_loop(ready_queue: Queue, process_queue: Queue, update_queue: Queue,
     
     on_kill(handle_killswitch)
 
+    # completes jobs in submission order, while the loop below feeds the model the next ones
+    finish_queue = Queue()
+
+    def update_image(job: SimpleNamespace, iterations: int, status: str, nsfw: bool = False, output_data: bytes = None, output_path: str = None):
+        image = job.image
+        if image.warmup:
+            return
+        score = 0
+        negative_score = 0
+        thumbnail_data = None
+        npy_data = None
+        # output image, handed back by the model process in memory, or in
+        # output_path when it's large, which is then streamed to the upload
+        if image.model == "swinir" and (output_data is not None or output_path):
+            with tracing.span("resize", image.trace_id):
+                img = Image.open(output_path or BytesIO(output_data))
+                # resize image
+                img = img.resize(
+                    (image.width, image.height), Image.ANTIALIAS)
+                if output_path:
+                    img.save(output_path, format="png")
+                else:
+                    buf = BytesIO()
+                    img.save(buf, format="png")
+                    output_data = buf.getvalue()
+
+        if output_data is not None or output_path:
+            with tracing.span("thumbnail", image.trace_id):
+                # use PIL to resize image
+                thumbnail = Image.open(output_path or BytesIO(output_data))
+                # resize image
+                thumbnail = thumbnail.resize((128, 128), Image.ANTIALIAS)
+                # thumbnail = Image.lo(image_data).resize((128, 128), Image.ANTIALIAS)
+                buf = BytesIO()
+                thumbnail.save(buf, format="png")
+                # raw png bytes all the way to the upload, getvalue() doesn't copy
+                thumbnail_data = buf.getvalue()
+        # update image
+        # client.update_image(image.id, image_data, npy_data, iterations, status, score, negative_score, nsfw)
+        update_queue.put(ImageUpdate(
+            id=image.id,
+            image_data=output_data,
+            thumbnail_data=thumbnail_data,
+            npy_data=npy_data,
+            iterations=iterations,
+            status=status,
+            score=score,
+            negative_score=negative_score,
+            nsfw=nsfw,
+            upload_urls=job.upload_urls,
+            image_path=output_path,
+            trace_id=image.trace_id,
+        ))
+
+    def finish_loop():
+        while True:
+            job = finish_queue.get()
+            if job is None:
+                return
+            try:
+                result = job.future.result()
+                # as timed by the model process, ending about now
+                done = time.time()
+                generated = done - result.duration_seconds
+                tracing.record("model_queue", job.image.trace_id, generated - result.queued_seconds, generated)
+                tracing.record("generate", job.image.trace_id, generated, done, result.cpu_seconds)
+                nsfw = result.nsfw or job.image.nsfw  # inherit nsfw from parent
+
+                # TODO: maybe change to "ranking" if we want to start ranking images again
+                update_image(job, job.image.iterations, "completed", nsfw, result.output_data, result.output_path)
+                metrics_queue.put(metric("worker.process", "count", 1, {
+                    "duration_seconds": time.time() - job.start,
+                    "inference_seconds": result.duration_seconds,
+                    "nsfw": nsfw,
+                    "model": job.image.model,
+                }))
+                if job.image.warmup:
+                    ready_queue.put(True)
+            except Exception as e:
+                tracing.end_trace(job.image.trace_id, status="error")
+                handle_error(e, "process_loop")
+
+    finish_thread = Thread(target=finish_loop, name="finish", daemon=True)
+    finish_thread.start()
+
     while True:
         try:
             image = process_queue.get()
             if not image:
+                finish_queue.put(None)
+                finish_thread.join()
                 return
             start = time.time()
+            tracing.record("process_queue_wait", image.trace_id, image.queued_at, start)
             image_data = image.image_data
             mask_data = image.mask_data
 
-            def update_image(iterations: int, status: str, nsfw: bool = False):
-                if image.warmup:
-                    return
-                score = 0
-                negative_score = 0
-                image_data = None
-                thumbnail_data = None
-                npy_data = None
-                # get output image
-                image_path = os.path.join("images", image.id + ".png")
-                if image.model == "swinir" and os.path.exists(image_path):
-                    img = Image.open(image_path)
-                    # resize image
-                    img = img.resize(
-                        (image.width, image.height), Image.ANTIALIAS)
-                    img.save(image_path)
-
-                if os.path.exists(image_path):
-                    with open(image_path, "rb") as f:
-                        image_data = f.read()
-                    # use PIL to resize image
-                    thumbnail = Image.open(image_path)
-                    # resize image
-                    thumbnail = thumbnail.resize((128, 128), Image.ANTIALIAS)
-                    # thumbnail = Image.lo(image_data).resize((128, 128), Image.ANTIALIAS)
-                    buf = BytesIO()
-                    thumbnail.save(buf, format="png")
-                    thumbnail_data = base64.b64encode(
-                        buf.getvalue()).decode("utf-8")
-                    # base64 encode image
-                    image_data = base64.encodebytes(image_data).decode("utf-8")
-                # update image
-                # client.update_image(image.id, image_data, npy_data, iterations, status, score, negative_score, nsfw)
-                update_queue.put(SimpleNamespace(
-                    id=image.id,
-                    image_data=image_data,
-                    thumbnail_data=thumbnail_data,
-                    npy_data=npy_data,
-                    iterations=iterations,
-                    status=status,
-                    score=score,
-                    negative_score=negative_score,
-                    nsfw=nsfw
-                ))
-
-            args = _swinir_args(image_data, image)
-
-            update_image(0, "processing")
-
-            nsfw = model.generate(args)
-            nsfw = nsfw or image.nsfw  # inherit nsfw from parent
-
-            # TODO: maybe change to "ranking" if we want to start ranking images again
-            update_image(image.iterations, "completed", nsfw)
-            metrics_queue.put(metric("worker.process", "count", 1, {
-                "duration_seconds": time.time() - start,
-                "nsfw": nsfw,
-                "model": image.model,
-            }))
-            if image.warmup:
-                ready_queue.put(True)
+            # fetch upload urls while the image generates
+            upload_urls = None
+            if not image.warmup:
+                upload_urls = client.prefetch_image_upload_urls(image.id)
+            job = SimpleNamespace(image=image, upload_urls=upload_urls, start=start, future=None)
+
+            with tracing.span("prepare", image.trace_id):
+                args = _swinir_args(image_data, image)
+
+            update_image(job, 0, "processing")
+
+            # blocks while the model's pipeline is full, finish_loop picks up the result
+            with tracing.span("pipeline_wait", image.trace_id):
+                job.future = model.submit(args)
+            finish_queue.put(job)
         except Exception as e:
             handle_error(e, "process_loop")
             continue
 
 
-def update_loop(update_queue: Queue, cleanup_queue: Queue, metrics_queue: Queue):
-    while True:
-        try:
-            image = update_queue.get()
-            if not image:
-                return
-            start = time.time()
-            client.update_image(image.id, image.image_data, image.thumbnail_data,
-                                image.iterations, image.status, image.score, image.negative_score, image.nsfw)
-            metrics_queue.put(metric("worker.update", "count", 1, {
-                "duration_seconds": time.time() - start
-            }))
-            # cleanup_queue.put(image.id)
-            if image.status == "ranking":
-                cleanup_queue.put(image.id)
-        except Exception as e:
-            handle_error(e, "update_loop")
-            continue
+def send_update(image, cleanup_queue: Queue):
+    # runs on an UploadPool thread, updates for the same image arrive in order
+    client.update_image_data(image.id, image.image_data, image.thumbnail_data,
+                             image.iterations, image.status, image.score, image.negative_score, image.nsfw,
+                             upload_urls=image.upload_urls, image_path=image.image_path)
+    if image.status == "completed":
+        tracing.end_trace(image.trace_id, status="completed")
+        cleanup_queue.put(image.id)
 
 
 def cleanup_loop(cleanup_queue: Queue):
@@ -358,20 +396,29 @@ def cleanup_loop(cleanup_queue: Queue):
             continue
 
 
-def metrics_loop(metrics_queue: Queue):
-    # Collect metrics and send to server every 10 seconds
-    last_send = time.time()
-    collected_metrics = []
-    while True:
+def flush_metrics(aggregator: MetricsAggregator, metrics_queue: MetricsBuffer, scheduler: PollScheduler):
+    collected_metrics = aggregator.flush()
+    # idle requests per second since the last flush
+    collected_metrics.append(scheduler.metric())
+    collected_metrics.extend(client.connection_metrics())
+    collected_metrics.extend(client.request_metrics())
+    dropped = metrics_queue.take_dropped()
+    if dropped:
+        collected_metrics.append(metric("worker.metrics.dropped", "count", dropped))
+    client.add_metrics(collected_metrics)
+
+
+def metrics_loop(metrics_queue: MetricsBuffer, scheduler: PollScheduler):
+    # Aggregate metrics locally and send them to the server every 10 seconds,
+    # producers never wait on this thread
+    aggregator = MetricsAggregator()
+    closed = False
+    while not closed:
         try:
-            metrics = metrics_queue.get()
-            if not metrics:
-                return
-            collected_metrics.append(metrics)
-            if time.time() - last_send > 10:
-                client.add_metrics(collected_metrics)
-                collected_metrics = []
-                last_send = time.time()
+            closed = metrics_queue.wait(METRICS_FLUSH_INTERVAL)
+            for metrics in metrics_queue.drain():
+                aggregator.add(metrics)
+            flush_metrics(aggregator, metrics_queue, scheduler)
         except Exception as e:
             handle_error(e, "metrics_loop")
             continue
@@ -379,49 +426,71 @@ def metrics_loop(metrics_queue: Queue):
 
 class ImagesWorker:
     def __init__(self, gpu: str):
+        self.gpu = gpu
         # create queues
         self.websocket_queue = Queue(maxsize=1)
         self.process_queue = Queue(maxsize=4)
-        self.update_queue = Queue(maxsize=4)
         self.cleanup_queue = Queue(maxsize=4)
-        self.metrics_queue = Queue(maxsize=4)
+        # non-blocking, metrics are dropped rather than stalling the pipeline
+        self.metrics_queue = MetricsBuffer()
+        # updates are uploaded in parallel, in order per image
+        self.upload_pool = UploadPool(
+            lambda image: send_update(image, self.cleanup_queue), self.metrics_queue, handle_error)
+        # "processing" updates are held back briefly, and dropped for jobs that finish first
+        self.update_queue = UpdateCoalescer(self.upload_pool, self.metrics_queue)
         self.ready_queue = Queue(maxsize=1)
 
         # start threads
-        self.apisocket = ApiSocket(api_url, client.token, self.websocket_queue)
-        # self.websocket_thread = Thread(target=self.apisocket.run)
-        self.websocket_thread = Thread(
-            target=asyncio.run, args=(self.apisocket.run(),))
+        # one socket per process, notifications are fanned out to every worker
+        self.apisocket = shared_socket(api_url, client.token)
+        self.apisocket.register(self.websocket_queue)
+        self.prefetch = PrefetchStage(
+            client, self.process_queue, self.metrics_queue, handle_error)
+        # shared by the poll loop and the metrics flush
+        self.scheduler = PollScheduler()
         self.poll_thread = Thread(target=poll_loop, args=(
-            self.ready_queue, self.process_queue, self.metrics_queue, self.websocket_queue, gpu))
+            self.ready_queue, self.process_queue, self.metrics_queue, self.websocket_queue, gpu, self.prefetch, self.scheduler))
         self.process_thread = Thread(target=process_loop, args=(
             self.ready_queue, self.process_queue, self.update_queue, self.metrics_queue, gpu))
-        self.update_thread = Thread(target=update_loop, args=(
-            self.update_queue, self.cleanup_queue, self.metrics_queue))
         self.cleanup_thread = Thread(
             target=cleanup_loop, args=(self.cleanup_queue,))
         self.metrics_thread = Thread(
-            target=metrics_loop, args=(self.metrics_queue,))
+            target=metrics_loop, args=(self.metrics_queue, self.scheduler))
+        # live /metrics for scraping, shared with the workers of the other gpus
+        self.metrics_endpoint = metrics_endpoint()
+        self.metrics_endpoint.register(self.collect_metrics)
 
     def start(self):
         # start threads
-        self.websocket_thread.start()
+        self.apisocket.start()
         self.poll_thread.start()
-        self.update_thread.start()
+        self.upload_pool.start()
+        self.update_queue.start()
         self.cleanup_thread.start()
+        start_sweeper()
         self.metrics_thread.start()
+        self.metrics_endpoint.start()
         self.process_thread.start()
 
     def wait(self):
         self.process_thread.join()
-        self.websocket_thread.join()
+        self.apisocket.join()
         self.poll_thread.join()
-        self.update_thread.join()
+        self.update_queue.join()
+        self.upload_pool.join()
         self.cleanup_thread.join()
         self.metrics_thread.join()
 
+    def collect_metrics(self) -> list:
+        # called on the metrics endpoint's thread when scraped
+        return pipeline_samples(self, gpu=self.gpu) + [
+            sample("worker_free_memory_bytes", get_free_memory(self.gpu), gpu=self.gpu),
+        ]
+
     def kill(self):
-        self.apisocket.kill()
+        self.metrics_endpoint.unregister(self.collect_metrics)
+        self.apisocket.unregister(self.websocket_queue)
+        self.prefetch.shutdown()
         self.websocket_queue.put(None)
         self.process_queue.put(None)
         self.update_queue.put(None)
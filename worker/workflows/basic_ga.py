@@ -3,6 +3,7 @@ import random
 from types import SimpleNamespace
 
 from api_client import AIBrushAPI
+from records import as_dict
 from workflows.generation import Generation
 
 def basic_ga(client: AIBrushAPI, workflow: SimpleNamespace):
@@ -46,7 +47,7 @@ def basic_ga(client: AIBrushAPI, workflow: SimpleNamespace):
                 negative_phrases=config["negative_phrases"].split("|"),
                 glid_3_xl_skip_iterations=skip_iterations,
             )
-            data["images"].append(image.__dict__)
+            data["images"].append(as_dict(image))
             generation.ping_if_needed()
         client.update_workflow(workflow.id, data_json=json.dumps(data), state="running")
     elif workflow.state == "running":
@@ -4,6 +4,7 @@ import random
 import time
 
 from api_client import AIBrushAPI
+from records import as_dict
 
 class Generation:
     def __init__(self, client: AIBrushAPI, workflow: SimpleNamespace, data_key="images"):
@@ -39,7 +40,7 @@ class Generation:
                 print(f"Error getting image {image.id}: {inst}")
             self.ping_if_needed()
         self.sort_images()
-        data[self.data_key] = [image.__dict__ for image in self.images]
+        data[self.data_key] = [as_dict(image) for image in self.images]
         self.workflow.data_json = json.dumps(data)
         self.client.update_workflow(self.workflow.id, data_json=self.workflow.data_json)
         return all_completed
@@ -57,7 +58,7 @@ class Generation:
             self.client.delete_image(image.id)
             self.ping_if_needed()
         self.images = survivors
-        data[self.data_key] = [image.__dict__ for image in survivors]
+        data[self.data_key] = [as_dict(image) for image in survivors]
         self.workflow.data_json = json.dumps(data)
         self.client.update_workflow(self.workflow.id, data_json=self.workflow.data_json)
 
@@ -69,7 +70,7 @@ class Generation:
         }
         for i in range(generation_size):
             image = self.client.create_image(**args)
-            data["images"].append(image.__dict__)
+            data["images"].append(as_dict(image))
             self.ping_if_needed()
         self.workflow.data_json = json.dumps(data)
         self.client.update_workflow(self.workflow.id, data_json=self.workflow.data_json, state=state)
@@ -108,6 +109,6 @@ class Generation:
             image = self.client.create_image(**create_from_parent(parent))
             self.images.append(image)
             self.ping_if_needed()
-        data[self.data_key] = [image.__dict__ for image in self.images]
+        data[self.data_key] = [as_dict(image) for image in self.images]
         self.workflow.data_json = json.dumps(data)
         self.client.update_workflow(self.workflow.id, data_json=self.workflow.data_json)
\ No newline at end of file
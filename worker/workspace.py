@@ -0,0 +1,84 @@
+# Per-job scratch directories. Every file a job writes (init image, mask,
+# output) goes in images/<image id>/, and the whole directory is removed in
+# one go when the job completes, instead of scanning every scratch folder
+# for files matching the id.
+# Jobs that never complete (errors, warmups, a killed worker) leave their
+# directory behind; a background sweeper removes anything in the scratch
+# folders older than ORPHAN_MAX_AGE.
+# Configurable options:
+#  ORPHAN_MAX_AGE: seconds before an untouched scratch entry is swept
+#  SWEEP_INTERVAL: seconds between sweeps
+
+import os
+import shutil
+import time
+from threading import Lock, Thread
+
+WORKSPACE_ROOT = "images"
+# legacy output folders, only swept
+SWEEP_FOLDERS = [WORKSPACE_ROOT, "output", "output_npy", os.path.join("results", "swinir_real_sr_x4")]
+
+ORPHAN_MAX_AGE = float(os.environ.get("ORPHAN_MAX_AGE", "3600"))
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", "600"))
+
+
+def job_dir(image_id: str) -> str:
+    return os.path.join(WORKSPACE_ROOT, image_id)
+
+
+def job_path(image_id: str, name: str) -> str:
+    # path of a file in the job's directory, which is created if needed
+    path = job_dir(image_id)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, name)
+
+
+def remove_job_dir(image_id: str):
+    shutil.rmtree(job_dir(image_id), ignore_errors=True)
+
+
+def sweep(folders=SWEEP_FOLDERS, max_age: float = ORPHAN_MAX_AGE) -> int:
+    # removes scratch entries (job directories or loose files) not modified for max_age
+    removed = 0
+    cutoff = time.time() - max_age
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    # another thread might have deleted it
+                    pass
+    return removed
+
+
+def _sweep_loop(interval: float):
+    while True:
+        try:
+            removed = sweep()
+            if removed:
+                print(f"Swept {removed} orphaned scratch entries")
+        except Exception as err:
+            print(f"Error sweeping scratch folders: {err}")
+        time.sleep(interval)
+
+
+_sweeper = None
+_sweeper_lock = Lock()
+
+
+def start_sweeper(interval: float = SWEEP_INTERVAL):
+    # one sweeper thread per process, however many workers start it
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = Thread(target=_sweep_loop, args=(interval,), name="workspace-sweeper", daemon=True)
+            _sweeper.start()